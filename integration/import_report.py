@@ -0,0 +1,96 @@
+'''
+    Timing and throughput for an import run. Saved as JSON in DataImport.report and shown
+    by `python manage.py import_report`.
+'''
+
+from contextlib import contextmanager, nullcontext
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ImportReport(object):
+
+    # wall-clock time of the stage that loads the TTL files, which may load several at once
+    LOAD_STAGE = "insertions"
+
+    def __init__(self):
+        self.files = []
+        self.deletion_files = []
+        self.stages = []
+        self.depth = 0 # stages are only opened from the thread running the import
+
+    @contextmanager
+    def stage(self, name):
+        t1 = time.perf_counter()
+        depth = self.depth
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth = depth
+            seconds = time.perf_counter() - t1
+            self.stages.append({"stage": name, "seconds": round(seconds, 3), "depth": depth})
+            logger.info(f"Stage {name} took {seconds:.1f} seconds")
+
+    def add_file(self, filename, triples, subjects, seconds):
+        # list.append is atomic so this is ok from the loader threads
+        self.files.append({"filename": filename, "triples": triples, "subjects": subjects,
+                           "seconds": round(seconds, 3),
+                           "triples_per_second": rate(triples, seconds)})
+
+    def add_deletion_file(self, filename, doc_ids, nodes_deleted, seconds):
+        self.deletion_files.append({"filename": filename, "doc_ids": doc_ids, "nodes_deleted": nodes_deleted,
+                                    "seconds": round(seconds, 3),
+                                    "nodes_deleted_per_second": rate(nodes_deleted, seconds)})
+
+    def as_dict(self):
+        triples = sum([x["triples"] for x in self.files])
+        load_stages = [x["seconds"] for x in self.stages if x["stage"] == self.LOAD_STAGE]
+        load_seconds = sum(load_stages) if len(load_stages) > 0 else sum([x["seconds"] for x in self.files])
+        nodes_deleted = sum([x["nodes_deleted"] for x in self.deletion_files])
+        deletion_seconds = sum([x["seconds"] for x in self.deletion_files])
+        summary = {
+            "files": len(self.files),
+            "triples": triples,
+            "triples_per_second": rate(triples, load_seconds),
+            "deletion_files": len(self.deletion_files),
+            "nodes_deleted": nodes_deleted,
+            "nodes_deleted_per_second": rate(nodes_deleted, deletion_seconds),
+            # nested stages are already inside their parent's time
+            "total_stage_seconds": round(sum([x["seconds"] for x in self.stages if x["depth"] == 0]), 3),
+        }
+        return {"summary": summary, "stages": self.stages,
+                "files": self.files, "deletion_files": self.deletion_files}
+
+
+def rate(count, seconds):
+    if seconds <= 0:
+        return None
+    return round(count / seconds, 1)
+
+
+def timed_stage(report, name):
+    '''
+        Context manager that times `name` into report if there is one
+    '''
+    if report is None:
+        return nullcontext()
+    return report.stage(name)
+
+
+def format_report(report_dict):
+    lines = []
+    summary = report_dict.get("summary", {})
+    lines.append(f"Files: {summary.get('files')}, {summary.get('triples')} triples at {summary.get('triples_per_second')} triples/sec")
+    lines.append(f"Deletion files: {summary.get('deletion_files')}, {summary.get('nodes_deleted')} nodes at {summary.get('nodes_deleted_per_second')} nodes/sec")
+    lines.append("Stages:")
+    for stage in report_dict.get("stages", []):
+        name = "  " * stage.get("depth", 0) + stage["stage"]
+        lines.append(f"    {name:<60} {stage['seconds']:>10.1f}s")
+    slowest = sorted(report_dict.get("files", []), key=lambda x: x["seconds"], reverse=True)[:5]
+    if len(slowest) > 0:
+        lines.append("Slowest files:")
+        for row in slowest:
+            lines.append(f"    {row['filename']:<60} {row['seconds']:>10.1f}s {row['triples_per_second']} triples/sec")
+    return "\n".join(lines)
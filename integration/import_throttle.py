@@ -0,0 +1,75 @@
+'''
+    Backpressure for the TTL importer, which runs while the site is serving traffic.
+
+    After each file a cheap probe query is timed over Bolt (and optionally heap usage is read from
+    dbms.queryJmx). While the database looks overloaded the pause before the next file doubles;
+    once the probe is comfortably under target the pause halves back down to the minimum.
+'''
+
+from neomodel import db
+import threading
+import time
+from syracuse.settings import (RDF_SLEEP_TIME, RDF_MAX_SLEEP_TIME,
+    RDF_TARGET_LATENCY_MS, RDF_THROTTLE_USE_JMX)
+import logging
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveThrottle(object):
+
+    PROBE_QUERY = "MATCH (n: Resource) RETURN n.uri LIMIT 1"
+    HEAP_QUERY = """CALL dbms.queryJmx("java.lang:type=Memory") YIELD attributes
+                    RETURN attributes.HeapMemoryUsage.value.properties.used,
+                           attributes.HeapMemoryUsage.value.properties.max"""
+
+    def __init__(self, min_sleep=RDF_SLEEP_TIME, max_sleep=RDF_MAX_SLEEP_TIME,
+                 target_latency=RDF_TARGET_LATENCY_MS / 1000, use_jmx=RDF_THROTTLE_USE_JMX,
+                 max_heap_ratio=0.9):
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.target_latency = target_latency
+        self.use_jmx = use_jmx
+        self.max_heap_ratio = max_heap_ratio
+        self.sleep_time = min_sleep
+        self.total_sleep_time = 0
+        self.lock = threading.Lock() # shared by the loader threads
+
+    def probe_latency(self):
+        t1 = time.perf_counter()
+        db.cypher_query(self.PROBE_QUERY)
+        return time.perf_counter() - t1
+
+    def heap_ratio(self):
+        if self.use_jmx is False:
+            return None
+        try:
+            vals, _ = db.cypher_query(self.HEAP_QUERY)
+            used, max_heap = vals[0]
+            return used / max_heap
+        except Exception as e:
+            logger.warning(f"Couldn't read heap usage from JMX, not using it again: {e}")
+            self.use_jmx = False
+            return None
+
+    def adjust(self, latency, heap_ratio=None):
+        with self.lock:
+            overloaded = latency > self.target_latency or (
+                heap_ratio is not None and heap_ratio > self.max_heap_ratio)
+            if overloaded:
+                self.sleep_time = min(self.max_sleep, max(self.sleep_time * 2, 1))
+            elif latency < self.target_latency / 2:
+                self.sleep_time = self.sleep_time / 2
+                if self.sleep_time < 1:
+                    self.sleep_time = 0
+            self.sleep_time = max(self.sleep_time, self.min_sleep)
+            return self.sleep_time
+
+    def pause(self):
+        latency = self.probe_latency()
+        heap_ratio = self.heap_ratio()
+        sleep_time = self.adjust(latency, heap_ratio)
+        logger.info(f"Probe latency {latency * 1000:.0f}ms, heap ratio {heap_ratio}: pausing {sleep_time:.1f} seconds")
+        time.sleep(sleep_time)
+        with self.lock:
+            self.total_sleep_time += sleep_time
+        return sleep_time
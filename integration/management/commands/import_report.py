@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from integration.models import DataImport
+from integration.import_report import format_report
+
+
+def import_reports(import_ts=None, limit=5):
+    imports = DataImport.objects.filter(report__isnull=False)
+    if import_ts is not None:
+        imports = imports.filter(import_ts=import_ts)
+    return imports.order_by("-run_at")[:limit]
+
+
+class Command(BaseCommand):
+    '''
+        Shows the timing and throughput reports saved by import_ttl
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument("-i","--import_ts",
+                default=None,
+                help="Only show the report for this export directory name")
+        parser.add_argument("-l","--limit",
+                default=5,
+                type=int,
+                help="Number of most recent imports to show. Defaults to 5")
+
+    def handle(self, *args, **options):
+        imports = import_reports(options["import_ts"], options["limit"])
+        if len(imports) == 0:
+            self.stdout.write("No import reports found")
+        for di in imports:
+            self.stdout.write(f"{di.import_ts} run at {di.run_at}: {di.creations} creations, {di.deletions} deletions")
+            self.stdout.write(format_report(di.report))
+            self.stdout.write("")
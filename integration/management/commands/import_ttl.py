@@ -1,25 +1,34 @@
 from django.core.management.base import BaseCommand
 import os
 import subprocess
-from integration.models import DataImport
+from integration.models import DataImport, DataImportFile
 from datetime import datetime, timezone
 from integration.neo4j_utils import (
-    setup_db_if_necessary, get_node_name_from_rdf_row,
-    get_internal_doc_ids_from_rdf_row, count_nodes,
-    delete_and_clean_up_nodes_by_doc_id,
+    setup_db_if_necessary, count_nodes,
+    use_database, live_database, standby_database, switch_database_alias,
+    delete_and_clean_up_nodes_by_doc_ids, N10S_PREDICATE_EXCLUSION_LIST,
 )
+from integration.ttl_utils import scan_ttl_file
+from integration.import_report import ImportReport, timed_stage, format_report
+from integration.import_throttle import AdaptiveThrottle
+import json
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from neomodel import db
 from trackeditems.management.commands.send_recent_activities_email import do_send_recent_activities_email
-from syracuse.settings import RDF_SLEEP_TIME, RDF_DUMP_DIR, RDF_ARCHIVE_DIR
+from syracuse.settings import (RDF_SLEEP_TIME, RDF_DUMP_DIR, RDF_ARCHIVE_DIR,
+    RDF_IMPORT_WORKERS, RDF_IMPORT_FULL_COUNTS, NEOMODEL_NEO4J_BOLT_URL,
+    NEO4J_BUFFER_DATABASES)
 from pathlib import Path
 from topics.cache_helpers import refresh_geo_data
+from topics.merge_targets import build_merge_target_map
 from integration.rdf_post_processor import RDFPostProcessor
 from auth_extensions.anon_user_utils import create_anon_user
 
 logger = logging.getLogger(__name__)
 PIDFILE="/tmp/syracuse-import-ttl.pid"
+DUAL_BUFFER=len(NEO4J_BUFFER_DATABASES) == 2
 
 
 def is_running(pidfile):
@@ -59,54 +68,190 @@ def move_files(src_dir,target_dir):
     logger.info(res)
 
 def load_ttl_files(dir_name,RDF_SLEEP_TIME,
-                    raise_on_error=True):
+                    raise_on_error=True,
+                    max_workers=RDF_IMPORT_WORKERS,
+                    touched_uris=None,
+                    report=None,
+                    full_counts=RDF_IMPORT_FULL_COUNTS,
+                    database="",
+                    throttled=True):
+    '''
+        If touched_uris is a set it is updated with the uris of all subjects loaded, all nodes
+        un-merged by deletions and the neighbours of deleted nodes, for use in incremental post-processing.
+        If report is an ImportReport it gets per-file throughput and per-phase timings.
+        database is the buffer database being loaded (see use_database) so that checkpoints are kept per database.
+        Set throttled to False when loading a database that isn't serving the site.
+    '''
+    import_ts = os.path.basename(os.path.normpath(dir_name))
+    already_loaded = DataImportFile.loaded_files(import_ts, database)
+    if len(already_loaded) > 0:
+        logger.info(f"Resuming {import_ts}: {len(already_loaded)} files were already loaded")
     delete_dir = f"{dir_name}/deletions"
     count_of_creations = 0
     count_of_deletions = 0
     if os.path.isdir(delete_dir):
-        delete_files = [x for x in os.listdir(delete_dir) if x.endswith(".ttl")]
-        logger.info(f"Found {len(delete_files)} ttl files to delete, currenty have {count_nodes()} nodes")
+        delete_files = sorted([x for x in os.listdir(delete_dir) if x.endswith(".ttl")])
+        logger.info(f"Found {len(delete_files)} ttl files to delete")
+        log_count_nodes("Before deletions", full_counts)
         for filename in delete_files:
-            deletions = load_deletion_file(f"{delete_dir}/{filename}")
+            checkpoint_name = f"deletions/{filename}"
+            if checkpoint_name in already_loaded:
+                count_of_deletions += already_loaded[checkpoint_name].deletions
+                if touched_uris is not None:
+                    logger.warning(f"{checkpoint_name} was loaded in an earlier run, nodes it un-merged won't be in incremental post-processing")
+                continue
+            deletions = load_deletion_file(f"{delete_dir}/{filename}", touched_uris=touched_uris, report=report)
+            DataImportFile.record(import_ts, checkpoint_name, deletions=deletions, database=database)
             count_of_deletions += deletions
-    logger.info(f"After running deletion files there are {count_nodes()} nodes")
+        log_count_nodes("After deletions", full_counts)
     all_files = sorted([x for x in os.listdir(dir_name) if x.endswith(".ttl")])
     logger.info(f"Found {len(all_files)} ttl files to process")
     if len(all_files) == 0:
         logger.info("No insertion files to load, quitting")
         return count_of_deletions, 0
+    files_to_load = []
     for filename in all_files:
-        creations = load_file(f"{dir_name}/{filename}",RDF_SLEEP_TIME,raise_on_error)
-        count_of_creations += creations
-    logger.info(f"After running insertion files there are {count_nodes()} nodes")
+        if filename in already_loaded:
+            count_of_creations += already_loaded[filename].creations
+            if touched_uris is not None:
+                uris, _, _ = scan_ttl_file(f"{dir_name}/{filename}")
+                touched_uris.update(uris)
+        else:
+            files_to_load.append(filename)
+    logger.info(f"Loading {len(files_to_load)} ttl files with {max_workers} worker(s), skipping {len(all_files) - len(files_to_load)} already loaded")
+    with timed_stage(report, "insertions"):
+        count_of_creations += load_files_concurrently(dir_name, import_ts, files_to_load, RDF_SLEEP_TIME,
+                                                      raise_on_error, max_workers, touched_uris, report,
+                                                      database, throttled)
+    log_count_nodes("After insertions", full_counts)
     return count_of_creations, count_of_deletions
 
-def load_deletion_file(filepath):
+def load_export_dirs(export_dirs, touched_uris=None, database="", throttled=True,
+                     record_imports=False, do_archiving=False, **load_options):
+    '''
+        Returns list of (export_dir, count_of_creations, count_of_deletions, ImportReport).
+        With record_imports each directory gets its DataImport row as soon as it is loaded, and with do_archiving
+        it is then moved to RDF_ARCHIVE_DIR
+    '''
+    results = []
+    for export_dir in export_dirs:
+        report = ImportReport()
+        count_of_creations, count_of_deletions = load_ttl_files(export_dir, RDF_SLEEP_TIME,
+                                                    touched_uris=touched_uris, report=report,
+                                                    database=database, throttled=throttled,
+                                                    **load_options)
+        if record_imports is True:
+            di = DataImport(
+                run_at = datetime.now(tz=timezone.utc),
+                import_ts = os.path.basename(export_dir),
+                deletions = count_of_deletions,
+                creations = count_of_creations,
+                report = report.as_dict(),
+            )
+            di.save()
+        if do_archiving is True:
+            logger.info(f"Archiving files from {export_dir} to {RDF_ARCHIVE_DIR}")
+            move_files(export_dir,RDF_ARCHIVE_DIR)
+        results.append( (export_dir, count_of_creations, count_of_deletions, report) )
+    return results
+
+def catch_up_database(database, compared_to_database, dump_dir, touched_uris=None, **load_options):
+    '''
+        Loads any exports that went into compared_to_database but not (fully) into database,
+        from the dump or archive directory. Needs to be run with use_database(database)
+    '''
+    export_dirs = []
+    for import_ts in DataImportFile.incomplete_imports(database, compared_to_database):
+        candidates = [os.path.join(x, import_ts) for x in [dump_dir, RDF_ARCHIVE_DIR]]
+        found = [x for x in candidates if os.path.isdir(x)]
+        if len(found) == 0:
+            raise ValueError(f"Can't find {import_ts} in {candidates} to catch up {database}")
+        export_dirs.append(found[0])
+    if len(export_dirs) > 0:
+        logger.info(f"Catching up {database} with {export_dirs}")
+    return load_export_dirs(export_dirs, touched_uris, database=database, throttled=False, **load_options)
+
+def log_count_nodes(text, full_counts):
+    if full_counts is True:
+        logger.info(f"{text}: {count_nodes()} nodes")
+
+def load_files_concurrently(dir_name, import_ts, files_to_load, RDF_SLEEP_TIME,
+                            raise_on_error, max_workers, touched_uris, report,
+                            database="", throttled=True):
+    count_of_creations = 0
+    if throttled is True:
+        throttle = AdaptiveThrottle(min_sleep=RDF_SLEEP_TIME)
+    else:
+        throttle = None
+        RDF_SLEEP_TIME = 0
+    bolt_url = db.url # workers use the same database as this thread
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {executor.submit(load_file_in_worker, f"{dir_name}/{filename}",
+                                RDF_SLEEP_TIME, raise_on_error, touched_uris, report, throttle, bolt_url): filename for filename in files_to_load}
+    try:
+        for future in as_completed(futures):
+            filename = futures[future]
+            creations = future.result()
+            DataImportFile.record(import_ts, filename, creations=creations, database=database)
+            count_of_creations += creations
+    except Exception:
+        logger.error(f"Stopping load of {dir_name}, files not yet loaded will be picked up on the next run")
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+    if throttle is not None:
+        logger.info(f"Paused for {throttle.total_sleep_time:.1f} seconds in total to keep the database responsive")
+    return count_of_creations
+
+def load_file_in_worker(filepath, RDF_SLEEP_TIME, raise_on_error=True, touched_uris=None, report=None, throttle=None,
+                        bolt_url=NEOMODEL_NEO4J_BOLT_URL):
+    if getattr(db, "driver", None) is None:
+        # neomodel connection state is thread-local, so worker threads need their own
+        db.set_connection(bolt_url)
+    return load_file(filepath, RDF_SLEEP_TIME, raise_on_error, touched_uris=touched_uris, report=report,
+                     throttle=throttle)
+
+def load_deletion_file(filepath, touched_uris=None, report=None):
+    '''
+        Returns change in node count (i.e. negative number of nodes deleted)
+    '''
     filepath = os.path.abspath(filepath)
-    count_query = f"MATCH (n: Resource) RETURN COUNT(n)"
-    cnt, _ = db.cypher_query(count_query)
-    with open(filepath) as f:
-        doc_ids = set([get_internal_doc_ids_from_rdf_row(x) for x in f.readlines() if get_internal_doc_ids_from_rdf_row(x) is not None])
-    for doc_id in doc_ids:
-        delete_and_clean_up_nodes_by_doc_id(doc_id)
-    cnt2, _ = db.cypher_query(count_query)
-    logger.info(f"Before deleting {cnt[0][0]} nodes. After delete {cnt2[0][0]} nodes")
-    return cnt2[0][0] - cnt[0][0]
-
-def load_file(filepath,RDF_SLEEP_TIME, raise_on_error=True):
+    _, doc_ids, _ = scan_ttl_file(filepath)
+    chunk_stats = delete_and_clean_up_nodes_by_doc_ids(doc_ids, touched_uris=touched_uris)
+    deletion_seconds = sum([x["seconds"] for x in chunk_stats])
+    nodes_deleted = sum([x["nodes_deleted"] for x in chunk_stats])
+    logger.info(f"Deleted {nodes_deleted} nodes for {len(doc_ids)} doc ids in {len(chunk_stats)} chunks, {deletion_seconds:.1f} seconds")
+    if report is not None:
+        report.add_deletion_file(os.path.basename(filepath), len(doc_ids), nodes_deleted, deletion_seconds)
+    return 0 - nodes_deleted
+
+def load_file(filepath,RDF_SLEEP_TIME, raise_on_error=True, touched_uris=None, report=None, throttle=None):
+    '''
+        With an AdaptiveThrottle the pause after loading depends on how busy the database is,
+        otherwise it's a fixed RDF_SLEEP_TIME
+    '''
     filepath = os.path.abspath(filepath)
     command = f"""CALL n10s.rdf.import.fetch("file://{filepath}","Turtle",
-                {{ predicateExclusionList : [ "https://1145.am/db/geoNamesRDF" ] }} );"""
+                {{ predicateExclusionList : {json.dumps(N10S_PREDICATE_EXCLUSION_LIST)} }} );"""
     logger.info(f"Loading: {command}")
+    t1 = time.perf_counter()
     results,columns = db.cypher_query(command)
+    seconds = time.perf_counter() - t1
     res = results[0] # row like ['KO', 0, 5025, None, 'Unexpected character U+FFFC at index 57: https://1145.am/db/techcrunchcom_2011_12_02_doo-net-gets-￼6-8m-to-reinvent-office-paperwork-oh-yes-2_ [line 5121]', {'singleTx': False}]
     if res[0] != 'OK':
         logger.error(f"{command}: {res}")
         if raise_on_error is True:
             raise ValueError(f"{command} failed with {res}")
-    with open(filepath) as f:
-        uris = [get_node_name_from_rdf_row(x) for x in f.readlines() if get_node_name_from_rdf_row(x) is not None]
-    time.sleep(RDF_SLEEP_TIME)
+    uris, _, type_counts = scan_ttl_file(filepath)
+    if touched_uris is not None:
+        touched_uris.update(uris) # set.update is atomic under the GIL so ok from worker threads
+    logger.info(f"Loaded {len(uris)} subjects ({res[1]} triples) from {filepath} in {seconds:.1f} seconds: {dict(type_counts)}")
+    if report is not None:
+        report.add_file(os.path.basename(filepath), res[1], len(uris), seconds)
+    if throttle is None:
+        time.sleep(RDF_SLEEP_TIME)
+    else:
+        throttle.pause()
     return len(uris)
 
 
@@ -143,6 +288,22 @@ class Command(BaseCommand):
                 default=False,
                 action="store_true",
                 help="Just run post-processing (excluding stats calculation)")
+        parser.add_argument("-w","--workers",
+                default=RDF_IMPORT_WORKERS,
+                type=int,
+                help=f"Number of TTL files to load concurrently. Defaults to {RDF_IMPORT_WORKERS}")
+        parser.add_argument("-i","--incremental_post_processing",
+                default=False,
+                action="store_true",
+                help="Only post-process nodes touched by this import rather than the whole graph")
+        parser.add_argument("-b","--dual_buffer",
+                default=DUAL_BUFFER,
+                action="store_false",
+                help="Set this flag to load straight into the live database even if NEO4J_BUFFER_DATABASES is set")
+        parser.add_argument("-c","--full_counts",
+                default=RDF_IMPORT_FULL_COUNTS,
+                action="store_true",
+                help="Log full-graph node and relationship counts between stages (slow on a big graph)")
 
     def handle(self, *args, **options):
         do_import_ttl(**options)
@@ -156,7 +317,11 @@ def do_import_ttl(**options):
     send_notifications = options.get("send_notifications",False)
     do_post_processing = options.get("do_post_processing",True)
     raise_on_error = options.get("raise_on_error",True)
-    R = RDFPostProcessor()
+    workers = options.get("workers",RDF_IMPORT_WORKERS)
+    incremental_post_processing = options.get("incremental_post_processing",False)
+    full_counts = options.get("full_counts",RDF_IMPORT_FULL_COUNTS)
+    dual_buffer = options.get("dual_buffer",DUAL_BUFFER)
+    R = RDFPostProcessor(full_counts=full_counts)
     if force:
         cleanup(pidfile)
     if not is_allowed_to_start(pidfile):
@@ -164,7 +329,12 @@ def do_import_ttl(**options):
         return None
     if options.get("only_post_processing",False) is True:
         logger.info("Only doing post processing")
-        R.run_all_in_order()
+        report = ImportReport()
+        setup_db_if_necessary() # constraints and indexes aren't there after a neo4j-admin import
+        R.run_all_in_order(report=report)
+        with report.stage("build_merge_target_map"):
+            build_merge_target_map()
+        logger.info(f"Post processing report:\n{format_report(report.as_dict())}")
         cleanup(pidfile)
         return None
     export_dirs = new_exports_to_import(dump_dir)
@@ -172,34 +342,59 @@ def do_import_ttl(**options):
         logger.info("No new TTL files to import")
         cleanup(pidfile)
         return None
-    setup_db_if_necessary()
-    total_creations = 0
-    total_deletions = 0
-    for export_dir in export_dirs:
-        count_of_creations, count_of_deletions = load_ttl_files(
-                                                    export_dir,RDF_SLEEP_TIME,
-                                                    raise_on_error=raise_on_error)
-        di = DataImport(
-            run_at = datetime.now(tz=timezone.utc),
-            import_ts = os.path.basename(export_dir),
-            deletions = count_of_deletions,
-            creations = count_of_creations,
-        )
-        total_creations += count_of_creations
-        total_deletions += count_of_deletions
-        di.save()
-        if do_archiving is True:
-            logger.info(f"Archiving files from {export_dir} to {RDF_ARCHIVE_DIR}")
-            move_files(export_dir,RDF_ARCHIVE_DIR)
+    load_options = {"raise_on_error": raise_on_error, "max_workers": workers, "full_counts": full_counts}
+    touched_uris = set() if incremental_post_processing is True else None
+    if dual_buffer is True:
+        live = live_database()
+        standby = standby_database()
+        logger.info(f"Dual-buffer import into {standby} while {live} serves the site")
+        with use_database(standby):
+            setup_db_if_necessary()
+            catch_up_database(standby, live, dump_dir, touched_uris, **load_options)
+            results = load_export_dirs(export_dirs, touched_uris, database=standby, throttled=False,
+                                       record_imports=True, do_archiving=do_archiving, **load_options)
+            report = results[-1][3]
+            def switch_to_standby():
+                with report.stage("switch_database_alias"):
+                    switch_database_alias(standby)
+            if do_post_processing is True:
+                RDFPostProcessor(full_counts=full_counts, database=standby).run_all_in_order(uris=touched_uris, report=report)
+                # Caches and Redis indexes are built from the standby, then the alias and the cache generation switch together
+                with report.stage("refresh_geo_data"):
+                    refresh_geo_data(report=report, before_publish=switch_to_standby)
+            else:
+                switch_to_standby()
+    else:
+        setup_db_if_necessary()
+        results = load_export_dirs(export_dirs, touched_uris, record_imports=True, do_archiving=do_archiving,
+                                   **load_options)
+        report = results[-1][3]
+    total_creations = sum([x[1] for x in results])
+    total_deletions = sum([x[2] for x in results])
     logger.info(f"Loaded {total_creations} creations and {total_deletions} deletions from {len(export_dirs)} directories")
-    if do_post_processing is True:
-        R.run_all_in_order()
+    # post-processing etc is for the whole run, so its timings go in the report for the latest export
+    if do_post_processing is True and dual_buffer is False:
+        R.run_all_in_order(uris=touched_uris, report=report)
     if send_notifications is True and total_creations > 0:
         do_send_recent_activities_email()
     else:
         logger.info("No email sending this time")
-    if do_post_processing is True:
-        refresh_geo_data()
+    if do_post_processing is True and dual_buffer is False:
+        with report.stage("refresh_geo_data"):
+            refresh_geo_data(report=report)
+    if dual_buffer is True and live is None:
+        logger.warning(f"No alias pointed at a buffer database before this run so nothing to catch up")
+    elif dual_buffer is True:
+        # The old live database is no longer serving so can catch up at full speed
+        with use_database(live), report.stage("catch_up_previous_live_database"):
+            catch_up_touched_uris = set() if incremental_post_processing is True else None
+            catch_up_database(live, standby, dump_dir, catch_up_touched_uris, **load_options)
+            if do_post_processing is True:
+                RDFPostProcessor(full_counts=full_counts, database=live).run_all_in_order(uris=catch_up_touched_uris)
+    di = DataImport.objects.filter(import_ts=os.path.basename(export_dirs[-1])).order_by("-run_at").first()
+    di.report = report.as_dict()
+    di.save()
+    logger.info(f"Import report for {di.import_ts}:\n{format_report(di.report)}")
     logger.info("re-set cache")
     create_anon_user()
     cleanup(pidfile)
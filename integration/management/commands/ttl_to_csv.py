@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+import os
+from datetime import datetime, timezone
+from integration.models import DataImport
+from integration.ttl_to_csv import export_dirs_to_csv, neo4j_admin_import_command
+from syracuse.settings import RDF_DUMP_DIR
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def export_dirs_in_order(dirname):
+    export_dirs = []
+    for x in sorted(os.listdir(dirname)):
+        if x.isdigit() and os.path.isdir(os.path.join(dirname, x)):
+            export_dirs.append(os.path.join(dirname, x))
+    return export_dirs
+
+
+class Command(BaseCommand):
+    '''
+        For fresh installs: converts the dump TTL files into CSVs for `neo4j-admin database import full`
+        (much faster than `import_ttl` for a full dump). After running the printed neo4j-admin command
+        and restarting Neo4j, run `python manage.py import_ttl -o` to post-process.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument("-d","--dirname",
+                default=RDF_DUMP_DIR,
+                help="Dump directory containing the export directories")
+        parser.add_argument("-o","--output_dir",
+                default=f"{os.getcwd()}/tmp/neo4j_import",
+                help="Where to write the CSV files")
+        parser.add_argument("-w","--workers",
+                default=os.cpu_count(),
+                type=int,
+                help="Number of processes for parsing TTL files. Defaults to number of CPUs")
+        parser.add_argument("-m","--mark_imported",
+                default=False,
+                action="store_true",
+                help="Record the export directories as imported so that import_ttl won't load them again")
+
+    def handle(self, *args, **options):
+        export_dirs = export_dirs_in_order(options["dirname"])
+        if len(export_dirs) == 0:
+            logger.info(f"No export directories found in {options['dirname']}")
+            return None
+        res = export_dirs_to_csv(export_dirs, options["output_dir"], workers=options["workers"])
+        if options["mark_imported"] is True:
+            # counts are for the whole conversion so go against the latest export dir
+            for export_dir in export_dirs:
+                DataImport.objects.create(
+                    run_at = datetime.now(tz=timezone.utc),
+                    import_ts = os.path.basename(export_dir),
+                    deletions = 0,
+                    creations = res["counts"]["nodes"] if export_dir == export_dirs[-1] else 0,
+                )
+        command = neo4j_admin_import_command(res["node_files"], res["relationship_files"])
+        logger.info(f"Stop Neo4j, then run:\n{command}")
+        self.stdout.write(command)
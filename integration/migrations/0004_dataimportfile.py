@@ -0,0 +1,31 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('integration', '0003_alter_dataimport_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataImportFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('import_ts', models.TextField()),
+                ('filename', models.TextField()),
+                ('loaded_at', models.DateTimeField()),
+                ('deletions', models.IntegerField(default=0)),
+                ('creations', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['import_ts', 'filename'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dataimportfile',
+            constraint=models.UniqueConstraint(models.F('import_ts'), models.F('filename'), name='unique_import_ts_filename'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('integration', '0004_dataimportfile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataimport',
+            name='report',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('integration', '0005_dataimport_report'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='dataimportfile',
+            name='unique_import_ts_filename',
+        ),
+        migrations.AddField(
+            model_name='dataimportfile',
+            name='database',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddConstraint(
+            model_name='dataimportfile',
+            constraint=models.UniqueConstraint(models.F('import_ts'), models.F('filename'), models.F('database'), name='unique_import_ts_filename_database'),
+        ),
+    ]
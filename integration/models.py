@@ -7,6 +7,7 @@ class DataImport(models.Model):
     import_ts = models.TextField()
     deletions = models.IntegerField()
     creations = models.IntegerField()
+    report = models.JSONField(null=True, blank=True) # see integration.import_report
 
     class Meta:
         constraints = [
@@ -30,3 +31,53 @@ class DataImport(models.Model):
         fmt = "%Y%m%d%H%M%S"
         d = datetime.strptime(str(ts),fmt)
         return d.astimezone(timezone.utc)
+
+
+class DataImportFile(models.Model):
+    '''
+        One row per TTL file that has been fully loaded from an export directory.
+        Lets an interrupted import skip files that already went in.
+    '''
+    import_ts = models.TextField()
+    filename = models.TextField() # relative to the export directory, e.g. full_dump_0001.ttl or deletions/foo.ttl
+    loaded_at = models.DateTimeField()
+    deletions = models.IntegerField(default=0)
+    creations = models.IntegerField(default=0)
+    database = models.TextField(default="", blank=True) # buffer database for dual-buffer imports, blank otherwise
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint("import_ts", "filename", "database", name="unique_import_ts_filename_database")
+        ]
+        ordering = ['import_ts','filename']
+
+    @staticmethod
+    def loaded_files(import_ts, database=""):
+        '''
+            Returns dict of filename -> DataImportFile for files already loaded from this export
+        '''
+        return {x.filename: x for x in DataImportFile.objects.filter(import_ts=import_ts, database=database)}
+
+    @staticmethod
+    def incomplete_imports(database, compared_to_database):
+        '''
+            import_ts of exports with files loaded into compared_to_database but not (all) into database
+        '''
+        res = []
+        import_tss = DataImportFile.objects.filter(database=compared_to_database).values_list("import_ts", flat=True)
+        for import_ts in sorted(set(import_tss)):
+            expected = set(DataImportFile.loaded_files(import_ts, compared_to_database).keys())
+            loaded = set(DataImportFile.loaded_files(import_ts, database).keys())
+            if len(expected - loaded) > 0:
+                res.append(import_ts)
+        return res
+
+    @staticmethod
+    def record(import_ts, filename, deletions=0, creations=0, database=""):
+        obj, _ = DataImportFile.objects.update_or_create(
+            import_ts=import_ts, filename=filename, database=database,
+            defaults={"loaded_at": datetime.now(tz=timezone.utc),
+                      "deletions": deletions,
+                      "creations": creations},
+        )
+        return obj
@@ -1,26 +1,32 @@
 import logging
+from contextlib import contextmanager
 from neomodel import db
-import re
 from datetime import datetime
+from syracuse.settings import (NEOMODEL_NEO4J_SCHEME, NEOMODEL_NEO4J_USERNAME,
+    NEOMODEL_NEO4J_PASSWORD, NEOMODEL_NEO4J_HOSTNAME, NEOMODEL_NEO4J_PORT,
+    NEO4J_DATABASE, NEO4J_BUFFER_DATABASES)
 from topics.models import Resource
+from integration.ttl_utils import INTERNAL_DOC_ID_REGEX, SUBJECT_REGEX
 
 logger = logging.getLogger(__name__)
 
 def delete_and_clean_up_nodes_from_doc_id_file(doc_id_file):
     with open(doc_id_file, "r") as f:
         doc_ids = f.readlines()
+    valid_doc_ids = []
     for row in doc_ids:
         try:
-            doc_id = int(row.strip())
-            logger.info(f"Deleting internalDocId {doc_id}")
-            delete_and_clean_up_nodes_by_doc_id(doc_id)
+            valid_doc_ids.append(int(row.strip()))
         except:
             logger.info(f"Couldn't do anything with internalDocID {row}")
+    logger.info(f"Deleting {len(valid_doc_ids)} internalDocIds")
+    return delete_and_clean_up_nodes_by_doc_ids(valid_doc_ids)
 
 def setup_db_if_necessary():
     db.cypher_query("CREATE CONSTRAINT n10s_unique_uri IF NOT EXISTS FOR (r:Resource) REQUIRE r.uri IS UNIQUE;")
     db.cypher_query("CREATE INDEX node_internal_doc_id_index IF NOT EXISTS FOR (n:Resource) on (n.internalDocId)")
     db.cypher_query("CREATE INDEX node_merged_same_as_high_to_uri IF NOT EXISTS FOR (n:Resource) on (n.internalMergedSameAsHighToUri)")
+    db.cypher_query("CREATE INDEX node_same_as_name_only_component IF NOT EXISTS FOR (n:Resource) on (n.internalSameAsNameOnlyComponentId)")
     db.cypher_query("CREATE FULLTEXT INDEX resource_names IF NOT EXISTS FOR (r:Resource) ON EACH [r.name]")
     db.cypher_query("CREATE INDEX article_date_published IF NOT EXISTS FOR (a:Article) ON (a.datePublished)")
     db.cypher_query("CREATE INDEX geonames_location_country_admin1_index IF NOT EXISTS FOR (n: GeoNamesLocation) on (n.countryCode, n.admin1Code)")
@@ -32,25 +38,28 @@ def setup_db_if_necessary():
     else:
         do_n10s_config(overwrite=True)
 
+N10S_MULTIVAL_PROPS = ["actionFoundName","activityType","basedInHighClean",
+    "basedInHighGeoName",
+    "basedInHighRaw","basedInLowRaw",
+    "description","foundName","industry",
+    "locationFoundName",
+    "locationPurpose","locationType","name",
+    "nameClean", "orgName",
+    "orgFoundName",
+    "productName",
+    "roleFoundName","roleHolderFoundName",
+    "status","targetDetails","targetName",
+    "useCase",
+    "valueRaw",
+    "when","whenRaw","whereHighGeoName","whereHighRaw","whereHighClean",
+    # IndustryCluster
+    "representation","representativeDoc",
+]
+
+N10S_PREDICATE_EXCLUSION_LIST = ["https://1145.am/db/geoNamesRDF"]
+
 def do_n10s_config(overwrite=False):
-    multivals = ["actionFoundName","activityType","basedInHighClean",
-                "basedInHighGeoName",
-                "basedInHighRaw","basedInLowRaw",
-                "description","foundName","industry",
-                "locationFoundName",
-                "locationPurpose","locationType","name",
-                "nameClean", "orgName",
-                "orgFoundName",
-                "productName",
-                "roleFoundName","roleHolderFoundName",
-                "status","targetDetails","targetName",
-                "useCase",
-                "valueRaw",
-                "when","whenRaw","whereHighGeoName","whereHighRaw","whereHighClean",
-                # IndustryCluster
-                "representation","representativeDoc",
-                ]
-    proplist = [f"https://1145.am/db/{x}" for x in multivals]
+    proplist = [f"https://1145.am/db/{x}" for x in N10S_MULTIVAL_PROPS]
     params = 'handleVocabUris: "MAP",handleMultival:"ARRAY",multivalPropList:["' + "\",\"".join(proplist) + '"]'
     if overwrite is True:
         query = 'CALL n10s.graphconfig.set({' + params + ', force: true })'
@@ -59,13 +68,25 @@ def do_n10s_config(overwrite=False):
     logger.info(query)
     db.cypher_query(query)
 
-def apoc_del_redundant_same_as():
-    output_same_as_stats("Before delete")
+def apoc_del_redundant_same_as(full_counts=True):
+    if full_counts is True:
+        output_same_as_stats("Before delete")
     apoc_query_high = f'CALL apoc.periodic.iterate("MATCH (n1:Organization)-[r1:sameAsHigh]->(n2:Organization)-[r2:sameAsHigh]->(n1) where elementId(n1) < elementId(n2) RETURN *","DELETE r2",{{}})'
     db.cypher_query(apoc_query_high)
     apoc_query_medium = f'CALL apoc.periodic.iterate("MATCH (n1:Organization)-[r1:sameAsNameOnly]->(n2:Organization)-[r2:sameAsNameOnly]->(n1) where elementId(n1) < elementId(n2) RETURN *","DELETE r2",{{}})'
     db.cypher_query(apoc_query_medium)
-    output_same_as_stats("After Delete sameAsNameOnly")
+    if full_counts is True:
+        output_same_as_stats("After Delete sameAsNameOnly")
+
+def apoc_del_redundant_same_as_for_uris(uris):
+    '''
+        Same as apoc_del_redundant_same_as but only looks at pairs that include one of the uris.
+        Of each pair of opposing relationships, the one pointing at the lower elementId node is deleted.
+    '''
+    for rel_type in ["sameAsHigh", "sameAsNameOnly"]:
+        query = f"UNWIND $uris AS uri MATCH (t:Organization {{uri: uri}})-[x:{rel_type}]->(o:Organization)-[y:{rel_type}]->(t) RETURN DISTINCT CASE WHEN elementId(t) < elementId(o) THEN y ELSE x END AS r2"
+        apoc_query = f'CALL apoc.periodic.iterate("{query}","DELETE r2",{{params: {{uris: $uris}}}})'
+        db.cypher_query(apoc_query, {"uris": list(uris)})
 
 def delete_all_not_needed_resources():
     query = """MATCH (n: Resource) WHERE n.uri CONTAINS 'https://1145.am/db/'
@@ -81,28 +102,76 @@ def output_same_as_stats(msg):
     logger.info(f"{msg} sameAsHigh: {same_as_high_count[0][0]}; sameAsNameOnly: {same_as_medium_count[0][0]}")
 
 def get_internal_doc_ids_from_rdf_row(row):
-    res = re.findall(r"^\s+ns1:internalDocId\s(\d+)", row)
-    if len(res) > 0:
-        return int(res[0])
+    res = INTERNAL_DOC_ID_REGEX.match(row)
+    if res is not None:
+        return int(res.group(1))
     else:
         return None
 
 def get_node_name_from_rdf_row(row):
-    res = re.findall(r"^<(https://\S.+)> a", row)
-    if len(res) > 0:
-        return res[0]
+    res = SUBJECT_REGEX.match(row)
+    if res is not None:
+        return res.group(1)
     else:
         return None
 
+RESET_MERGED_INTO_DOC_IDS_QUERY = """
+    UNWIND $doc_ids AS doc_id
+    MATCH (n: Resource {internalDocId: doc_id})
+    WITH n.uri AS deleted_uri
+    MATCH (m: Resource {internalMergedSameAsHighToUri: deleted_uri})
+    SET m.internalMergedSameAsHighToUri = NULL
+    RETURN COLLECT(DISTINCT m.uri)
+"""
+
+# Nodes left behind with a relationship gone, e.g. an Organization losing an activity, so their stats need redoing
+NEIGHBOURS_OF_DOC_IDS_QUERY = """
+    UNWIND $doc_ids AS doc_id
+    MATCH (n: Resource {internalDocId: doc_id})-[]-(m: Resource)
+    WHERE m.internalDocId IS NULL OR NOT m.internalDocId IN $all_doc_ids
+    RETURN COLLECT(DISTINCT m.uri)
+"""
+
+DELETE_BY_DOC_IDS_QUERY = """
+    UNWIND $doc_ids AS doc_id
+    MATCH (n: Resource {internalDocId: doc_id})
+    DETACH DELETE n
+    RETURN COUNT(n)
+"""
+
 def delete_and_clean_up_nodes_by_doc_id(doc_id):
-    nodes_to_delete = Resource.nodes.filter(internalDocId=doc_id)
-    uris_to_delete = [x.uri for x in nodes_to_delete]
-    merged_nodes = Resource.nodes.filter(internalMergedSameAsHighToUri__in=uris_to_delete)
-    for n in nodes_to_delete:
-        n.delete()
-    for m in merged_nodes:
-        m.internalMergedSameAsHighToUri = None
-        m.save()
+    return delete_and_clean_up_nodes_by_doc_ids([doc_id])
+
+def delete_and_clean_up_nodes_by_doc_ids(doc_ids, batch_size=1000, touched_uris=None):
+    '''
+        Deletes all nodes with any of the given internalDocIds, and un-merges any nodes
+        that had been merged into them, in one transaction per chunk of doc ids.
+        If touched_uris is a set it is updated with the uris of the un-merged nodes and of
+        the surviving nodes that had a relationship with a deleted one.
+
+        Returns list of dicts with per-chunk stats
+    '''
+    doc_ids = sorted(set(doc_ids))
+    chunk_stats = []
+    for idx in range(0, len(doc_ids), batch_size):
+        chunk = doc_ids[idx:idx + batch_size]
+        t1 = datetime.now()
+        neighbour_uris = []
+        with db.transaction:
+            reset, _ = db.cypher_query(RESET_MERGED_INTO_DOC_IDS_QUERY, {"doc_ids": chunk})
+            if touched_uris is not None:
+                neighbours, _ = db.cypher_query(NEIGHBOURS_OF_DOC_IDS_QUERY, {"doc_ids": chunk, "all_doc_ids": doc_ids})
+                neighbour_uris = neighbours[0][0]
+            deleted, _ = db.cypher_query(DELETE_BY_DOC_IDS_QUERY, {"doc_ids": chunk})
+        t2 = datetime.now()
+        if touched_uris is not None:
+            touched_uris.update(reset[0][0])
+            touched_uris.update(neighbour_uris)
+        stats = {"doc_ids": len(chunk), "nodes_deleted": deleted[0][0],
+                 "nodes_unmerged": len(reset[0][0]), "seconds": (t2 - t1).total_seconds()}
+        logger.info(f"Deleted chunk {idx // batch_size + 1} of {len(doc_ids)} doc ids: {stats}")
+        chunk_stats.append(stats)
+    return chunk_stats
 
 def count_relationships():
     vals, _ = db.cypher_query("MATCH ()-[x]-() RETURN COUNT(x);")
@@ -112,3 +181,42 @@ def count_relationships():
 def count_nodes():
     val, _ = db.cypher_query("MATCH (n) RETURN COUNT(n)")
     return val[0][0]
+
+def bolt_url_for_database(database):
+    return f"{NEOMODEL_NEO4J_SCHEME}://{NEOMODEL_NEO4J_USERNAME}:{NEOMODEL_NEO4J_PASSWORD}@{NEOMODEL_NEO4J_HOSTNAME}:{NEOMODEL_NEO4J_PORT}/{database}"
+
+@contextmanager
+def use_database(database):
+    '''
+        Points neomodel (in this thread) at another database on the same server, e.g. a standby buffer or system
+    '''
+    previous_url = db.url
+    db.set_connection(bolt_url_for_database(database))
+    try:
+        yield
+    finally:
+        db.set_connection(previous_url)
+
+def live_database(alias=NEO4J_DATABASE):
+    '''
+        The buffer database that the site's alias currently points at
+    '''
+    with use_database("system"):
+        vals, _ = db.cypher_query("SHOW ALIASES FOR DATABASE YIELD name, database WHERE name = $alias RETURN database",
+                                  {"alias": alias})
+    if len(vals) == 0:
+        return None
+    return vals[0][0]
+
+def standby_database(alias=NEO4J_DATABASE, buffer_databases=NEO4J_BUFFER_DATABASES):
+    assert len(buffer_databases) == 2, f"Expected two buffer databases, got {buffer_databases}"
+    live = live_database(alias)
+    return [x for x in buffer_databases if x != live][0]
+
+def switch_database_alias(target, alias=NEO4J_DATABASE):
+    '''
+        One statement, so queries go either to the old database or to the new one, never a mix
+    '''
+    logger.info(f"Switching {alias} to {target}")
+    with use_database("system"):
+        db.cypher_query(f"CREATE OR REPLACE ALIAS `{alias}` FOR DATABASE `{target}`")
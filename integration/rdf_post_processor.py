@@ -1,15 +1,29 @@
 from topics.models import Resource
+from topics.models.models import most_common_name, by_popularity
 from topics.models.models_extras import add_dynamic_classes_for_multiple_labels
-from neomodel import db
+from neomodel import db, RelationshipTo, RelationshipFrom
+from collections import defaultdict
 import logging
-from integration.neo4j_utils import count_relationships, apoc_del_redundant_same_as
+from integration.neo4j_utils import (count_relationships, apoc_del_redundant_same_as,
+    apoc_del_redundant_same_as_for_uris)
 from integration.vector_search_utils import create_new_embeddings
+from integration.import_report import ImportReport
 logger = logging.getLogger(__name__)
 
 class RDFPostProcessor(object):
 
-    # m is target (that we are going to merge to), n is source (that we are copying relationships from)
-    QUERY_SAME_AS_HIGH_FOR_MERGE = f"""
+    QUERY_SAME_AS_HIGH_FOR_MERGE_COUNT = f"""
+        MATCH (m: Resource)-[x:sameAsHigh]-(n: Resource)
+        WHERE m.internalDocId <= n.internalDocId
+        AND m.internalMergedSameAsHighToUri IS NULL
+        AND n.internalMergedSameAsHighToUri IS NULL
+        AND LABELS(m) = LABELS(n)
+        AND NOT ANY(x in LABELS(n) WHERE x =~ ".+Activity")
+        RETURN count(*)
+    """
+
+    # All candidate pairs in one go, used to build connected components
+    QUERY_SAME_AS_HIGH_FOR_MERGE_ALL = f"""
         MATCH (m: Resource)-[x:sameAsHigh]-(n: Resource)
         WHERE m.internalDocId <= n.internalDocId
         AND m.internalMergedSameAsHighToUri IS NULL
@@ -20,110 +34,454 @@ class RDFPostProcessor(object):
         AND NOT "LocationActivity" IN LABELS(m)
         AND NOT "PartnershipActivity" IN LABELS(m)
         AND NOT "ProductActivity" IN LABELS(m)
-        RETURN m,n
-        ORDER BY m.internalDocId
-        LIMIT 1000
+        AND m.uri <> n.uri
+        RETURN DISTINCT m.uri, m.internalDocId, n.uri, n.internalDocId, LABELS(m)
     """
 
-    QUERY_SAME_AS_HIGH_FOR_MERGE_COUNT = f"""
-        MATCH (m: Resource)-[x:sameAsHigh]-(n: Resource)
-        WHERE m.internalDocId <= n.internalDocId
-        AND m.internalMergedSameAsHighToUri IS NULL
+    # Candidate pairs where one side is in $uris. Used for incremental post-processing so doesn't
+    # constrain which side has the lower internalDocId - same_as_high_components sorts that out
+    QUERY_SAME_AS_HIGH_FOR_MERGE_BY_URIS = f"""
+        UNWIND $uris AS uri
+        MATCH (m: Resource {{uri: uri}})-[x:sameAsHigh]-(n: Resource)
+        WHERE m.internalMergedSameAsHighToUri IS NULL
         AND n.internalMergedSameAsHighToUri IS NULL
         AND LABELS(m) = LABELS(n)
-        AND NOT ANY(x in LABELS(n) WHERE x =~ ".+Activity")
-        RETURN count(*)
+        AND NOT "CorporateFinanceActivity" IN LABELS(m)
+        AND NOT "RoleActivity" IN LABELS(m)
+        AND NOT "LocationActivity" IN LABELS(m)
+        AND NOT "PartnershipActivity" IN LABELS(m)
+        AND NOT "ProductActivity" IN LABELS(m)
+        AND m.uri <> n.uri
+        RETURN DISTINCT m.uri, m.internalDocId, n.uri, n.internalDocId, LABELS(m)
     """
 
+    QUERY_SET_MERGED_TO_URI = """
+        UNWIND $pairs AS pair
+        MATCH (source: Resource {uri: pair.source})
+        SET source.internalMergedSameAsHighToUri = pair.target
+    """
+
+    MERGE_BATCH_SIZE = 500
+
     QUERY_SELF_RELATIONSHIP = f"""
         MATCH (n: Resource)-[r]-(n)
         DELETE r
         RETURN *
     """
 
-    def run_all_in_order(self):
+    QUERY_SELF_RELATIONSHIP_BY_URIS = f"""
+        UNWIND $uris AS uri
+        MATCH (n: Resource {{uri: uri}})-[r]-(n)
+        DELETE r
+        RETURN *
+    """
+
+    QUERY_UNMERGED_ORGANIZATION_URIS = """
+        MATCH (n: Resource&Organization)
+        WHERE n.internalMergedSameAsHighToUri IS NULL
+        AND n.uri > $after
+        RETURN n.uri
+        ORDER BY n.uri
+        LIMIT $limit
+    """
+
+    # Organizations whose stats could have changed when the nodes in $uris were loaded or merged
+    QUERY_UNMERGED_ORGANIZATION_URIS_NEAR_URIS = """
+        UNWIND $uris AS uri
+        MATCH (t: Resource {uri: uri})
+        OPTIONAL MATCH (t)-[]-(o: Resource&Organization)
+        WITH COLLECT(t) + COLLECT(o) AS nodes
+        UNWIND nodes AS n
+        WITH DISTINCT n
+        WHERE n:Organization AND n.internalMergedSameAsHighToUri IS NULL
+        RETURN n.uri
+    """
+
+    QUERY_ORGANIZATION_STATS_INPUTS = """
+        UNWIND $uris AS uri
+        MATCH (n: Resource&Organization {uri: uri})
+        OPTIONAL MATCH (n)-[x]-()
+        WITH n, SUM(x.weight) AS sum_of_weights
+        OPTIONAL MATCH (n)-[:industryClusterPrimary]->(i: IndustryCluster)
+        WITH n, sum_of_weights, COLLECT(i.uri) AS industry_uris
+        OPTIONAL MATCH (n)-[:sameAsHigh]-(s: Resource)
+        OPTIONAL MATCH (s)-[:industryClusterPrimary]->(si: IndustryCluster)
+        WITH n, sum_of_weights, industry_uris, s, COLLECT(si.uri) AS same_as_industry_uris
+        RETURN n.uri, sum_of_weights, n.name, industry_uris, COLLECT([s.name, same_as_industry_uris])
+    """
+
+    QUERY_SET_ORGANIZATION_STATS = """
+        UNWIND $rows AS row
+        MATCH (n: Resource {uri: row.uri})
+        SET n.internalSumOfWeights = row.sum_of_weights,
+            n.internalBestName = row.best_name,
+            n.internalIndustryUris = row.industry_uris
+    """
+
+    STATS_BATCH_SIZE = 1000
+
+    QUERY_SAME_AS_NAME_ONLY_PAIRS = """
+        MATCH (n: Resource&Organization)-[:sameAsNameOnly]-(o: Resource&Organization)
+        WHERE n.internalMergedSameAsHighToUri IS NULL
+        AND o.internalMergedSameAsHighToUri IS NULL
+        AND n.uri < o.uri
+        RETURN DISTINCT n.uri, o.uri
+    """
+
+    QUERY_SAME_AS_NAME_ONLY_INPUTS = """
+        UNWIND $uris AS uri
+        MATCH (n: Resource {uri: uri})
+        OPTIONAL MATCH (n)-[]-(a: Article)
+        RETURN n.uri, n.internalDocId, COUNT(a)
+    """
+
+    QUERY_URIS_WITH_SAME_AS_NAME_ONLY_COMPONENT = """
+        MATCH (n: Resource) WHERE n.internalSameAsNameOnlyComponentId IS NOT NULL
+        RETURN n.uri
+    """
+
+    QUERY_SET_SAME_AS_NAME_ONLY_COMPONENTS = """
+        UNWIND $rows AS row
+        MATCH (n: Resource {uri: row.uri})
+        SET n.internalSameAsNameOnlyComponentId = row.component_id,
+            n.internalSameAsNameOnlyRepresentativeUri = row.representative_uri,
+            n.internalSameAsNameOnlyArticleCount = row.article_count
+    """
+
+    QUERY_CLEAR_SAME_AS_NAME_ONLY_COMPONENTS = """
+        UNWIND $uris AS uri
+        MATCH (n: Resource {uri: uri})
+        REMOVE n.internalSameAsNameOnlyComponentId, n.internalSameAsNameOnlyRepresentativeUri,
+            n.internalSameAsNameOnlyArticleCount
+    """
+
+    def __init__(self, full_counts=True, database=None):
+        self.full_counts = full_counts # full-graph relationship counts before/after the slow steps
+        self.database = database # for embeddings, which use their own driver. None means the site's database
+
+    def run_all_in_order(self, uris=None, report=None):
+        '''
+            If uris is provided (e.g. the subjects touched by the latest import) each step only
+            looks at those nodes and their immediate neighbours rather than the whole graph.
+            If report is an ImportReport each step is timed into it.
+        '''
+        if uris is not None:
+            uris = sorted(set(uris))
+            logger.info(f"Incremental post-processing for {len(uris)} uris")
+        if report is None:
+            report = ImportReport()
         write_log_header("Creating multi-inheritance classes")
-        add_dynamic_classes_for_multiple_labels(ignore_cache=True)
+        with report.stage("post_processing.add_dynamic_classes"):
+            add_dynamic_classes_for_multiple_labels(ignore_cache=True, uris=uris)
         write_log_header("del_redundant_same_as")
-        apoc_del_redundant_same_as()
+        with report.stage("post_processing.del_redundant_same_as"):
+            if uris is None:
+                apoc_del_redundant_same_as(full_counts=self.full_counts)
+            else:
+                apoc_del_redundant_same_as_for_uris(uris)
         write_log_header("delete_self_relationships")
-        self.delete_self_relationships()
+        with report.stage("post_processing.delete_self_relationships"):
+            self.delete_self_relationships(uris)
         write_log_header("add_document_extract_to_relationship")
-        self.add_document_extract_to_relationship()
+        with report.stage("post_processing.add_document_extract_to_relationship"):
+            self.add_document_extract_to_relationship(uris)
         write_log_header("Set default weighting to 1")
-        self.add_weighting_to_relationship()
+        with report.stage("post_processing.add_weighting_to_relationship"):
+            self.add_weighting_to_relationship(uris)
         write_log_header("Creating multi-inheritance classes")
         add_dynamic_classes_for_multiple_labels()
         write_log_header("merge_same_as_high_connections")
-        self.merge_same_as_high_connections()
+        with report.stage("post_processing.merge_same_as_high_connections"):
+            merge_target_uris = self.merge_same_as_high_connections(uris)
+        if uris is not None:
+            # targets picked up relationships from the nodes merged into them, so their stats need redoing too
+            uris = sorted(set(uris) | merge_target_uris)
+        write_log_header("precompute_organization_stats")
+        with report.stage("post_processing.precompute_organization_stats"):
+            self.precompute_organization_stats(uris)
+        write_log_header("precompute_same_as_name_only_components")
+        with report.stage("post_processing.precompute_same_as_name_only_components"):
+            self.precompute_same_as_name_only_components()
         write_log_header("adding embeddings")
-        create_new_embeddings()
+        with report.stage("post_processing.create_new_embeddings"):
+            if self.database is None:
+                create_new_embeddings()
+            else:
+                create_new_embeddings(database=self.database)
+        return report
 
-    def delete_self_relationships(self):
-        res, _ = db.cypher_query(self.QUERY_SELF_RELATIONSHIP)
-        logger.info(f"Deleted {len(res)} self-relationships")
+    def precompute_organization_stats(self, uris=None):
+        '''
+            Writes sum_of_weights, best_name and industry_list onto each unmerged Organization so they come
+            back with the node rather than needing queries per node. Same logic as the Organization properties.
 
-    def merge_same_as_high_connections(self):
+            If uris is provided only organizations in or next to uris are updated.
+        '''
         cnt = 0
-        log_count_relationships("Before merge_same_as_high_connections")
-        while True:
-            logger.info("Querying for entries to merge")
-            vals,_ = db.cypher_query(self.QUERY_SAME_AS_HIGH_FOR_MERGE,
-                                        resolve_objects=True)
-            if len(vals) == 0:
-                break
-            for target_node_tmp, source_node_tmp in vals:
-                res = self.merge_nodes(source_node_tmp, target_node_tmp)
-                if res is False:
+        if uris is not None:
+            vals, _ = db.cypher_query(self.QUERY_UNMERGED_ORGANIZATION_URIS_NEAR_URIS, {"uris": uris})
+            org_uris = [x[0] for x in vals]
+            for idx in range(0, len(org_uris), self.STATS_BATCH_SIZE):
+                cnt += self.set_organization_stats(org_uris[idx:idx + self.STATS_BATCH_SIZE])
+        else:
+            after = ""
+            while True:
+                vals, _ = db.cypher_query(self.QUERY_UNMERGED_ORGANIZATION_URIS, {"after": after, "limit": self.STATS_BATCH_SIZE})
+                if len(vals) == 0:
                     break
-                cnt += 1
-                if cnt % 1000 == 0:
-                    log_count_relationships(f"After merge_same_as_high_connections {cnt} records")
-                if cnt % 100 == 0:
-                    logger.info(f"Merged merge_same_as_high_connections {cnt} records")
-
-        log_count_relationships("After merge_same_as_high_connections")
-
-    def merge_nodes(self,source_node_tmp, target_node_tmp):
-        source_node2 = Resource.self_or_ultimate_target_node(source_node_tmp.uri)
-        target_node2 = Resource.self_or_ultimate_target_node(target_node_tmp.uri)
-        logger.info(f"Merging {source_node_tmp.uri} ({source_node2.uri}) into {target_node_tmp.uri} ({target_node2.uri})")
-        if source_node2.internalMergedSameAsHighToUri is not None:
-            logger.info(f"{source_node2.uri} is already merged into {source_node2.internalMergedSameAsHighToUri}, not merging again")
-            return False
-        if target_node2.internalDocId <= source_node2.internalDocId:
-            source_node = source_node2
-            target_node = target_node2
+                after = vals[-1][0]
+                cnt += self.set_organization_stats([x[0] for x in vals])
+        logger.info(f"Precomputed stats for {cnt} organizations")
+        return cnt
+
+    def set_organization_stats(self, org_uris):
+        vals, _ = db.cypher_query(self.QUERY_ORGANIZATION_STATS_INPUTS, {"uris": org_uris})
+        rows = []
+        for uri, sum_of_weights, names, industry_uris, same_as_highs in vals:
+            name_cands = list(names or [])
+            for same_as_names, same_as_industry_uris in same_as_highs:
+                name_cands.extend(same_as_names or [])
+                industry_uris.extend(same_as_industry_uris)
+            rows.append({"uri": uri, "sum_of_weights": sum_of_weights,
+                         "best_name": most_common_name(name_cands),
+                         "industry_uris": by_popularity(industry_uris)})
+        db.cypher_query(self.QUERY_SET_ORGANIZATION_STATS, {"rows": rows})
+        return len(rows)
+
+    def precompute_same_as_name_only_components(self):
+        '''
+            Groups unmerged Organizations connected by sameAsNameOnly and writes the group's id, its representative
+            (lowest internalDocId) and the group's total article count onto each member, so that searches
+            and family trees don't need to walk sameAsNameOnly.
+
+            Always looks at the whole graph because one new sameAsNameOnly can join two existing groups.
+        '''
+        vals, _ = db.cypher_query(self.QUERY_SAME_AS_NAME_ONLY_PAIRS)
+        component_ids = same_as_name_only_components(vals)
+        member_uris = sorted(component_ids.keys())
+        doc_ids = {}
+        article_counts = {}
+        for idx in range(0, len(member_uris), self.STATS_BATCH_SIZE):
+            vals, _ = db.cypher_query(self.QUERY_SAME_AS_NAME_ONLY_INPUTS, {"uris": member_uris[idx:idx + self.STATS_BATCH_SIZE]})
+            for uri, doc_id, article_count in vals:
+                doc_ids[uri] = doc_id
+                article_counts[uri] = article_count
+        members = defaultdict(list)
+        for uri, component_id in component_ids.items():
+            members[component_id].append(uri)
+        rows = []
+        for component_id, uris in members.items():
+            representative_uri = min(uris, key=lambda x: (doc_ids.get(x) is None, doc_ids.get(x) or 0, x))
+            article_count = sum(article_counts.get(x, 0) for x in uris)
+            rows.extend({"uri": uri, "component_id": component_id, "representative_uri": representative_uri,
+                         "article_count": article_count} for uri in uris)
+        for idx in range(0, len(rows), self.STATS_BATCH_SIZE):
+            db.cypher_query(self.QUERY_SET_SAME_AS_NAME_ONLY_COMPONENTS, {"rows": rows[idx:idx + self.STATS_BATCH_SIZE]})
+        vals, _ = db.cypher_query(self.QUERY_URIS_WITH_SAME_AS_NAME_ONLY_COMPONENT)
+        stale_uris = [x[0] for x in vals if x[0] not in component_ids]
+        for idx in range(0, len(stale_uris), self.STATS_BATCH_SIZE):
+            db.cypher_query(self.QUERY_CLEAR_SAME_AS_NAME_ONLY_COMPONENTS, {"uris": stale_uris[idx:idx + self.STATS_BATCH_SIZE]})
+        logger.info(f"Precomputed {len(members)} sameAsNameOnly groups covering {len(rows)} organizations, cleared {len(stale_uris)}")
+        return len(members)
+
+    def delete_self_relationships(self, uris=None):
+        if uris is None:
+            res, _ = db.cypher_query(self.QUERY_SELF_RELATIONSHIP)
         else:
-            logger.info(f"Flipping them round because {source_node2.internalDocId} is lower then {target_node2.internalDocId}")
-            source_node = target_node2
-            target_node = source_node2
-        if source_node.uri == target_node.uri:
-            logger.info("Nodes are already merged to the same target, skipping")
-            return False
-        Resource.merge_node_connections(source_node,target_node)
-        return True
-    
-    def add_document_extract_to_relationship(self):
+            res, _ = db.cypher_query(self.QUERY_SELF_RELATIONSHIP_BY_URIS, {"uris": uris})
+        logger.info(f"Deleted {len(res)} self-relationships")
+
+    def same_as_high_candidates_for_uris(self, uris):
+        '''
+            Candidate pairs for the sameAsHigh connected components reachable from uris.
+            Keeps following newly found nodes until no more turn up.
+        '''
+        rows = []
+        seen = set(uris)
+        frontier = list(seen)
+        while len(frontier) > 0:
+            vals, _ = db.cypher_query(self.QUERY_SAME_AS_HIGH_FOR_MERGE_BY_URIS, {"uris": frontier})
+            rows.extend(vals)
+            frontier = []
+            for row in vals:
+                if row[2] not in seen:
+                    seen.add(row[2])
+                    frontier.append(row[2])
+        return rows
+
+    def merge_same_as_high_connections(self, uris=None):
+        '''
+            Each connected component of sameAsHigh is merged into its node with the lowest internalDocId:
+            relationships are copied over (summing weights where the target already has the same
+            relationship) and the other nodes point at the target via internalMergedSameAsHighToUri.
+
+            If uris is provided only components that include one of them are merged.
+
+            Returns the set of target uris that had nodes merged into them.
+        '''
+        logger.info("Querying for entries to merge")
+        if uris is None:
+            if self.full_counts is True:
+                log_count_relationships("Before merge_same_as_high_connections")
+            vals, _ = db.cypher_query(self.QUERY_SAME_AS_HIGH_FOR_MERGE_ALL)
+        else:
+            vals = self.same_as_high_candidates_for_uris(uris)
+        components_by_labels = same_as_high_components(vals)
+        cnt = 0
+        target_uris = set()
+        for labels, components in components_by_labels.items():
+            pairs = []
+            for component in components:
+                target_doc_id, target_uri = component[0]
+                for _, source_uri in component[1:]:
+                    pairs.append({"source": source_uri, "target": target_uri})
+                target_uris.add(target_uri)
+            logger.info(f"Merging {len(pairs)} {labels} nodes into {len(components)} targets")
+            queries = self.relationship_merge_queries(pairs[0]["target"])
+            for idx in range(0, len(pairs), self.MERGE_BATCH_SIZE):
+                batch = pairs[idx:idx + self.MERGE_BATCH_SIZE]
+                with db.transaction:
+                    for query in queries:
+                        db.cypher_query(query, {"pairs": batch})
+                    db.cypher_query(self.QUERY_SET_MERGED_TO_URI, {"pairs": batch})
+                cnt += len(batch)
+                logger.info(f"Merged merge_same_as_high_connections {cnt} records")
+        if uris is None and self.full_counts is True:
+            log_count_relationships("After merge_same_as_high_connections")
+        return target_uris
+
+    def relationship_merge_queries(self, example_uri):
+        '''
+            One query per relationship defined on the node's class (excluding sameAs*). Each query copies
+            relationships from every source in $pairs to its target, same semantics as Resource.merge_node_connections
+        '''
+        example_node = Resource.nodes.get(uri=example_uri)
+        queries = []
+        for rel_key, rel in example_node.__all_relationships__:
+            if rel_key.startswith("sameAs"):
+                continue
+            definition = example_node.__dict__[rel_key].definition
+            rel_type = definition["relation_type"]
+            other_label = definition["node_class"].__label__
+            if isinstance(rel, RelationshipTo):
+                old_pattern = f"(source)-[old:`{rel_type}`]->(other:`{other_label}`)"
+                new_pattern = f"(target)-[new:`{rel_type}`]->(other)"
+            elif isinstance(rel, RelationshipFrom):
+                old_pattern = f"(source)<-[old:`{rel_type}`]-(other:`{other_label}`)"
+                new_pattern = f"(target)<-[new:`{rel_type}`]-(other)"
+            else:
+                old_pattern = f"(source)-[old:`{rel_type}`]-(other:`{other_label}`)"
+                new_pattern = f"(target)-[new:`{rel_type}`]-(other)"
+            if hasattr(definition["model"], "documentExtract"):
+                document_extract_collect = ", COLLECT(old.documentExtract)[0] AS document_extract"
+                document_extract_set = ", new.documentExtract = document_extract"
+            else:
+                document_extract_collect = ""
+                document_extract_set = ""
+            query = f"""
+                UNWIND $pairs AS pair
+                MATCH (source: Resource {{uri: pair.source}})
+                MATCH {old_pattern}
+                WITH pair, source, old, other
+                ORDER BY source.internalDocId
+                WITH pair.target AS target_uri, other, SUM(COALESCE(old.weight, 1)) AS weight {document_extract_collect}
+                MATCH (target: Resource {{uri: target_uri}})
+                MERGE {new_pattern}
+                ON CREATE SET new.weight = weight {document_extract_set}
+                ON MATCH SET new.weight = COALESCE(new.weight, 1) + weight
+            """
+            queries.append(query)
+        return queries
+
+    def add_document_extract_to_relationship(self, uris=None):
         logger.info("Adding document extract to relationship")
-        query = """
-            MATCH (n:Resource)-[d:documentSource]->(a:Article)
+        if uris is None:
+            match_str = "MATCH (n:Resource)-[d:documentSource]->(a:Article)"
+        else:
+            match_str = "UNWIND $uris AS uri MATCH (n:Resource {uri: uri})-[d:documentSource]->(a:Article)"
+        query = f"""
+            {match_str}
             WHERE d.documentExtract IS NULL
             AND n.documentExtract IS NOT NULL
-            CALL {
+            CALL {{
                 WITH d, n
                 SET d.documentExtract = n.documentExtract
-            }
+            }}
             IN TRANSACTIONS OF 10000 ROWS;
             """
-        db.cypher_query(query)
+        db.cypher_query(query, {"uris": uris})
 
-    def add_weighting_to_relationship(self):
+    def add_weighting_to_relationship(self, uris=None):
         logger.info("Adding weighting to relationship")
-        query = "MATCH (n: Resource)-[rel]-(o:Resource) WHERE rel.weight is NULL RETURN rel"
+        if uris is None:
+            query = "MATCH (n: Resource)-[rel]-(o:Resource) WHERE rel.weight is NULL RETURN rel"
+        else:
+            query = "UNWIND $uris AS uri MATCH (n: Resource {uri: uri})-[rel]-(o:Resource) WHERE rel.weight is NULL RETURN DISTINCT rel"
         action = "SET rel.weight = 1"
-        apoc_query = f'CALL apoc.periodic.iterate("{query}","{action}",{{}})'
-        db.cypher_query(apoc_query)
+        apoc_query = f'CALL apoc.periodic.iterate("{query}","{action}",{{params: {{uris: $uris}}}})'
+        db.cypher_query(apoc_query, {"uris": uris})
+
+def same_as_high_components(rows):
+    '''
+        rows are (uri1, doc_id1, uri2, doc_id2, labels) for each sameAsHigh pair eligible for merging.
+
+        Returns dict of labels tuple -> list of components, each component a sorted list of (doc_id, uri)
+        so the first entry is the merge target
+    '''
+    parent = {}
+    doc_ids = {}
+    labels_for_uri = {}
+
+    def find(uri):
+        root = uri
+        while parent[root] != root:
+            root = parent[root]
+        while parent[uri] != root: # path compression
+            parent[uri], uri = root, parent[uri]
+        return root
+
+    for uri1, doc_id1, uri2, doc_id2, labels in rows:
+        for uri, doc_id in [(uri1, doc_id1), (uri2, doc_id2)]:
+            if uri not in parent:
+                parent[uri] = uri
+                doc_ids[uri] = doc_id
+                labels_for_uri[uri] = tuple(labels)
+        root1, root2 = find(uri1), find(uri2)
+        if root1 != root2:
+            parent[root2] = root1
+
+    members = defaultdict(list)
+    for uri in parent:
+        members[find(uri)].append((doc_ids[uri], uri))
+    components_by_labels = defaultdict(list)
+    for root, component in members.items():
+        components_by_labels[labels_for_uri[root]].append(sorted(component))
+    return components_by_labels
+
+def same_as_name_only_components(pairs):
+    '''
+        pairs are (uri1, uri2) for each sameAsNameOnly between unmerged nodes.
+
+        Returns dict of uri -> component id, where the component id is the lowest uri in the component
+    '''
+    parent = {}
+
+    def find(uri):
+        root = uri
+        while parent[root] != root:
+            root = parent[root]
+        while parent[uri] != root: # path compression
+            parent[uri], uri = root, parent[uri]
+        return root
+
+    for uri1, uri2 in pairs:
+        for uri in [uri1, uri2]:
+            if uri not in parent:
+                parent[uri] = uri
+        root1, root2 = find(uri1), find(uri2)
+        if root1 != root2: # keep the lowest uri as root
+            parent[max(root1, root2)] = min(root1, root2)
+    return {uri: find(uri) for uri in parent}
 
 def write_log_header(message):
     for row in ["*" * 50, message, "*" * 50]:
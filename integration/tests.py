@@ -1,18 +1,27 @@
 from django.test import TestCase
 from neomodel import db
+import csv
+import io
+import tempfile
 import time
 import os
 from datetime import datetime, timezone
-from integration.models import DataImport
+from integration.models import DataImport, DataImportFile
 from integration.management.commands.import_ttl import ( do_import_ttl,
-    load_deletion_file, load_file
+    load_deletion_file, load_file, load_ttl_files,
 )
 from topics.models import Organization, Resource
 from integration.neo4j_utils import (
     delete_all_not_needed_resources,
     apoc_del_redundant_same_as,
+    delete_and_clean_up_nodes_by_doc_ids,
 )
-from integration.rdf_post_processor import RDFPostProcessor
+from integration.rdf_post_processor import RDFPostProcessor, same_as_high_components, same_as_name_only_components
+from integration.ttl_utils import scan_ttl_file
+from integration.ttl_to_csv import parse_turtle, nodes_from_triples, export_dirs_to_csv, tokenize
+from integration.import_throttle import AdaptiveThrottle
+from integration.import_report import ImportReport
+from integration.vector_search_utils import create_embeddings
 from topics.cache_helpers import nuke_cache
 
 import logging
@@ -37,6 +46,7 @@ def count_relevant_nodes():
 def clean_db():
     db.cypher_query("MATCH (n) CALL {WITH n DETACH DELETE n} IN TRANSACTIONS OF 10000 ROWS;")
     DataImport.objects.all().delete()
+    DataImportFile.objects.all().delete()
 
 def clean_db_and_load_files(dirname,do_post_processing=False):
     clean_db()
@@ -52,6 +62,44 @@ class TurtleLoadingTestCase(TestCase):
         assert len(DataImport.objects.all()) == 2
         assert DataImport.latest_import() == 20231224180800
 
+    def test_loads_ttl_files_in_parallel_and_records_each_file(self):
+        clean_db()
+        creations, deletions = load_ttl_files("integration/test_dump/dump-1/20231216081557",RDF_SLEEP_TIME=0,max_workers=3)
+        assert creations > 0
+        assert deletions == 0
+        loaded = DataImportFile.loaded_files("20231216081557")
+        assert set(loaded.keys()) == {"full_dump_0000.ttl","full_dump_0658.ttl","full_dump_0683.ttl","industry_topics.ttl"}
+        assert sum([x.creations for x in loaded.values()]) == creations
+
+    def test_saves_import_report(self):
+        clean_db_and_load_files("integration/test_dump/dump-1")
+        report = DataImport.objects.all()[0].report
+        assert report["summary"]["files"] == 4
+        assert report["summary"]["triples"] > 0
+        assert report["summary"]["triples_per_second"] > 0
+        assert "insertions" in [x["stage"] for x in report["stages"]]
+
+    def test_finds_exports_missing_from_standby_database(self):
+        DataImportFile.objects.all().delete()
+        for filename in ["a.ttl","b.ttl"]:
+            DataImportFile.record("20240101000000", filename, creations=1, database="bufa")
+            DataImportFile.record("20240102000000", filename, creations=1, database="bufa")
+        DataImportFile.record("20240101000000", "a.ttl", creations=1, database="bufb")
+        assert DataImportFile.incomplete_imports("bufb", "bufa") == ["20240101000000","20240102000000"]
+        DataImportFile.record("20240101000000", "b.ttl", creations=1, database="bufb")
+        assert DataImportFile.incomplete_imports("bufb", "bufa") == ["20240102000000"]
+        assert DataImportFile.incomplete_imports("bufa", "bufb") == []
+        assert DataImportFile.loaded_files("20240102000000") == {} # default database is separate
+
+    def test_skips_files_already_loaded(self):
+        clean_db()
+        dirname = "integration/test_dump/dump-1/20231216081557"
+        for filename in os.listdir(dirname):
+            DataImportFile.record("20231216081557", filename, creations=1)
+        creations, _ = load_ttl_files(dirname,RDF_SLEEP_TIME=0,max_workers=2)
+        assert creations == 4 # recorded counts carried over
+        assert count_relevant_nodes() == 0 # nothing re-loaded
+
     def test_loads_deletion_and_recreation_step_by_step(self):
         clean_db_and_load_files("integration/test_dump/dump-1",do_post_processing=True)
         node_count = count_relevant_nodes()
@@ -105,6 +153,38 @@ class TurtleLoadingTestCase(TestCase):
                 assert new_vals[k] == target_node_rels[k]
         assert target_node_rels['sameAsNameOnly'] - new_vals['sameAsNameOnly'] == {"https://1145.am/db/4001762/Royal_Mail"} # not recreated in the files
 
+    def test_incremental_post_processing_merges_newly_loaded_nodes(self):
+        clean_db_and_load_files("integration/test_dump/dump-1",do_post_processing=True)
+        do_import_ttl(dirname="integration/test_dump/dump-1.5",force=True,do_archiving=False,
+                      do_post_processing=True,incremental_post_processing=True)
+        assert Organization.self_or_ultimate_target_node("https://1145.am/db/4290155/Royal_Mail").uri == "https://1145.am/db/2984033/Royal_Mail"
+        assert Organization.self_or_ultimate_target_node("https://1145.am/db/4001762/Royal_Mail").uri == "https://1145.am/db/2984033/Royal_Mail"
+        assert Organization.self_or_ultimate_target_node("https://1145.am/db/2984033/Royal_Mail").uri == "https://1145.am/db/2984033/Royal_Mail"
+        new_node = Resource.nodes.get_or_none(uri="https://1145.am/db/2984033/Royal_Mail")
+        for rel in new_node.industryClusterPrimary.all():
+            assert new_node.industryClusterPrimary.relationship(rel).weight is not None
+        stats_after_import = new_node.internalSumOfWeights
+        RDFPostProcessor().precompute_organization_stats(["https://1145.am/db/2984033/Royal_Mail"])
+        new_node.refresh()
+        assert new_node.internalSumOfWeights == stats_after_import # merge target's stats already redone by the import
+
+    def test_bulk_deletes_doc_ids_in_chunks(self):
+        clean_db_and_load_files("integration/test_dump/dump-1",do_post_processing=True)
+        doc_ids = [4001762, 4290155]
+        uris_to_delete = [x.uri for x in Resource.nodes.filter(internalDocId__in=doc_ids)]
+        assert len(list(Resource.nodes.filter(internalMergedSameAsHighToUri__in=uris_to_delete))) > 0
+        neighbours, _ = db.cypher_query("""MATCH (n: Resource)-[]-(m: Resource) WHERE n.uri IN $uris AND NOT m.uri IN $uris
+                                           RETURN COLLECT(DISTINCT m.uri)""", {"uris": uris_to_delete})
+        assert len(neighbours[0][0]) > 0
+        touched_uris = set()
+        chunk_stats = delete_and_clean_up_nodes_by_doc_ids(doc_ids, batch_size=1, touched_uris=touched_uris)
+        assert len(chunk_stats) == 2
+        assert set(neighbours[0][0]) <= touched_uris # so that incremental post-processing redoes them
+        assert len(touched_uris & set(uris_to_delete)) == 0
+        assert sum([x["nodes_deleted"] for x in chunk_stats]) == len(uris_to_delete)
+        assert len(list(Resource.nodes.filter(internalDocId__in=doc_ids))) == 0
+        assert len(list(Resource.nodes.filter(internalMergedSameAsHighToUri__in=uris_to_delete))) == 0
+
     def test_loads_deletion_with_new_edit(self):
         clean_db_and_load_files("integration/test_dump/dump-1",do_post_processing=True)
         do_import_ttl(dirname="integration/test_dump/dump-1.5",force=True,do_archiving=False,do_post_processing=True)
@@ -157,6 +237,196 @@ class TurtleLoadingTestCase(TestCase):
         assert doc_id_in_uri is False # Should be no occurrence of the deleted doc id in Royal Mail's relationships
 
 
+class TurtleScannerTestCase(TestCase):
+
+    def test_scans_subjects_doc_ids_and_types(self):
+        uris, doc_ids, type_counts = scan_ttl_file("integration/test_dump/dump-2/20231224180756/deletions/for_deletion_4001762.ttl")
+        assert doc_ids == {4001762}
+        assert "https://1145.am/db/4001762/Royal_Mail" in uris
+        assert len(uris) == sum(type_counts.values())
+        assert type_counts["Organization"] > 0
+        assert type_counts["CorporateFinanceActivity"] > 0
+
+    def test_counts_every_type_of_multi_typed_subject(self):
+        uris, _, type_counts = scan_ttl_file("dump/20231226000000/simple_topics.ttl")
+        assert "https://1145.am/db/2946644/Planning_Application_For_New_Covent_Garden_Market" in uris
+        assert type_counts["EquityActionsActivity"] == 2
+        assert type_counts["OperationsActivity"] == 4
+
+
+class TurtleToCsvTestCase(TestCase):
+
+    def test_builds_nodes_like_n10s(self):
+        filepath = "integration/test_dump/dump-1/20231216081557/full_dump_0000.ttl"
+        with open(filepath) as f:
+            nodes, relationships = nodes_from_triples(parse_turtle(f))
+        uris, _, _ = scan_ttl_file(filepath)
+        assert set(nodes.keys()) == set(uris)
+        org = nodes["https://1145.am/db/4290155/Daniel_Kretinsky"]
+        assert org["labels"] == ["Resource","Organization"]
+        assert org["props"]["internalDocId"] == [("4290155","long")]
+        assert org["props"]["name"] == [("Daniel Kretinsky","string")] # multival so stays a list
+        assert len([x for x in relationships if x[2] == "geoNamesRDF"]) == 0 # excluded predicate
+        assert len([x for x in relationships if x[2] == "sameAsHigh"]) > 0
+
+    def test_tokenizes_across_chunk_boundaries(self):
+        text = '@prefix ns1: <https://1145.am/db/> .\n<https://1145.am/db/1/A> ns1:description """one\n"two"\nthree""" ;\n    ns1:n 12 .\n'
+        expected = list(tokenize(text, chunk_lines=10000))
+        assert ("long_string", '"""one\n"two"\nthree"""') in expected
+        assert list(tokenize(io.StringIO(text), chunk_lines=1)) == expected
+
+    def test_writes_each_relationship_once(self):
+        prefix = "@prefix ns1: <https://1145.am/db/> .\n\n"
+        subject = "<https://1145.am/db/1/A> a ns1:Organization ;\n    ns1:buyer <https://1145.am/db/1/C> .\n"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            export_dir = f"{tmpdir}/20240101000000"
+            os.makedirs(export_dir)
+            for filename in ["a.ttl", "b.ttl"]: # A is in both files, and twice in a.ttl
+                with open(f"{export_dir}/{filename}", "w") as f:
+                    f.write(prefix + subject + (subject if filename == "a.ttl" else ""))
+            res = export_dirs_to_csv([export_dir], f"{tmpdir}/out", workers=1)
+            relationships = []
+            for _, csv_path in res["relationship_files"]:
+                with open(csv_path, newline="") as f:
+                    relationships.extend(csv.reader(f))
+        assert relationships == [["https://1145.am/db/1/A", "https://1145.am/db/1/C", "buyer"]] # as n10s MERGE
+        assert res["counts"]["relationships"] == 1
+        assert res["counts"]["resource_only_nodes"] == 1
+
+    def test_drops_relationships_to_deleted_nodes(self):
+        prefix = "@prefix ns1: <https://1145.am/db/> .\n\n"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            first_dir, second_dir = f"{tmpdir}/20240101000000", f"{tmpdir}/20240102000000"
+            os.makedirs(first_dir)
+            os.makedirs(f"{second_dir}/deletions")
+            files = {
+                f"{first_dir}/a.ttl": "<https://1145.am/db/1/A> a ns1:Organization ;\n    ns1:internalDocId 1 ;\n    ns1:buyer <https://1145.am/db/2/B> .\n",
+                f"{first_dir}/b.ttl": "<https://1145.am/db/2/B> a ns1:Organization ;\n    ns1:internalDocId 2 ;\n    ns1:buyer <https://1145.am/db/1/A> .\n",
+                f"{second_dir}/deletions/for_deletion_2.ttl": "<https://1145.am/db/2/B> a ns1:Organization ;\n    ns1:internalDocId 2 .\n",
+            }
+            for filepath, body in files.items():
+                with open(filepath, "w") as f:
+                    f.write(prefix + body)
+            res = export_dirs_to_csv([first_dir, second_dir], f"{tmpdir}/out", workers=1)
+            relationships = []
+            for _, csv_path in res["relationship_files"]:
+                with open(csv_path, newline="") as f:
+                    relationships.extend(csv.reader(f))
+            node_uris = []
+            for _, csv_path in res["node_files"]:
+                with open(csv_path, newline="") as f:
+                    node_uris.extend([x[0] for x in csv.reader(f)])
+        assert relationships == [] # A -> B went with B
+        assert node_uris == ["https://1145.am/db/1/A"] # B isn't recreated as a bare Resource
+        assert res["counts"]["relationships"] == 0
+        assert res["counts"]["dropped_relationships"] == 1
+
+
+class ImportReportTestCase(TestCase):
+
+    def test_nested_stages_counted_once(self):
+        report = ImportReport()
+        with report.stage("insertions"):
+            report.add_file("a.ttl", 1000, 10, 2.0) # files loaded concurrently
+            report.add_file("b.ttl", 1000, 10, 2.0)
+        with report.stage("refresh_geo_data"):
+            with report.stage("refresh_geo_data.build_industry_geo_org_index"):
+                time.sleep(0.05)
+        report.stages[0]["seconds"] = 2.0
+        summary = report.as_dict()["summary"]
+        assert summary["triples_per_second"] == 1000 # wall clock of the load, not the per-file total
+        assert [x["depth"] for x in report.stages] == [0, 1, 0]
+        outer = report.stages[2]["seconds"]
+        assert summary["total_stage_seconds"] == round(2.0 + outer, 3)
+
+
+class AdaptiveThrottleTestCase(TestCase):
+
+    def test_backs_off_when_slow_and_recovers_when_fast(self):
+        throttle = AdaptiveThrottle(min_sleep=0, max_sleep=8, target_latency=0.2, use_jmx=False)
+        assert throttle.adjust(0.5) == 1
+        assert throttle.adjust(0.5) == 2
+        for _ in range(5):
+            throttle.adjust(0.5)
+        assert throttle.sleep_time == 8 # capped
+        assert throttle.adjust(0.15) == 8 # between half target and target, hold steady
+        assert throttle.adjust(0.01) == 4
+        assert throttle.adjust(0.01) == 2
+        assert throttle.adjust(0.01) == 1
+        assert throttle.adjust(0.01) == 0
+
+    def test_backs_off_on_high_heap_usage(self):
+        throttle = AdaptiveThrottle(min_sleep=2, max_sleep=8, target_latency=0.2, use_jmx=False)
+        assert throttle.adjust(0.01) == 2 # never below min_sleep
+        assert throttle.adjust(0.01, heap_ratio=0.95) == 4
+
+
+class FakeEmbeddingsDriver(object):
+    def __init__(self, uris):
+        self.uris = sorted(uris)
+        self.reads = []
+        self.writes = []
+
+    def execute_query(self, query, **kwargs):
+        if "UNWIND" in query:
+            self.writes.append([x["uri"] for x in kwargs["nodes"]])
+            return [], None, None
+        self.reads.append(kwargs["after"])
+        page = [x for x in self.uris if x > kwargs["after"]][:kwargs["limit"]]
+        return [{"uri": x, "industry": [x]} for x in page], None, None
+
+
+class FakeEmbeddingsModel(object):
+    def __init__(self):
+        self.batch_sizes = []
+
+    def encode(self, texts, batch_size):
+        self.batch_sizes.append(batch_size)
+        return [FakeVector(len(x)) for x in texts]
+
+
+class FakeVector(object):
+    def __init__(self, val):
+        self.val = val
+
+    def tolist(self):
+        return [self.val]
+
+
+class CreateEmbeddingsTestCase(TestCase):
+
+    def test_pages_by_uri_and_writes_in_batches(self):
+        uris = [f"https://1145.am/db/{x}/Org" for x in range(10, 17)]
+        driver = FakeEmbeddingsDriver(uris)
+        model = FakeEmbeddingsModel()
+        rows = create_embeddings(driver, model, "MATCH ...", lambda x: "; ".join(x["industry"]), "industry_embedding",
+                                 database="neo4j", page_size=3, encode_batch_size=2, write_batch_size=2)
+        assert rows == 7
+        assert driver.reads == ["", uris[2], uris[5], uris[6]] # keyset paging, last read is empty
+        assert model.batch_sizes == [2, 2, 2]
+        assert driver.writes == [uris[0:2], uris[2:3], uris[3:5], uris[5:6], uris[6:7]]
+
+
+class SameAsHighComponentsTestCase(TestCase):
+
+    def test_groups_pairs_into_components_with_lowest_doc_id_first(self):
+        org = ["Resource","Organization"]
+        rows = [("b",101,"c",102,org),("a",100,"b",101,org),
+                ("e",104,"f",105,org),("f",105,"a",100,org),
+                ("h",107,"i",108,org),
+                ("x",200,"y",201,["Resource","Person"])]
+        res = same_as_high_components(rows)
+        assert sorted(res[("Resource","Organization")]) == [
+            [(100,"a"),(101,"b"),(102,"c"),(104,"e"),(105,"f")],
+            [(107,"h"),(108,"i")],
+        ]
+        assert res[("Resource","Person")] == [[(200,"x"),(201,"y")]]
+
+    def test_groups_same_as_name_only_pairs_under_lowest_uri(self):
+        res = same_as_name_only_components([("b","c"),("d","e"),("c","a"),("e","f")])
+        assert res == {"a":"a","b":"a","c":"a","d":"d","e":"d","f":"d"}
+
+
 class MergeSameAsHighTestCase(TestCase):
 
     @classmethod
@@ -0,0 +1,438 @@
+'''
+    Offline alternative to loading the export dumps through n10s for fresh installs.
+
+    The Turtle files are streamed through a tokenizer in worker processes and written out as node and relationship CSVs
+    for `neo4j-admin database import full`. The resulting graph mirrors what n10s creates with the
+    config from `do_n10s_config`:
+        - every subject and every IRI object becomes a `Resource` node keyed on `uri`
+        - rdf:types become labels, predicates and types use their local name (handleVocabUris: MAP)
+        - predicates in N10S_MULTIVAL_PROPS are always arrays, other literal properties keep the last value
+        - predicates in N10S_PREDICATE_EXCLUSION_LIST are skipped
+        - each (start, end, type) relationship is written once, since n10s MERGEs them
+
+    Subjects that are deleted by a deletion file in a later export directory are left out, along with
+    any relationships to or from them (DETACH DELETE), so the output matches loading the export
+    directories one after the other.
+'''
+
+import csv
+import io
+import os
+import re
+from collections import Counter, defaultdict, deque
+from itertools import islice
+from multiprocessing import Pool
+from integration.neo4j_utils import N10S_MULTIVAL_PROPS, N10S_PREDICATE_EXCLUSION_LIST
+from integration.ttl_utils import scan_ttl_file
+import logging
+logger = logging.getLogger(__name__)
+
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+XSD = "http://www.w3.org/2001/XMLSchema#"
+INTERNAL_DOC_ID = "https://1145.am/db/internalDocId"
+MULTIVAL_PROPS = set(N10S_MULTIVAL_PROPS)
+MULTIVAL_PREDICATES = set([f"https://1145.am/db/{x}" for x in N10S_MULTIVAL_PROPS])
+EXCLUDED_PREDICATES = set(N10S_PREDICATE_EXCLUSION_LIST)
+ARRAY_DELIMITER = "\u001f" # pass to neo4j-admin as --array-delimiter=U+001F
+
+TOKEN_REGEX = re.compile(r'''
+    (?P<ws>\s+|\#[^\n]*)
+   |(?P<long_string>"""(?:[^"\\]|\\.|"(?!""))*""")
+   |(?P<string>"(?:[^"\\\n]|\\.)*")
+   |(?P<iri><[^>]*>)
+   |(?P<datatype>\^\^)
+   |(?P<at>@[A-Za-z]+(?:-[A-Za-z0-9]+)*)
+   |(?P<number>[+-]?(?:\d*\.\d+(?:[eE][+-]?\d+)?|\d+(?:[eE][+-]?\d+)?))
+   |(?P<punct>[;,.\[\]()])
+   |(?P<name>(?:[A-Za-z][\w\-]*)?:[\w\-]*(?:\.[\w\-]+)*|[A-Za-z_][\w\-]*)
+''', re.VERBOSE)
+
+ESCAPE_REGEX = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "b": "\b", "f": "\f"}
+
+DATATYPE_TO_CSV_TYPE = {
+    f"{XSD}dateTime": "datetime",
+    f"{XSD}date": "date",
+    f"{XSD}integer": "long",
+    f"{XSD}int": "long",
+    f"{XSD}long": "long",
+    f"{XSD}decimal": "double",
+    f"{XSD}double": "double",
+    f"{XSD}float": "double",
+    f"{XSD}boolean": "boolean",
+}
+
+
+def unescape(val):
+    def replace(match):
+        esc = match.group(1)
+        if esc[0] in "uU":
+            return chr(int(esc[1:], 16))
+        return ESCAPES.get(esc, esc)
+    return ESCAPE_REGEX.sub(replace, val)
+
+
+def local_name(uri):
+    return re.split(r"[/#]", uri)[-1]
+
+
+def tokenize(f, chunk_lines=10000):
+    '''
+        Yields (kind, value) for each token in f (a file object or a string), reading chunk_lines lines at a time
+        so that a large file is never held in memory
+    '''
+    if isinstance(f, str):
+        f = io.StringIO(f)
+    buf = ""
+    pos = 0
+    eof = False
+    while True:
+        match = TOKEN_REGEX.match(buf, pos) if pos < len(buf) else None
+        # a token at the end of the buffer, or an unterminated """, may carry on in the next chunk
+        incomplete = (match is None or match.end() == len(buf)
+                      or (buf.startswith('"""', pos) and match.lastgroup != "long_string"))
+        if incomplete and not eof:
+            lines = list(islice(f, chunk_lines))
+            eof = len(lines) == 0
+            buf = buf[pos:] + "".join(lines)
+            pos = 0
+            continue
+        if pos >= len(buf):
+            return
+        if match is None:
+            raise ValueError(f"Can't tokenize Turtle at {buf[pos:pos+50]!r}")
+        pos = match.end()
+        if match.lastgroup != "ws":
+            yield match.lastgroup, match.group()
+
+
+class TokenStream(object):
+    '''
+        Lookahead over tokenize() for the parser, keeping only the next few tokens
+    '''
+
+    def __init__(self, tokens):
+        self.tokens = iter(tokens)
+        self.ahead = deque()
+
+    def peek(self, offset=0):
+        '''
+            The token offset places ahead, or (None, None) at the end of the file
+        '''
+        while len(self.ahead) <= offset:
+            token = next(self.tokens, None)
+            if token is None:
+                return None, None
+            self.ahead.append(token)
+        return self.ahead[offset]
+
+    def pop(self):
+        token = self.peek()
+        if token[0] is None:
+            raise ValueError("Unexpected end of file")
+        return self.ahead.popleft()
+
+
+def parse_turtle(f):
+    '''
+        Minimal Turtle parser covering what rdflib's serializer writes for our exports
+        (prefixes, IRIs, prefixed names, typed/language literals, numbers, booleans).
+        Blank nodes and collections aren't used in the exports and aren't supported.
+        f is a file object (read incrementally) or a string.
+
+        Yields (subject, predicate, object) where object is ("iri", uri) or ("literal", value, csv_type)
+    '''
+    tokens = TokenStream(tokenize(f))
+    prefixes = {}
+
+    def expect(value):
+        found = tokens.peek()[1]
+        if found != value:
+            raise ValueError(f"Expected {value!r} but found {found if found is not None else 'end of file'!r}")
+        tokens.pop()
+
+    def resolve(kind, value):
+        if kind == "iri":
+            return value[1:-1]
+        if kind == "name":
+            prefix, _, rest = value.partition(":")
+            if prefix not in prefixes:
+                raise ValueError(f"Unknown prefix in {value}")
+            return prefixes[prefix] + rest
+        raise ValueError(f"Expected IRI but found {value!r}")
+
+    def parse_object():
+        kind, value = tokens.pop()
+        if kind in ["iri", "name"] and value not in ["true", "false"]:
+            return ("iri", resolve(kind, value))
+        if kind == "name":
+            return ("literal", value, "boolean")
+        if kind == "number":
+            csv_type = "long" if re.fullmatch(r"[+-]?\d+", value) else "double"
+            return ("literal", value, csv_type)
+        if kind in ["string", "long_string"]:
+            quote_len = 3 if kind == "long_string" else 1
+            literal = unescape(value[quote_len:-quote_len])
+            csv_type = "string"
+            if tokens.peek()[0] == "datatype":
+                tokens.pop()
+                datatype = resolve(*tokens.pop())
+                csv_type = DATATYPE_TO_CSV_TYPE.get(datatype, "string")
+                if csv_type == "datetime" and not re.search(r"(Z|[+-]\d\d:?\d\d)$", literal):
+                    csv_type = "localdatetime"
+            elif tokens.peek()[0] == "at":
+                tokens.pop() # language tags are dropped, same as n10s default
+            return ("literal", literal, csv_type)
+        raise ValueError(f"Unsupported Turtle object {value!r}")
+
+    while tokens.peek()[0] is not None:
+        kind, value = tokens.pop()
+        if value in ["@prefix", "PREFIX"]:
+            prefix = tokens.pop()[1].rstrip(":")
+            prefixes[prefix] = tokens.pop()[1][1:-1]
+            if value == "@prefix":
+                expect(".")
+            continue
+        if value == "[" or value.startswith("_:"):
+            raise ValueError("Blank nodes are not supported")
+        subject = resolve(kind, value)
+        while True:
+            kind, value = tokens.pop()
+            predicate = RDF_TYPE if value == "a" else resolve(kind, value)
+            while True:
+                yield subject, predicate, parse_object()
+                if tokens.peek()[1] != ",":
+                    break
+                tokens.pop()
+            if tokens.peek()[1] == ";":
+                tokens.pop()
+                if tokens.peek()[1] != ".": # trailing ';' is allowed
+                    continue
+            expect(".")
+            break
+
+
+def nodes_from_triples(triples):
+    '''
+        Groups triples into nodes, returns (nodes, relationships) where nodes is dict of uri ->
+        {"labels": list, "props": dict of name -> list of (value, csv_type), "doc_ids": set}
+    '''
+    nodes = {}
+    relationships = []
+    for subject, predicate, obj in triples:
+        if predicate in EXCLUDED_PREDICATES:
+            continue
+        node = nodes.get(subject)
+        if node is None:
+            node = {"labels": ["Resource"], "props": {}, "doc_ids": set()}
+            nodes[subject] = node
+        if predicate == RDF_TYPE:
+            label = local_name(obj[1])
+            if label not in node["labels"]:
+                node["labels"].append(label)
+        elif obj[0] == "iri":
+            relationships.append((subject, obj[1], local_name(predicate)))
+        else:
+            prop = local_name(predicate)
+            if predicate in MULTIVAL_PREDICATES:
+                node["props"].setdefault(prop, []).append((obj[1], obj[2]))
+            else:
+                node["props"][prop] = [(obj[1], obj[2])]
+            if predicate == INTERNAL_DOC_ID:
+                node["doc_ids"].add(int(obj[1]))
+    return nodes, relationships
+
+
+def merge_node(existing, node):
+    ''' Same as loading the same subject again with n10s: labels added, single values replaced, arrays appended '''
+    for label in node["labels"]:
+        if label not in existing["labels"]:
+            existing["labels"].append(label)
+    for prop, vals in node["props"].items():
+        if prop in existing["props"] and prop in MULTIVAL_PROPS:
+            existing["props"][prop].extend(vals)
+        else:
+            existing["props"][prop] = vals
+    existing["doc_ids"].update(node["doc_ids"])
+    return existing
+
+
+def write_nodes_csv(nodes, csv_path, header_path):
+    columns = {}
+    for node in nodes.values():
+        for prop, vals in node["props"].items():
+            csv_types = set([x[1] for x in vals])
+            csv_type = csv_types.pop() if len(csv_types) == 1 else "string"
+            if columns.get(prop, csv_type) != csv_type:
+                csv_type = "string"
+            columns[prop] = csv_type
+    props = sorted(columns.keys())
+    header = ["uri:ID", ":LABEL"]
+    for prop in props:
+        array_str = "[]" if prop in MULTIVAL_PROPS else ""
+        header.append(f"{prop}:{columns[prop]}{array_str}")
+    with open(header_path, "w", newline="") as f:
+        csv.writer(f).writerow(header)
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        for uri, node in nodes.items():
+            row = [uri, ARRAY_DELIMITER.join(node["labels"])]
+            for prop in props:
+                vals = node["props"].get(prop, [])
+                row.append(ARRAY_DELIMITER.join([str(x[0]) for x in vals]))
+            writer.writerow(row)
+    return header_path, csv_path
+
+
+def write_relationships_csv(relationships, csv_path, header_path):
+    with open(header_path, "w", newline="") as f:
+        csv.writer(f).writerow([":START_ID", ":END_ID", ":TYPE"])
+    with open(csv_path, "w", newline="") as f:
+        csv.writer(f).writerows(relationships)
+    return header_path, csv_path
+
+
+def convert_ttl_file(args):
+    '''
+        Worker: parses one TTL file and writes its node and relationship CSVs.
+        Nodes whose uri is in shared_uris (subjects that appear in more than one file), and relationships
+        starting at them, are returned rather than written so the main process can merge them.
+    '''
+    filepath, out_dir, file_id, excluded_doc_ids, shared_uris = args
+    with open(filepath) as f:
+        nodes, relationships = nodes_from_triples(parse_turtle(f))
+    excluded_uris = set([uri for uri, node in nodes.items() if len(node["doc_ids"] & excluded_doc_ids) > 0])
+    # n10s MERGEs each (start, end, type) but neo4j-admin creates an edge per row, so each is written once
+    relationships = list(dict.fromkeys([x for x in relationships if x[0] not in excluded_uris]))
+    shared_relationships = [x for x in relationships if x[0] in shared_uris]
+    relationships = [x for x in relationships if x[0] not in shared_uris]
+    shared_nodes = {}
+    own_nodes = {}
+    for uri, node in nodes.items():
+        if uri in excluded_uris:
+            continue
+        if uri in shared_uris:
+            shared_nodes[uri] = node
+        else:
+            own_nodes[uri] = node
+    node_files = write_nodes_csv(own_nodes, f"{out_dir}/nodes_{file_id}.csv", f"{out_dir}/nodes_{file_id}_header.csv")
+    rel_files = write_relationships_csv(relationships, f"{out_dir}/relationships_{file_id}.csv",
+                                        f"{out_dir}/relationships_{file_id}_header.csv")
+    return {"filepath": filepath, "node_files": node_files, "relationship_files": rel_files,
+            "subjects": set(own_nodes.keys()), "objects": set([x[1] for x in relationships]),
+            "shared_nodes": shared_nodes, "shared_relationships": shared_relationships,
+            "nodes": len(own_nodes), "relationships": len(relationships), "excluded_uris": excluded_uris}
+
+
+def drop_relationships_to(csv_path, uris):
+    '''
+        Rewrites a relationship CSV without the rows ending at one of uris, returns how many were dropped
+    '''
+    with open(csv_path, newline="") as f:
+        rows = list(csv.reader(f))
+    kept = [x for x in rows if x[1] not in uris]
+    with open(csv_path, "w", newline="") as f:
+        csv.writer(f).writerows(kept)
+    return len(rows) - len(kept)
+
+
+def ttl_files_in_order(export_dirs):
+    '''
+        Returns list of (filepath, doc ids deleted by later export directories)
+    '''
+    deleted_in_dir = []
+    for export_dir in export_dirs:
+        doc_ids = set()
+        delete_dir = f"{export_dir}/deletions"
+        if os.path.isdir(delete_dir):
+            for filename in sorted(os.listdir(delete_dir)):
+                if filename.endswith(".ttl"):
+                    doc_ids.update(scan_ttl_file(f"{delete_dir}/{filename}")[1])
+        deleted_in_dir.append(doc_ids)
+    files = []
+    for idx, export_dir in enumerate(export_dirs):
+        deleted_later = set().union(*deleted_in_dir[idx + 1:])
+        for filename in sorted(os.listdir(export_dir)):
+            if filename.endswith(".ttl"):
+                files.append((f"{export_dir}/{filename}", deleted_later))
+    return files
+
+
+def export_dirs_to_csv(export_dirs, out_dir, workers=None):
+    '''
+        Converts all TTL files in export_dirs (in order) to CSVs in out_dir.
+
+        Returns dict with the node and relationship file groups and counts
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    files = ttl_files_in_order(export_dirs)
+    logger.info(f"Converting {len(files)} TTL files from {len(export_dirs)} export directories to {out_dir}")
+    with Pool(workers) as pool:
+        uri_counts = Counter()
+        for uris, _, _ in pool.imap(scan_ttl_file, [x[0] for x in files]):
+            uri_counts.update(set(uris))
+        shared_uris = set([uri for uri, cnt in uri_counts.items() if cnt > 1])
+        del uri_counts
+        logger.info(f"{len(shared_uris)} subjects appear in more than one file")
+        tasks = [(filepath, out_dir, f"{idx:05d}", excluded_doc_ids, shared_uris)
+                 for idx, (filepath, excluded_doc_ids) in enumerate(files)]
+        node_files = []
+        relationship_files = []
+        subjects = set()
+        objects_by_file = []
+        excluded_uris = set()
+        shared_nodes = {}
+        shared_relationships = {} # used as an ordered set
+        counts = defaultdict(int)
+        for res in pool.imap(convert_ttl_file, tasks): # in file order so later files win, as with n10s
+            node_files.append(res["node_files"])
+            relationship_files.append(res["relationship_files"])
+            subjects.update(res["subjects"])
+            objects_by_file.append(res["objects"])
+            excluded_uris.update(res["excluded_uris"])
+            for uri, node in res["shared_nodes"].items():
+                if uri in shared_nodes:
+                    merge_node(shared_nodes[uri], node)
+                else:
+                    shared_nodes[uri] = node
+            shared_relationships.update(dict.fromkeys(res["shared_relationships"]))
+            for k in ["nodes", "relationships"]:
+                counts[k] += res[k]
+            logger.info(f"Converted {res['filepath']}: {res['nodes']} nodes, {res['relationships']} relationships")
+    node_files.append(write_nodes_csv(shared_nodes, f"{out_dir}/nodes_shared.csv", f"{out_dir}/nodes_shared_header.csv"))
+    subjects.update(shared_nodes.keys())
+    counts["nodes"] += len(shared_nodes)
+    counts["excluded"] = len(excluded_uris)
+    # deleted nodes were DETACH DELETEd, so relationships from other files pointing at them go too
+    deleted_uris = excluded_uris - subjects
+    del excluded_uris
+    objects = set()
+    for rel_files, file_objects in zip(relationship_files, objects_by_file):
+        if len(file_objects & deleted_uris) > 0:
+            dropped = drop_relationships_to(rel_files[1], deleted_uris)
+            counts["relationships"] -= dropped
+            counts["dropped_relationships"] += dropped
+            file_objects -= deleted_uris
+        objects.update(file_objects)
+    shared_rels = [x for x in shared_relationships if x[1] not in deleted_uris]
+    counts["dropped_relationships"] += len(shared_relationships) - len(shared_rels)
+    del shared_relationships
+    relationship_files.append(write_relationships_csv(shared_rels, f"{out_dir}/relationships_shared.csv",
+                                                      f"{out_dir}/relationships_shared_header.csv"))
+    counts["relationships"] += len(shared_rels)
+    objects.update([x[1] for x in shared_rels])
+    # IRI objects that are never a subject still get a bare Resource node, as n10s does
+    resource_only = {uri: {"labels": ["Resource"], "props": {}, "doc_ids": set()} for uri in objects - subjects}
+    node_files.append(write_nodes_csv(resource_only, f"{out_dir}/nodes_resources.csv", f"{out_dir}/nodes_resources_header.csv"))
+    counts["resource_only_nodes"] = len(resource_only)
+    logger.info(f"Wrote {dict(counts)} to {out_dir}")
+    return {"node_files": node_files, "relationship_files": relationship_files, "counts": dict(counts)}
+
+
+def neo4j_admin_import_command(node_files, relationship_files, database="neo4j"):
+    args = ["neo4j-admin", "database", "import", "full", database,
+            "--overwrite-destination", "--array-delimiter=U+001F", "--multiline-fields=true",
+            "--skip-duplicate-nodes=true"] # in case a subject in several files wasn't picked up as shared
+    args.extend([f"--nodes={','.join(x)}" for x in node_files])
+    args.extend([f"--relationships={','.join(x)}" for x in relationship_files])
+    return " ".join(args)
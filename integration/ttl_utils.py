@@ -0,0 +1,61 @@
+'''
+    Lightweight line-based scanning of the Turtle files produced by the export job.
+
+    These files are written by rdflib's Turtle serializer so each subject starts at the
+    beginning of a line (`<uri> a type1, type2 ;`) and each predicate is on its own indented line.
+    That lets us pull out the bits we need for accounting without a full RDF parse.
+'''
+
+import re
+from collections import Counter
+import logging
+logger = logging.getLogger(__name__)
+
+SUBJECT_REGEX = re.compile(r"^<(https://\S.+)> a\b(.*)$")
+INTERNAL_DOC_ID_REGEX = re.compile(r"^\s+ns1:internalDocId\s(\d+)")
+TYPE_REGEX = re.compile(r"[\w\-]*:(\w+)|<[^>]*[/#](\w+)>")
+LONG_STRING_DELIMITER = '"""'
+
+
+def types_from_fragment(fragment):
+    return [x[0] or x[1] for x in TYPE_REGEX.findall(fragment)]
+
+
+def scan_ttl_file(filepath):
+    '''
+        Single streaming pass over a TTL file.
+
+        Returns:
+            uris: list of subject URIs that have an rdf:type (in file order)
+            doc_ids: set of internalDocIds found
+            type_counts: Counter of type local name (e.g. Organization) -> number of subjects
+    '''
+    uris = []
+    doc_ids = set()
+    type_counts = Counter()
+    in_long_string = False
+    in_type_list = False
+    with open(filepath) as f:
+        for row in f:
+            if in_long_string or LONG_STRING_DELIMITER in row:
+                if row.count(LONG_STRING_DELIMITER) % 2 == 1:
+                    in_long_string = not in_long_string
+                continue
+            if in_type_list:
+                # continuation of `a type1,\n    type2 ;`
+                type_counts.update(types_from_fragment(row))
+                in_type_list = row.rstrip().endswith(",")
+                continue
+            if row.startswith("<"):
+                match = SUBJECT_REGEX.match(row)
+                if match is not None:
+                    uri, rest = match.groups()
+                    uris.append(uri)
+                    type_counts.update(types_from_fragment(rest))
+                    in_type_list = rest.rstrip().endswith(",")
+                continue
+            match = INTERNAL_DOC_ID_REGEX.match(row)
+            if match is not None:
+                doc_ids.add(int(match.group(1)))
+    logger.debug(f"Scanned {filepath}: {len(uris)} subjects, {len(doc_ids)} doc ids")
+    return uris, doc_ids, type_counts
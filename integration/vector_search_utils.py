@@ -1,23 +1,31 @@
 # Based on https://neo4j.com/docs/genai/tutorials/embeddings-vector-indexes/embeddings/sentence-transformers/
 
 import neo4j
-from neomodel import db
 from sentence_transformers import SentenceTransformer
 from syracuse.settings import (NEOMODEL_NEO4J_SCHEME,
     NEOMODEL_NEO4J_USERNAME,NEOMODEL_NEO4J_PASSWORD,
     NEOMODEL_NEO4J_HOSTNAME,NEOMODEL_NEO4J_PORT,
-    EMBEDDINGS_MODEL, CREATE_NEW_EMBEDDINGS)
+    EMBEDDINGS_MODEL, CREATE_NEW_EMBEDDINGS, NEO4J_DATABASE,
+    EMBEDDINGS_PAGE_SIZE, EMBEDDINGS_ENCODE_BATCH_SIZE,
+    EMBEDDINGS_WRITE_BATCH_SIZE, EMBEDDINGS_PROCESSES)
+from topics.query_templates import run_query
+import time
 import logging
 logger = logging.getLogger(__name__)
 
 NEW_ORGANIZATION_INDUSTRY_QUERY = '''MATCH (n:Resource&Organization) 
 WHERE n.industry_embedding IS NULL 
-AND n.industry IS NOT NULL RETURN n.uri as uri, n.industry as industry'''
+AND n.industry IS NOT NULL
+AND n.uri > $after
+RETURN n.uri as uri, n.industry as industry
+ORDER BY n.uri LIMIT $limit'''
 
 NEW_INDUSTRY_REPRESENTATIVE_DOCS_QUERY = '''MATCH (n:Resource&IndustryCluster)
 WHERE n.representative_doc_embedding IS NULL
 AND n.representativeDoc IS NOT NULL
-return n.uri as uri, n.representativeDoc as representative_doc'''
+AND n.uri > $after
+RETURN n.uri as uri, n.representativeDoc as representative_doc
+ORDER BY n.uri LIMIT $limit'''
 
 ORGANIZATION_SEARCH_BY_INDUSTRY_QUERY = ''' CALL db.index.vector.queryNodes('organization_industries_vec', 5, $queryEmbedding)
     YIELD node, score
@@ -31,72 +39,100 @@ INDUSTRY_SEARCH_QUERY = ''' CALL db.index.vector.queryNodes('industry_cluster_re
 
 URI=f"{NEOMODEL_NEO4J_SCHEME}://{NEOMODEL_NEO4J_HOSTNAME}:{NEOMODEL_NEO4J_PORT}"
 AUTH=(NEOMODEL_NEO4J_USERNAME,NEOMODEL_NEO4J_PASSWORD)
-DB_NAME="neo4j"
+DB_NAME=NEO4J_DATABASE or "neo4j"
 
 MODEL=SentenceTransformer(EMBEDDINGS_MODEL)
 
-def create_new_embeddings(uri=URI, auth=AUTH, model=MODEL, really_run_me=CREATE_NEW_EMBEDDINGS):
+def create_new_embeddings(uri=URI, auth=AUTH, model=MODEL, really_run_me=CREATE_NEW_EMBEDDINGS, database=DB_NAME,
+                          processes=EMBEDDINGS_PROCESSES):
     if really_run_me is not True:
         logger.info("Not running embeddings - check env var CREATE_NEW_EMBEDDINGS")
         return None
     driver = setup(uri, auth)
-    create_industry_cluster_representative_doc_embeddings(driver,model)
-    create_organization_industry_embeddings(driver,model)
+    pool = start_encoding_pool(model, processes)
+    try:
+        create_industry_cluster_representative_doc_embeddings(driver,model,database,pool)
+        create_organization_industry_embeddings(driver,model,database,pool)
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
 
 def setup(uri=URI, auth=AUTH):
     driver = neo4j.GraphDatabase.driver(uri, auth=auth)
     driver.verify_connectivity()
     return driver
 
-def create_organization_industry_embeddings(driver, model):
-    batch_size = 100
-    batch_n = 1
-    batch_for_update = []
-    logger.info("Starting update_organization_industry_embeddings")
-    with driver.session(database=DB_NAME) as session:
-        result = session.run(NEW_ORGANIZATION_INDUSTRY_QUERY)
-        for record in result:
-            embedding = model.encode("; ".join(record.get('industry')))
-            batch_for_update.append(
-                {'uri':record.get('uri'), 'industry_embedding': embedding}
-            )
-            # Import when a batch of movies has embeddings ready; flush buffer
-            if len(batch_for_update) == batch_size:
-                batch_n = import_batch(driver, batch_for_update, batch_n, 'industry_embedding')
-                batch_for_update = []
-        import_batch(driver, batch_for_update, batch_n, 'industry_embedding')
-
-def create_industry_cluster_representative_doc_embeddings(driver, model):
-    batch_size = 10
+def start_encoding_pool(model, processes=EMBEDDINGS_PROCESSES):
+    '''
+        On a GPU a single process with large batches is fastest, on CPU-only hosts spread batches over processes
+    '''
+    if processes is None or processes <= 1 or model.device.type != "cpu":
+        return None
+    logger.info(f"Starting {processes} encoding processes")
+    return model.start_multi_process_pool(target_devices=["cpu"] * processes)
+
+def industry_text(record):
+    return "; ".join(record.get('industry'))
+
+def representative_doc_text(record):
+    return "; ".join(sorted(record.get('representative_doc'),key=len))
+
+def create_organization_industry_embeddings(driver, model, database=DB_NAME, pool=None):
+    logger.info("Starting create_organization_industry_embeddings")
+    return create_embeddings(driver, model, NEW_ORGANIZATION_INDUSTRY_QUERY, industry_text,
+                             'industry_embedding', database, pool)
+
+def create_industry_cluster_representative_doc_embeddings(driver, model, database=DB_NAME, pool=None):
+    logger.info("Starting create_industry_cluster_representative_doc_embeddings")
+    return create_embeddings(driver, model, NEW_INDUSTRY_REPRESENTATIVE_DOCS_QUERY, representative_doc_text,
+                             'representative_doc_embedding', database, pool)
+
+def create_embeddings(driver, model, query, text_fn, field, database=DB_NAME, pool=None,
+                      page_size=EMBEDDINGS_PAGE_SIZE, encode_batch_size=EMBEDDINGS_ENCODE_BATCH_SIZE,
+                      write_batch_size=EMBEDDINGS_WRITE_BATCH_SIZE):
+    '''
+        Reads a page of nodes missing `field` (keyset paging on uri so no session is held open while encoding),
+        encodes the page in batches and writes the vectors back in UNWIND chunks. Returns number of rows embedded.
+    '''
+    after = ""
     batch_n = 1
-    batch_for_update = []
-    logger.info("Starting update_organization_industry_embeddings")
-    with driver.session(database=DB_NAME) as session:
-        result = session.run(NEW_INDUSTRY_REPRESENTATIVE_DOCS_QUERY)
-        for record in result:
-            joined = "; ".join(sorted(record.get('representative_doc'),key=len))
-            embedding = model.encode(joined)
-            batch_for_update.append(
-                {'uri':record.get('uri'), 'representative_doc_embedding': embedding}
-            )
-            # Import when a batch of movies has embeddings ready; flush buffer
-            if len(batch_for_update) == batch_size:
-                batch_n = import_batch(driver, batch_for_update, batch_n, 'representative_doc_embedding')
-                batch_for_update = []
-        import_batch(driver, batch_for_update, batch_n, 'representative_doc_embedding')
-
-
-def import_batch(driver, nodes_with_embeddings, batch_n, field):
+    rows = 0
+    t1 = time.perf_counter()
+    while True:
+        records, _, _ = driver.execute_query(query, after=after, limit=page_size, database_=database)
+        if len(records) == 0:
+            break
+        after = records[-1].get('uri')
+        embeddings = encode_texts(model, [text_fn(x) for x in records], encode_batch_size, pool)
+        nodes_with_embeddings = [{'uri': record.get('uri'), field: embedding.tolist()}
+                                    for record, embedding in zip(records, embeddings)]
+        for idx in range(0, len(nodes_with_embeddings), write_batch_size):
+            batch_n = import_batch(driver, nodes_with_embeddings[idx:idx+write_batch_size], batch_n, field, database)
+        rows += len(records)
+        seconds = time.perf_counter() - t1
+        logger.info(f"{field}: {rows} rows in {seconds:.1f} seconds ({rows / seconds:.1f} rows/sec)")
+    logger.info(f"Finished {field}: {rows} rows in {time.perf_counter() - t1:.1f} seconds")
+    return rows
+
+def encode_texts(model, texts, batch_size=EMBEDDINGS_ENCODE_BATCH_SIZE, pool=None):
+    if pool is not None:
+        return model.encode_multi_process(texts, pool, batch_size=batch_size)
+    return model.encode(texts, batch_size=batch_size)
+
+def import_batch(driver, nodes_with_embeddings, batch_n, field, database=DB_NAME):
+    if len(nodes_with_embeddings) == 0:
+        return batch_n
     driver.execute_query(f'''
     UNWIND $nodes AS node
     MATCH (n:Resource {{uri: node.uri}})
     CALL db.create.setNodeVectorProperty(n, '{field}', node.{field})
-    ''', nodes=nodes_with_embeddings)
+    ''', nodes=nodes_with_embeddings, database_=database)
     logger.info(f'Processed batch {batch_n}.')
     return batch_n + 1
 
-def do_vector_search(text, base_query, model=MODEL):
+def do_vector_search(text, base_query, model=MODEL, params=None, name="vector_search"):
     query_embedding = model.encode(text)
     assert "$query_embedding" in base_query, f"Expected {base_query} to include $query_embedding"
-    res, _ = db.cypher_query(base_query, params={'query_embedding':query_embedding}, resolve_objects=True) 
+    params = {**(params or {}), 'query_embedding': query_embedding}
+    res, _ = run_query(name, base_query, params, resolve_objects=True)
     return res
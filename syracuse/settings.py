@@ -70,6 +70,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "allauth.account.middleware.AccountMiddleware",
+    "topics.models.identity_map.IdentityMapMiddleware",
 ]
 
 ROOT_URLCONF = 'syracuse.urls'
@@ -189,7 +190,11 @@ NEOMODEL_NEO4J_USERNAME = os.environ.get('NEO4J_USERNAME','neo4j')
 NEOMODEL_NEO4J_PASSWORD = os.environ.get('NEO4J_PASSWORD','itsasecret')
 NEOMODEL_NEO4J_HOSTNAME = os.environ.get('NEO4J_HOSTNAME','localhost')
 NEOMODEL_NEO4J_PORT = os.environ.get('NEO4J_PORT',7687)
+NEO4J_DATABASE = os.environ.get('NEO4J_DATABASE','') # Database (or alias) the site queries, blank for the server default
+NEO4J_BUFFER_DATABASES = [x for x in os.environ.get('NEO4J_BUFFER_DATABASES','').split(",") if x != ""] # Two databases that NEO4J_DATABASE alias switches between, for dual-buffer imports (Neo4j Enterprise)
 NEOMODEL_NEO4J_BOLT_URL = f'{NEOMODEL_NEO4J_SCHEME}://{NEOMODEL_NEO4J_USERNAME}:{NEOMODEL_NEO4J_PASSWORD}@{NEOMODEL_NEO4J_HOSTNAME}:{NEOMODEL_NEO4J_PORT}'
+if NEO4J_DATABASE != '':
+    NEOMODEL_NEO4J_BOLT_URL = f'{NEOMODEL_NEO4J_BOLT_URL}/{NEO4J_DATABASE}'
 
 if neomodel.db.url is None:
     neomodel.db.set_connection(NEOMODEL_NEO4J_BOLT_URL)
@@ -204,22 +209,47 @@ BREVO_API_KEY = os.environ['BREVO_API_KEY']
 TRACKED_ORG_ACTIVITIES_DAYS = int(os.environ.get('TRACKED_ORG_ACTIVITIES_DAYS',"7"))
 
 
+SLOW_QUERY_MS=int(os.environ.get("SLOW_QUERY_MS","2000")) # Log a warning for Cypher queries slower than this, see topics.query_templates
+QUERY_LATENCY_LOG_SECONDS=int(os.environ.get("QUERY_LATENCY_LOG_SECONDS","900")) # How often each process logs its per-template query latencies, 0 to never log them
+NAME_INDEX_CHECK_SECONDS=int(os.environ.get("NAME_INDEX_CHECK_SECONDS","30")) # How often each process checks for a rebuilt topics.name_index
+RANDOM_ACTIVE_NODES_POOL_SIZE=int(os.environ.get("RANDOM_ACTIVE_NODES_POOL_SIZE","1000")) # Nodes kept per window, see topics.random_active_nodes
+RANDOM_ACTIVE_NODES_WINDOW_DAYS=[int(x) for x in os.environ.get("RANDOM_ACTIVE_NODES_WINDOW_DAYS","365,730").split(",") if x.strip()] # Windows back from the import date, Index page uses 730
+INDUSTRY_GEO_INDEX_CHECK_SECONDS=int(os.environ.get("INDUSTRY_GEO_INDEX_CHECK_SECONDS","30")) # Same for topics.industry_geo.org_index
+INDUSTRY_GEO_USE_INDEX=os.environ.get("INDUSTRY_GEO_USE_INDEX","True").lower() == 'true' # If false, refresh_geo_data warms up the per-key industry geo cache instead of building the index
+
 CACHES = {
     "default": {
         "BACKEND": "django.core.cache.backends.redis.RedisCache",
         "LOCATION": "redis://127.0.0.1:6379",
         "TIMEOUT": None, 
+        "KEY_FUNCTION": "topics.cache_generations.make_key",
     }
 }
+CACHE_GENERATION_CHECK_SECONDS=int(os.environ.get("CACHE_GENERATION_CHECK_SECONDS","5")) # How often each process checks for a newly published cache generation
+CACHE_OLD_GENERATION_TTL=int(os.environ.get("CACHE_OLD_GENERATION_TTL","3600")) # Seconds before keys from a replaced generation expire
+LOCAL_CACHE_MAX_ENTRIES=int(os.environ.get("LOCAL_CACHE_MAX_ENTRIES","10000")) # Per process, see topics.local_cache
+LOCAL_CACHE_TTL_SECONDS=int(os.environ.get("LOCAL_CACHE_TTL_SECONDS","3600"))
+SINGLE_FLIGHT_LOCK_SECONDS=int(os.environ.get("SINGLE_FLIGHT_LOCK_SECONDS","300")) # Longest one worker can hold the lock while computing, see topics.single_flight
+SINGLE_FLIGHT_WAIT_SECONDS=int(os.environ.get("SINGLE_FLIGHT_WAIT_SECONDS","10")) # How long other workers wait for it before computing themselves, keep well under the gunicorn worker timeout (30s by default) so they still have time to compute
+CACHE_STALE_AFTER_SECONDS=int(os.environ.get("CACHE_STALE_AFTER_SECONDS","0")) # 0 turns off stale-while-revalidate
 
 ACCOUNT_FORMS = {'login': 'auth_extensions.allauth.AnonAwareLoginForm'}
 
 # TTL integration
-RDF_SLEEP_TIME=int(os.environ.get("RDF_SLEEP_TIME","0"))
+RDF_SLEEP_TIME=int(os.environ.get("RDF_SLEEP_TIME","0")) # Minimum pause between TTL files, see integration.import_throttle
+RDF_MAX_SLEEP_TIME=int(os.environ.get("RDF_MAX_SLEEP_TIME","60"))
+RDF_TARGET_LATENCY_MS=int(os.environ.get("RDF_TARGET_LATENCY_MS","250")) # Slow down importing if a probe query takes longer than this
+RDF_THROTTLE_USE_JMX=os.environ.get("RDF_THROTTLE_USE_JMX","False").lower() == 'true' # Also slow down if heap usage is high
 RDF_DUMP_DIR=os.environ.get("RDF_DUMP_DIR","tmp/dump")
 RDF_ARCHIVE_DIR=os.environ.get("RDF_ARCHIVE_DIR","tmp/archive")
+RDF_IMPORT_WORKERS=int(os.environ.get("RDF_IMPORT_WORKERS","1")) # Number of TTL files to load concurrently
+RDF_IMPORT_FULL_COUNTS=os.environ.get("RDF_IMPORT_FULL_COUNTS","False").lower() == 'true' # Full-graph node/relationship counts between import stages
 
 USE_GOOGLE_ANALYTICS=os.environ.get("USE_GOOGLE_ANALYTICS","False").lower() == 'true'
 
 EMBEDDINGS_MODEL=os.environ.get("EMBEDDINGS_MODEL")
-CREATE_NEW_EMBEDDINGS=os.environ.get("CREATE_NEW_EMBEDDINGS","False").lower() == 'true' # If false then won't create embeddings for new nodes
\ No newline at end of file
+CREATE_NEW_EMBEDDINGS=os.environ.get("CREATE_NEW_EMBEDDINGS","False").lower() == 'true' # If false then won't create embeddings for new nodes
+EMBEDDINGS_PAGE_SIZE=int(os.environ.get("EMBEDDINGS_PAGE_SIZE","5000")) # Nodes read per query when creating embeddings, see integration.vector_search_utils
+EMBEDDINGS_ENCODE_BATCH_SIZE=int(os.environ.get("EMBEDDINGS_ENCODE_BATCH_SIZE","64")) # Texts per model.encode batch
+EMBEDDINGS_WRITE_BATCH_SIZE=int(os.environ.get("EMBEDDINGS_WRITE_BATCH_SIZE","1000")) # Vectors per UNWIND write
+EMBEDDINGS_PROCESSES=int(os.environ.get("EMBEDDINGS_PROCESSES","1")) # Encoding processes on CPU-only hosts
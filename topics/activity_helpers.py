@@ -1,11 +1,17 @@
-from django.core.cache import cache
-from neomodel import db
 import logging
 from .models import IndustryCluster, Article, ActivityMixin, Resource, Organization
 from .industry_geo.region_hierarchies import COUNTRY_CODE_TO_NAME
 from .neo4j_utils import date_to_cypher_friendly, neo4j_date_converter
 from .util import cache_friendly, blank_or_none, elements_from_uri
 from .industry_geo import geo_to_country_admin1
+from .query_templates import run_query, template_name, NO_LIMIT
+from .single_flight import get_or_compute
+
+# Relationships read when turning activities into API results (all_actors differs by activity class)
+ACTIVITY_PREFETCH_RELATIONSHIPS = ["documentSource", "whereHighGeoNamesLocation",
+    "vendor", "investor", "buyer", "protagonist", "participant", "target",
+    "awarded", "partnership", "providedBy", "location", "locationAdded", "locationRemoved",
+    "productOrganization", "roleActivity", "withProduct", "withRole"]
 
 ORG_ACTIVITY_LIST="|".join([f"{x}Activity" for x in ["CorporateFinance","Product","Location","Partnership"]])
 
@@ -34,7 +40,7 @@ def get_activities_by_org_uris_and_date_range(uri_list,min_date,max_date,combine
     if combine_same_as_name_only is True:
         orgs = Organization.nodes.filter(uri__in=uri_list)
         for org in orgs:
-            new_uris = [x.uri for x in org.sameAsNameOnly]
+            new_uris = [x.uri for x in org.same_as_name_only_members()]
             uris_to_check.update(new_uris)
     activity_article_uris = activities_by_org_uris(uris_to_check,min_date,max_date,limit)
     return activity_articles_to_api_results(activity_article_uris)
@@ -62,125 +68,120 @@ def get_activities_by_industry_geo_and_date_range(industry_or_industry_id, geo_c
 
 def activities_by_org_uris(org_uris, min_date, max_date, limit=None):
     cache_key = cache_friendly(f"activities_{org_uris}_{min_date}_{max_date}_{limit}")
-    res = cache.get(cache_key)
-    if res is not None:
-        return res
-    where_etc = f"""
-        WHERE art.datePublished >= datetime('{date_to_cypher_friendly(min_date)}')
-        AND art.datePublished <= datetime('{date_to_cypher_friendly(max_date)}')   
-        AND o.uri in {list(org_uris)}
+    where_etc = """
+        WHERE art.datePublished >= datetime($min_date)
+        AND art.datePublished <= datetime($max_date)   
+        AND o.uri in $org_uris
         RETURN DISTINCT act.uri, art.uri, art.datePublished
         ORDER BY art.datePublished DESC
     """
-    limit_str = f" LIMIT {limit} " if limit else ""
     query = f"""
         MATCH (art: Article)<-[:documentSource]-(act:CorporateFinanceActivity|LocationActivity|PartnershipActivity)--(o: Resource&Organization)
         {where_etc}
-        {limit_str}
+        LIMIT $limit
         UNION
         MATCH (art: Article)<-[:documentSource]-(act:RoleActivity)-[:withRole]->(Role)<-[:hasRole]-(o: Resource&Organization)
         {where_etc}
-        {limit_str}
+        LIMIT $limit
     """
-    return query_and_cache(query, cache_key, False)
+    params = date_range_params(min_date, max_date, limit)
+    params["org_uris"] = list(org_uris)
+    return query_and_cache("activities_by_org_uris", query, params, cache_key, False)
 
 def activities_by_source(source_name, min_date, max_date, counts_only=False,limit=None):
     cache_key = cache_friendly(f"activities_{source_name}_{min_date}_{max_date}_{limit}")
-    res = cache.get(cache_key)
-    if res is not None:
-        return len(res) if counts_only is True else res
-    limit_str = f" LIMIT {limit} " if limit else ""
-    query = f"""
+    query = """
     MATCH (art: Article)<-[:documentSource]-(act:CorporateFinanceActivity|ProductActivity|LocationActivity|PartnershipActivity|RoleActivity)
-    WHERE art.datePublished >= datetime('{date_to_cypher_friendly(min_date)}')
-    AND art.datePublished <= datetime('{date_to_cypher_friendly(max_date)}') 
-    AND art.sourceOrganization = '{source_name}'
-    AND EXISTS {{
+    WHERE art.datePublished >= datetime($min_date)
+    AND art.datePublished <= datetime($max_date) 
+    AND art.sourceOrganization = $source_name
+    AND EXISTS {
         MATCH (art)<-[:documentSource]-(org: Organization)
         WHERE org.internalMergedSameAsHighToUri IS NULL
-    }}
+    }
     RETURN DISTINCT act.uri, art.uri, art.datePublished
     ORDER by art.datePublished DESC
-    {limit_str}
+    LIMIT $limit
     """
-    return query_and_cache(query, cache_key, counts_only)
+    params = date_range_params(min_date, max_date, limit)
+    params["source_name"] = source_name
+    return query_and_cache("activities_by_source", query, params, cache_key, counts_only)
 
 def activities_by_industry_region(industry,country_code,admin1_code,min_date,max_date,limit=None):
     cache_key = cache_friendly(f"activities_{industry.topicId}_{country_code}_{admin1_code}_{min_date}_{max_date}_{limit}")
-    res = cache.get(cache_key)
-    if res is not None:
-        return res
-    admin1_str = f" AND l.admin1Code = '{admin1_code}' " if admin1_code else "" 
-    limit_str = f" LIMIT {limit} " if limit else ""
+    admin1_str = " AND l.admin1Code = $admin1_code " if admin1_code else "" 
     where_etc = f"""
-        WHERE art.datePublished >= datetime('{date_to_cypher_friendly(min_date)}')
-        AND art.datePublished <= datetime('{date_to_cypher_friendly(max_date)}')   
+        WHERE art.datePublished >= datetime($min_date)
+        AND art.datePublished <= datetime($max_date)   
         AND o.internalMergedSameAsHighToUri IS NULL
-        AND l.countryCode = '{country_code}'
+        AND l.countryCode = $country_code
         {admin1_str}
         RETURN DISTINCT act.uri, art.uri, art.datePublished
         ORDER BY art.datePublished DESC
     """
     query = f"""MATCH (art: Article)<-[:documentSource]-(act:{ORG_ACTIVITY_LIST})--(o:Organization)-[:basedInHighGeoNamesLocation]->(l:GeoNamesLocation)
-    , (o)-[:industryClusterPrimary]->(ind:Resource&IndustryCluster {{uri: "{industry.uri}" }})
+    , (o)-[:industryClusterPrimary]->(ind:Resource&IndustryCluster {{uri: $industry_uri }})
     {where_etc}
-    {limit_str}
+    LIMIT $limit
     UNION
     MATCH (art: Article)<-[:documentSource]-(act:RoleActivity)-[:withRole]->(Role)<-[:hasRole]-(o:Organization)-[:basedInHighGeoNamesLocation]->(l:GeoNamesLocation)
-    , (o)-[:industryClusterPrimary]->(ind:Resource&IndustryCluster {{uri: "{industry.uri}" }})
+    , (o)-[:industryClusterPrimary]->(ind:Resource&IndustryCluster {{uri: $industry_uri }})
     {where_etc}
-    {limit_str}
+    LIMIT $limit
     """
-    return query_and_cache(query, cache_key, counts_only=False)
+    params = date_range_params(min_date, max_date, limit)
+    params.update({"industry_uri": industry.uri, "country_code": country_code, "admin1_code": admin1_code})
+    return query_and_cache(template_name("activities_by_industry_region", admin1=bool(admin1_code)),
+                           query, params, cache_key, counts_only=False)
 
 
 def activities_by_region(country_code, min_date, max_date, admin1_code=None, counts_only=False,limit=None):
     cache_key=cache_friendly(f"activities_{country_code}_{admin1_code}_{min_date}_{max_date}_{limit}")
-    res = cache.get(cache_key)
-    if res is not None:
-        return len(res) if counts_only is True else res
-    admin1_str = f" AND l.admin1Code = '{admin1_code}' " if admin1_code else ""
+    admin1_str = " AND l.admin1Code = $admin1_code " if admin1_code else ""
 
     query = f"""MATCH (art: Article)<-[:documentSource]-(act:CorporateFinanceActivity|ProductActivity|LocationActivity|PartnershipActivity|RoleActivity)-[:whereHighGeoNamesLocation]->(l:GeoNamesLocation)
-                WHERE art.datePublished >= datetime('{date_to_cypher_friendly(min_date)}')
-                AND art.datePublished <= datetime('{date_to_cypher_friendly(max_date)}') 
-                AND l.countryCode = '{country_code}'
+                WHERE art.datePublished >= datetime($min_date)
+                AND art.datePublished <= datetime($max_date) 
+                AND l.countryCode = $country_code
                 {admin1_str}
                 RETURN DISTINCT  act.uri, art.uri, art.datePublished
                 UNION
                 MATCH
                 (act:CorporateFinanceActivity|ProductActivity|LocationActivity|PartnershipActivity|RoleActivity)-[:documentSource]->(art: Article)<-[:documentSource]-(:Organization|Site)-[:basedInHighGeoNamesLocation]->(l:GeoNamesLocation)
-                WHERE art.datePublished >= datetime('{date_to_cypher_friendly(min_date)}')
-                AND art.datePublished <= datetime('{date_to_cypher_friendly(max_date)}') 
-                AND l.countryCode = '{country_code}'
+                WHERE art.datePublished >= datetime($min_date)
+                AND art.datePublished <= datetime($max_date) 
+                AND l.countryCode = $country_code
                 {admin1_str}
                 RETURN DISTINCT act.uri, art.uri, art.datePublished"""
-    return query_and_cache(query, cache_key, counts_only)
+    params = date_range_params(min_date, max_date)
+    params.update({"country_code": country_code, "admin1_code": admin1_code})
+    return query_and_cache(template_name("activities_by_region", admin1=bool(admin1_code)),
+                           query, params, cache_key, counts_only)
 
 
 def activities_by_industry(industry, min_date, max_date, counts_only=False, limit=None):
     cache_key = cache_friendly(f"activities_{industry.topicId}_{min_date}_{max_date}_{limit}")
-    res = cache.get(cache_key)
-    if res is not None:
-        return len(res) if counts_only is True else res
-    limit_str = f" LIMIT {limit} " if limit else ""
-
-    query = f"""
-    MATCH (art:Article)<-[:documentSource]-(org: Organization)-[:industryClusterPrimary]->(i:Resource&IndustryCluster {{uri: "{industry.uri}" }})
+    query = """
+    MATCH (art:Article)<-[:documentSource]-(org: Organization)-[:industryClusterPrimary]->(i:Resource&IndustryCluster {uri: $industry_uri })
          , (art)<-[:documentSource]-(act:CorporateFinanceActivity|ProductActivity|LocationActivity|PartnershipActivity|RoleActivity)
-    WHERE art.datePublished >= datetime('{date_to_cypher_friendly(min_date)}')
-    AND art.datePublished <= datetime('{date_to_cypher_friendly(max_date)}') 
+    WHERE art.datePublished >= datetime($min_date)
+    AND art.datePublished <= datetime($max_date) 
     AND org.internalMergedSameAsHighToUri IS NULL
     RETURN DISTINCT act.uri, art.uri, art.datePublished
     ORDER BY art.datePublished DESC
-    {limit_str}
+    LIMIT $limit
     """
-    return query_and_cache(query, cache_key, counts_only)
+    params = date_range_params(min_date, max_date, limit)
+    params["industry_uri"] = industry.uri
+    return query_and_cache("activities_by_industry", query, params, cache_key, counts_only)
+
+def date_range_params(min_date, max_date, limit=None):
+    return {"min_date": date_to_cypher_friendly(min_date),
+            "max_date": date_to_cypher_friendly(max_date),
+            "limit": limit if limit else NO_LIMIT}
 
-def query_and_cache(query, cache_key, counts_only):
-    vals, _ = db.cypher_query(query)
-    vals = neo4j_date_converter(vals)
-    cache.set(cache_key, vals)
+def query_and_cache(name, query, params, cache_key, counts_only):
+    vals = get_or_compute(cache_key, lambda: neo4j_date_converter(run_query(name, query, params)[0]))
     if counts_only is True:
         return len(vals)
     else:
@@ -192,9 +193,12 @@ def activity_articles_to_api_results(activity_article_uris, limit=None):
     by_date = sorted(activity_article_uris,key=lambda x: x[2], reverse=True)
     if limit is not None:
         by_date = by_date[:limit]
+    uris = [x[0] for x in activity_article_uris] + [x[1] for x in activity_article_uris]
+    nodes = Resource.nodes_by_uri(uris)
+    Resource.prefetch([nodes.get(x[0]) for x in activity_article_uris], ACTIVITY_PREFETCH_RELATIONSHIPS)
     for activity_uri, article_uri, date_published in activity_article_uris:
-        activity = Resource.nodes.get_or_none(uri=activity_uri)
-        article = Resource.nodes.get_or_none(uri=article_uri)
+        activity = nodes.get(activity_uri)
+        article = nodes.get(article_uri)
         assert isinstance(article, Article), f"{article} should be an Article"
         assert isinstance(activity, ActivityMixin), f"{activity} should be an Activity"
         api_row = {}
@@ -0,0 +1,167 @@
+'''
+    Per-resource summary of the articles a node came from, so that source and date filtering
+    doesn't need to hydrate (or pickle) Article lists.
+
+    Each resource is stored in one Redis hash as "source_mask:min_date:max_date" where source_mask has a bit
+    for each sourceOrganization (bit numbers kept in another hash) and the dates are date ordinals.
+    Resources with no articles are stored as "0:0:0". The hash is kept per cache generation, the source bit
+    numbers aren't because they never change once given out. For the same reason each process remembers the
+    bit numbers it has seen, and which names had none in the active generation, so that building a mask for
+    a request's source names doesn't go to Redis. Both are forgotten when the active generation changes, like
+    the other per-process indexes, because a flush of Redis (nuke_cache) gives the bit numbers out again.
+'''
+
+from datetime import date
+import threading
+from neomodel import db
+from topics.merge_targets import redis_client
+from topics.cache_generations import generation_key, active_generation
+import logging
+logger = logging.getLogger(__name__)
+
+ARTICLE_INDEX_KEY = "article_index"
+SOURCE_CODES_KEY = "article_source_codes"
+SOURCE_CODES_COUNTER_KEY = "article_source_codes_next"
+
+RESOURCES_WITH_ARTICLES_QUERY = """MATCH (n: Resource)
+                                   WHERE n.uri > $after AND EXISTS { (n)-[:documentSource]->(:Article) }
+                                   RETURN n.uri ORDER BY n.uri LIMIT $limit"""
+
+ARTICLE_METADATA_QUERY = """UNWIND $uris AS uri
+                            MATCH (n: Resource {uri: uri})-[:documentSource]->(a: Article)
+                            RETURN n.uri, COLLECT(DISTINCT a.sourceOrganization), MIN(a.datePublished), MAX(a.datePublished)"""
+
+
+def date_ordinal(dt):
+    if dt is None:
+        return 0
+    return date(dt.year, dt.month, dt.day).toordinal()
+
+
+_known = {"codes": {}, "generation": None, "missing": set()}
+_lock = threading.Lock()
+
+
+def source_codes(source_names, client=None, create=False):
+    '''
+        Returns dict of source name -> bit number. If create is True, names without a bit number get one
+    '''
+    source_names = sorted(set([x for x in source_names if x is not None]))
+    if len(source_names) == 0:
+        return {}
+    generation = active_generation()
+    with _lock:
+        if generation != _known["generation"]:
+            _known["generation"] = generation
+            _known["codes"] = {}
+            _known["missing"] = set()
+        to_fetch = [x for x in source_names if x not in _known["codes"]
+                    and (create is True or x not in _known["missing"])]
+    if len(to_fetch) > 0:
+        if client is None:
+            client = redis_client()
+        vals = client.hmget(SOURCE_CODES_KEY, to_fetch)
+        found = {name: int(val) for name, val in zip(to_fetch, vals) if val is not None}
+        if create is True:
+            for name in to_fetch:
+                if name in found:
+                    continue
+                code = client.incr(SOURCE_CODES_COUNTER_KEY) - 1
+                if client.hsetnx(SOURCE_CODES_KEY, name, code) == 0: # someone else got there first
+                    code = int(client.hget(SOURCE_CODES_KEY, name))
+                found[name] = code
+        with _lock:
+            _known["codes"].update(found)
+            _known["missing"].difference_update(found)
+            _known["missing"].update([x for x in to_fetch if x not in found])
+    with _lock:
+        return {x: _known["codes"][x] for x in source_names if x in _known["codes"]}
+
+
+def forget_source_codes():
+    with _lock:
+        _known["codes"] = {}
+        _known["generation"] = None
+        _known["missing"] = set()
+
+
+def source_mask(source_names, client=None, create=False):
+    mask = 0
+    for code in source_codes(source_names, client, create).values():
+        mask |= 1 << code
+    return mask
+
+
+def encode_article_metadata(mask, min_date_ordinal, max_date_ordinal):
+    return f"{mask}:{min_date_ordinal}:{max_date_ordinal}"
+
+
+def decode_article_metadata(val):
+    mask, min_date_ordinal, max_date_ordinal = val.split(":")
+    return int(mask), int(min_date_ordinal), int(max_date_ordinal)
+
+
+def article_metadata(uri, client=None):
+    '''
+        (source_mask, min_date_ordinal, max_date_ordinal) or None if uri isn't indexed
+    '''
+    if client is None:
+        client = redis_client()
+    val = client.hget(generation_key(ARTICLE_INDEX_KEY), uri)
+    if val is None:
+        return None
+    return decode_article_metadata(val.decode("utf-8"))
+
+
+def articles_metadata(uris, client=None):
+    '''
+        article_metadata for each of uris (in the same order) with one HMGET
+    '''
+    if len(uris) == 0:
+        return []
+    if client is None:
+        client = redis_client()
+    vals = client.hmget(generation_key(ARTICLE_INDEX_KEY), uris)
+    return [decode_article_metadata(x.decode("utf-8")) if x is not None else None for x in vals]
+
+
+def store_article_metadata(uri, source_names, dates_published, client=None):
+    if client is None:
+        client = redis_client()
+    mask = source_mask(source_names, client, create=True)
+    ordinals = [date_ordinal(x) for x in dates_published if x is not None]
+    res = (mask, min(ordinals, default=0), max(ordinals, default=0))
+    client.hset(generation_key(ARTICLE_INDEX_KEY), uri, encode_article_metadata(*res))
+    return res
+
+
+def build_article_index(client=None, batch_size=10000):
+    if client is None:
+        client = redis_client()
+    key = generation_key(ARTICLE_INDEX_KEY)
+    tmp_key = f"{key}_building"
+    client.delete(tmp_key)
+    after = ""
+    cnt = 0
+    while True:
+        vals, _ = db.cypher_query(RESOURCES_WITH_ARTICLES_QUERY, {"after": after, "limit": batch_size})
+        if len(vals) == 0:
+            break
+        after = vals[-1][0]
+        rows, _ = db.cypher_query(ARTICLE_METADATA_QUERY, {"uris": [x[0] for x in vals]})
+        codes = source_codes([name for row in rows for name in row[1]], client, create=True)
+        mapping = {}
+        for uri, names, min_date, max_date in rows:
+            mask = 0
+            for name in names:
+                if name in codes:
+                    mask |= 1 << codes[name]
+            mapping[uri] = encode_article_metadata(mask, date_ordinal(min_date), date_ordinal(max_date))
+        client.hset(tmp_key, mapping=mapping)
+        cnt += len(mapping)
+    if cnt > 0:
+        client.rename(tmp_key, key)
+    else:
+        client.delete(key)
+    logger.info(f"Built article index for {cnt} resources")
+    return cnt
@@ -0,0 +1,120 @@
+'''
+    Generation-stamped cache keys, so that refresh_geo_data can warm up a new generation while the site keeps
+    reading the current one, rather than flushing Redis and running cold until the warm-up finishes.
+
+    make_key (the CACHES KEY_FUNCTION) puts the active generation into every Django cache key. Readers use the
+    generation in CACHE_GENERATION_KEY, checked at most every CACHE_GENERATION_CHECK_SECONDS. Inside
+    new_cache_generation() reads and writes go to a freshly allocated generation instead, which is published
+    by setting CACHE_GENERATION_KEY when the block finishes. Keys from older generations are then given
+    a TTL of CACHE_OLD_GENERATION_TTL and expire by themselves.
+
+    The indexes that are written straight to Redis (topics.merge_targets, article_index, name_index,
+    random_active_nodes and industry_geo.org_index) use generation_key, so they switch over with the same pointer.
+'''
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import re
+import threading
+import time
+import redis
+from syracuse.settings import CACHES, CACHE_GENERATION_CHECK_SECONDS, CACHE_OLD_GENERATION_TTL
+import logging
+logger = logging.getLogger(__name__)
+
+CACHE_GENERATION_KEY = "cache_generation"
+CACHE_GENERATION_COUNTER_KEY = "cache_generation_counter"
+GENERATION_IN_KEY = re.compile(r":g(\d+):")
+
+_building_generation = ContextVar("building_cache_generation", default=None)
+_current = {"generation": None, "checked_at": 0}
+_lock = threading.Lock()
+
+
+def redis_client():
+    return redis.Redis.from_url(CACHES["default"]["LOCATION"])
+
+
+def current_generation(client=None):
+    with _lock:
+        now = time.monotonic()
+        if _current["generation"] is not None and now - _current["checked_at"] < CACHE_GENERATION_CHECK_SECONDS:
+            return _current["generation"]
+        if client is None:
+            client = redis_client()
+        val = client.get(CACHE_GENERATION_KEY)
+        _current["generation"] = int(val) if val is not None else 0
+        _current["checked_at"] = now
+        return _current["generation"]
+
+
+def forget_cache_generation():
+    with _lock:
+        _current["generation"] = None
+
+
+def active_generation():
+    building = _building_generation.get()
+    if building is not None:
+        return building
+    return current_generation()
+
+
+def make_key(key, key_prefix, version):
+    return f"{key_prefix}:{version}:g{active_generation()}:{key}"
+
+
+def generation_key(key, generation=None):
+    '''
+        Redis key for an index that isn't written through django.core.cache, in the active generation by default
+    '''
+    if generation is None:
+        generation = active_generation()
+    return f"raw:g{generation}:{key}"
+
+
+def expire_old_generations(generation, client=None, ttl=CACHE_OLD_GENERATION_TTL):
+    '''
+        Gives every key from a generation before `generation` a TTL. Returns the number of keys
+    '''
+    if client is None:
+        client = redis_client()
+    cnt = 0
+    pipe = client.pipeline(transaction=False)
+    for key in client.scan_iter(match="*:g[0-9]*:*", count=1000):
+        match = GENERATION_IN_KEY.search(key.decode("utf-8", errors="replace"))
+        if match is None or int(match.group(1)) >= generation:
+            continue
+        pipe.expire(key, ttl)
+        cnt += 1
+        if cnt % 1000 == 0:
+            pipe.execute()
+    pipe.execute()
+    return cnt
+
+
+@contextmanager
+def new_cache_generation(client=None):
+    '''
+        Cache reads and writes in this block use a new generation, which readers switch to when the block
+        finishes without an exception. If it raises, readers stay where they were.
+    '''
+    if client is None:
+        client = redis_client()
+    generation = client.incr(CACHE_GENERATION_COUNTER_KEY)
+    current = current_generation(client)
+    if generation <= current: # counter was lost (e.g. a flush) while the pointer wasn't
+        generation = current + 1
+        client.set(CACHE_GENERATION_COUNTER_KEY, generation)
+    logger.info(f"Building cache generation {generation}, readers are on {current}")
+    token = _building_generation.set(generation)
+    try:
+        yield generation
+    finally:
+        _building_generation.reset(token)
+    client.set(CACHE_GENERATION_KEY, generation)
+    with _lock:
+        _current["generation"] = generation
+        _current["checked_at"] = time.monotonic()
+    cnt = expire_old_generations(generation, client)
+    logger.info(f"Published cache generation {generation}, {cnt} older keys set to expire in {CACHE_OLD_GENERATION_TTL}s")
@@ -3,23 +3,56 @@ from .stats_helpers import get_stats
 from topics.industry_geo.geoname_mappings import prepare_country_mapping
 from topics.industry_geo import update_organization_data
 from django.core.cache import cache
+from integration.import_report import timed_stage
+from topics.merge_targets import build_merge_target_map
+from topics.article_index import build_article_index, forget_source_codes
+from topics.name_index import build_name_index, forget_name_index
+from topics.random_active_nodes import build_random_active_node_pools
+from topics.industry_geo.org_index import forget_industry_geo_org_index
+from topics.cache_generations import new_cache_generation, forget_cache_generation
+from topics.local_cache import local_cache
 import redis
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def refresh_geo_data(max_date = date.today()):
+def refresh_geo_data(max_date = date.today(), report=None, before_publish=None):
+    '''
+        Django cache entries and the indexes kept straight in Redis are rebuilt in a new cache generation,
+        readers switch to all of them at once when everything is done. If anything fails they stay where they were.
+        before_publish is called right before the switch, e.g. to point the database alias at what was just loaded
+    '''
     t1 = datetime.now()
-    nuke_cache()
-    res0 = prepare_country_mapping()
-    update_organization_data()
-    get_stats(max_date)
-    cache.set("activity_stats_last_updated",max_date)
+    with new_cache_generation():
+        with timed_stage(report, "refresh_geo_data.build_merge_target_map"):
+            build_merge_target_map()
+        with timed_stage(report, "refresh_geo_data.build_article_index"):
+            build_article_index()
+        with timed_stage(report, "refresh_geo_data.build_name_index"):
+            build_name_index()
+        with timed_stage(report, "refresh_geo_data.build_random_active_node_pools"):
+            build_random_active_node_pools(as_of_date=max_date)
+        with timed_stage(report, "refresh_geo_data.prepare_country_mapping"):
+            res0 = prepare_country_mapping()
+        update_organization_data(report=report)
+        with timed_stage(report, "refresh_geo_data.get_stats"):
+            get_stats(max_date)
+        cache.set("activity_stats_last_updated",max_date)
+        if before_publish is not None:
+            before_publish()
     t2 = datetime.now()
     logger.info(f"Refreshed geo data in {t2 - t1}")
     return res0
 
 def nuke_cache():
+    '''
+        Empties Redis completely, including the precomputed indexes. refresh_geo_data doesn't need this
+    '''
     r = redis.Redis()
     r.flushdb()
+    forget_name_index()
+    forget_industry_geo_org_index()
+    forget_cache_generation()
+    forget_source_codes()
+    local_cache.clear_local()
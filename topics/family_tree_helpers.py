@@ -59,38 +59,42 @@ def do_get_child_orgs_query(uri_or_uris: Union[str,List], relationships = "buyer
     return results
 
 def get_child_orgs(uri, combine_same_as_name_only=True, relationships="buyer|vendor|investor",
-                   nodes_found_so_far=set(), source_names=Article.core_sources(),
+                   nodes_found_so_far=None, source_names=Article.core_sources(),
                    earliest_doc_date=BEGINNING_OF_TIME,
                    override_target_uri=None):
     logger.debug(f"get_child_orgs for {uri}")
+    if nodes_found_so_far is None:
+        nodes_found_so_far = {}
     if combine_same_as_name_only is False:
         res = do_get_child_orgs_query(uri, relationships, source_names, earliest_doc_date)
         return res
     org = Organization.self_or_ultimate_target_node(uri)
     if override_target_uri:
         override_target_org = Organization.self_or_ultimate_target_node(override_target_uri)
-    same_as_uris = [x.uri for x in org.sameAsNameOnly if x.internalMergedSameAsHighToUri is None]
+    same_as_uris = [x.uri for x in org.same_as_name_only_members()]
     res = do_get_child_orgs_query(same_as_uris + [uri], relationships, source_names, earliest_doc_date)
     items_to_keep = []
     for item in res:
         target_node_or_same_as = keep_or_switch_node(item[1], nodes_found_so_far, combine_same_as_name_only)
         if target_node_or_same_as == item[1]:
             item[0] = keep_or_switch_node(item[0], nodes_found_so_far, combine_same_as_name_only)
-            if override_target_uri and override_target_org in item[1].sameAsNameOnly:
+            if override_target_uri and item[1].same_as_name_only_key == override_target_org.same_as_name_only_key:
                 item[1] = override_target_org
             items_to_keep.append(item)
     return items_to_keep
 
 def get_parent_orgs(uri, combine_same_as_name_only=True, relationships="buyer|vendor|investor",
-                    nodes_found_so_far=set(),source_names=Article.core_sources(),
+                    nodes_found_so_far=None,source_names=Article.core_sources(),
                     earliest_doc_date=BEGINNING_OF_TIME):
     logger.debug(f"get_parent_orgs for {uri}")
+    if nodes_found_so_far is None:
+        nodes_found_so_far = {}
     if combine_same_as_name_only is False:
         res = do_get_parent_orgs_query(uri, relationships, source_names, earliest_doc_date)
         return res
 
     org = Organization.self_or_ultimate_target_node(uri)
-    same_as_uris = [x.uri for x in org.sameAsNameOnly if x.internalMergedSameAsHighToUri is None]
+    same_as_uris = [x.uri for x in org.same_as_name_only_members()]
     res = do_get_parent_orgs_query(same_as_uris + [uri], relationships, source_names, earliest_doc_date)
     items_to_keep = []
     for item in res:
@@ -104,7 +108,7 @@ def org_family_tree(organization_uri, combine_same_as_name_only=True, relationsh
                     source_names=Article.core_sources(),
                     earliest_doc_date=BEGINNING_OF_TIME):
     logger.debug(f"org_family_tree for {organization_uri} with '{relationships}' and '{source_names}'")
-    nodes_found_so_far = set()
+    nodes_found_so_far = {}
     children = get_child_orgs(organization_uri,
                     combine_same_as_name_only=combine_same_as_name_only,
                     relationships=relationships,nodes_found_so_far=nodes_found_so_far,
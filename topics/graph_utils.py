@@ -79,10 +79,10 @@ def graph_centered_on(start_node, **kwargs):
     min_date = kwargs.get("min_date",BEGINNING_OF_TIME)
     max_nodes = kwargs.get("max_nodes",50)
     uris_to_ignore = set()
-    nodes_found_so_far = set()
+    nodes_found_so_far = {}
 
     if combine_same_as_name_only is True:
-        center_node_same_as_name_onlies = root_node.sameAsNameOnly.all()
+        center_node_same_as_name_onlies = root_node.same_as_name_only_members()
         uris_to_ignore = set([x.uri for x in center_node_same_as_name_onlies])
 
     for rel_data in root_node.all_directional_relationships(source_names=source_names,min_date=min_date):
@@ -110,16 +110,14 @@ def graph_centered_on(start_node, **kwargs):
 def keep_or_switch_node(current_node, nodes_found_so_far, combine_same_as_name_only):
     '''
         Returns current_node if combine_name_as_same_only is False
-        Else, if a sameAsNameOnly node is in nodes_found_so_far, return that
+        Else, if a node from the same sameAsNameOnly group is in nodes_found_so_far, return that
         Else, return current_node
+
+        nodes_found_so_far is dict of same_as_name_only_key -> node
     '''
     if combine_same_as_name_only is False:
         return current_node
-    for same_as in current_node.sameAsNameOnly:
-        if same_as in nodes_found_so_far:
-            return same_as
-    nodes_found_so_far.add(current_node)
-    return current_node
+    return nodes_found_so_far.setdefault(current_node.same_as_name_only_key, current_node)
 
 def build_out_graph_entries(rel_data, node_data, node_details, edge_data, edge_details, uris_to_ignore, 
                             nodes_found_so_far, combine_same_as_name_only, source_names, min_date, max_nodes):
@@ -1,18 +1,29 @@
 from .region_hierarchies import COUNTRY_CODE_TO_NAME
 from .geoname_mappings import CC_ADMIN1_CODE_TO_ADMIN1_NAME_PREFIX
-from .orgs_by_industry_geo import (warm_up_all_industry_geos, 
+from .orgs_by_industry_geo import (warm_up_all_industry_geos,
                                    orgs_by_industry_cluster_and_geo,
                                    orgs_by_industry_text_and_geo)
 from topics.models import IndustryCluster
 from topics.util import geo_to_country_admin1
+from integration.import_report import timed_stage
 from .geo_rdf_post_processor import update_geonames_locations_with_country_admin1
+from .org_index import build_industry_geo_org_index
+from syracuse.settings import INDUSTRY_GEO_USE_INDEX
 import logging
 from django.core.cache import cache
+from topics.local_cache import local_cache
 logger = logging.getLogger(__name__)
 
-def update_organization_data():
-    update_geonames_locations_with_country_admin1()
-    warm_up_all_industry_geos()
+def update_organization_data(report=None):
+    with timed_stage(report, "refresh_geo_data.update_geonames_locations_with_country_admin1"):
+        update_geonames_locations_with_country_admin1()
+    if INDUSTRY_GEO_USE_INDEX is True:
+        with timed_stage(report, "refresh_geo_data.build_industry_geo_org_index"):
+            build_industry_geo_org_index()
+    else:
+        # no index in this generation, so readers use the per-key cache entries written here
+        with timed_stage(report, "refresh_geo_data.warm_up_all_industry_geos"):
+            warm_up_all_industry_geos()
 
 def orgs_by_industry_and_or_geo(industry_or_id,geo_code):
     if industry_or_id is None:
@@ -39,7 +50,7 @@ def country_admin1_full_name(geo_code):
     if admin1_code is None:
         return country_name
     else:
-        admin1_name = cache.get(f"{CC_ADMIN1_CODE_TO_ADMIN1_NAME_PREFIX}{geo_code}")
+        admin1_name = local_cache.get(f"{CC_ADMIN1_CODE_TO_ADMIN1_NAME_PREFIX}{geo_code}")
         return f"{country_name} - {admin1_name}"
     
 def orgs_by_industry_text_and_geo_code(industry_text, geo_code):
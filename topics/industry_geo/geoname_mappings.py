@@ -5,6 +5,7 @@ from collections import defaultdict
 from .region_hierarchies import COUNTRIES_WITH_STATE_PROVINCE
 from neomodel import db
 from topics.util import cache_friendly
+from topics.local_cache import local_cache
 import pickle
 
 logger = logging.getLogger(__name__)
@@ -19,10 +20,10 @@ def get_geo_data(geonameid):
     '''
         Returns: dict of country, admin1, feature, country_list
     '''
-    return cache.get(f"{GEO_DATA_PREFIX}{geonameid}")
+    return local_cache.get(f"{GEO_DATA_PREFIX}{geonameid}")
 
 def admin1s_for_country(country_code):
-    return cache.get(f"{COUNTRY_TO_ADMIN1_PREFIX}{country_code}")
+    return local_cache.get(f"{COUNTRY_TO_ADMIN1_PREFIX}{country_code}")
 
 def get_available_geoname_ids():
     res, _ = db.cypher_query("MATCH (n: GeoNamesLocation) RETURN DISTINCT(n.geoNamesId)")
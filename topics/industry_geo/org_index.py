@@ -0,0 +1,154 @@
+'''
+    Columnar index of which organizations are in which industry, country and admin1, replacing the
+    orgs_industry_cluster_geo_* cache entries that each held their own list of org uris.
+
+    Every unmerged organization gets an integer id (its position in the sorted uris). Each industry topicId,
+    country code and (country code, admin1 code) points at a sorted array of org ids, so an industry/geo cell is
+    an intersection of two arrays and a count is its length. The index is pickled into Redis as one blob in the
+    cache generation being built; each process loads it once and reloads when the generation or version key changes,
+    like topics.name_index.
+'''
+
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime
+import pickle
+import threading
+import time
+import zlib
+from neomodel import db
+from topics.merge_targets import redis_client
+from topics.cache_generations import generation_key, active_generation
+from syracuse.settings import INDUSTRY_GEO_INDEX_CHECK_SECONDS
+import logging
+logger = logging.getLogger(__name__)
+
+INDUSTRY_GEO_INDEX_KEY = "industry_geo_org_index"
+INDUSTRY_GEO_INDEX_VERSION_KEY = "industry_geo_org_index_version"
+
+ORGANIZATION_INDUSTRIES_QUERY = """MATCH (o:Resource&Organization)-[:industryClusterPrimary]->(i: Resource&IndustryCluster)
+                                   WHERE o.internalMergedSameAsHighToUri IS NULL
+                                   RETURN o.uri, COLLECT(DISTINCT i.topicId)"""
+
+ORGANIZATION_LOCATIONS_QUERY = """MATCH (l: Resource&GeoNamesLocation)<-[:basedInHighGeoNamesLocation]-(o:Resource&Organization)
+                                  WHERE o.internalMergedSameAsHighToUri IS NULL
+                                  RETURN o.uri, COLLECT(DISTINCT [l.countryCode, l.admin1Code])"""
+
+
+def intersect_sorted(left, right):
+    '''
+        Ids in both sorted arrays, looking up each id of the shorter one in the longer one
+    '''
+    if len(left) > len(right):
+        left, right = right, left
+    res = array("I")
+    for org_id in left:
+        idx = bisect_left(right, org_id)
+        if idx < len(right) and right[idx] == org_id:
+            res.append(org_id)
+    return res
+
+
+class IndustryGeoOrgIndex(object):
+    '''
+        industries is {org_uri: [industry topicIds]}, locations is {org_uri: [(country_code, admin1_code)]}
+    '''
+
+    def __init__(self, industries, locations):
+        self.uris = sorted(set(industries) | set(locations))
+        ids = {uri: idx for idx, uri in enumerate(self.uris)}
+        by_industry = defaultdict(set)
+        by_country = defaultdict(set)
+        by_admin1 = defaultdict(set)
+        for uri, topic_ids in industries.items():
+            for topic_id in topic_ids:
+                by_industry[topic_id].add(ids[uri])
+        for uri, geos in locations.items():
+            for country_code, admin1_code in geos:
+                if country_code is None or country_code == '':
+                    continue
+                by_country[country_code].add(ids[uri])
+                if admin1_code is not None and admin1_code not in ('', '00'):
+                    by_admin1[(country_code, admin1_code)].add(ids[uri])
+        self.industries = {k: array("I", sorted(v)) for k, v in by_industry.items()}
+        self.countries = {k: array("I", sorted(v)) for k, v in by_country.items()}
+        self.admin1s = {k: array("I", sorted(v)) for k, v in by_admin1.items()}
+
+    def __len__(self):
+        return len(self.uris)
+
+    def org_ids(self, industry_cluster_topic_id, country_code, admin1_code=None):
+        '''
+            Sorted array of org ids, or None for the query with neither industry nor geo
+        '''
+        if country_code is None:
+            if admin1_code is not None or industry_cluster_topic_id is None:
+                return None
+            return self.industries.get(industry_cluster_topic_id, array("I"))
+        if admin1_code is None:
+            geo_ids = self.countries.get(country_code, array("I"))
+        else:
+            geo_ids = self.admin1s.get((country_code, admin1_code), array("I"))
+        if industry_cluster_topic_id is None:
+            return geo_ids
+        return intersect_sorted(self.industries.get(industry_cluster_topic_id, array("I")), geo_ids)
+
+    def org_uris(self, industry_cluster_topic_id, country_code, admin1_code=None):
+        org_ids = self.org_ids(industry_cluster_topic_id, country_code, admin1_code)
+        if org_ids is None:
+            return None
+        return [self.uris[x] for x in org_ids]
+
+    def count(self, industry_cluster_topic_id, country_code, admin1_code=None):
+        org_ids = self.org_ids(industry_cluster_topic_id, country_code, admin1_code)
+        if org_ids is None:
+            return None
+        return len(org_ids)
+
+
+def build_industry_geo_org_index(client=None):
+    if client is None:
+        client = redis_client()
+    industries, _ = db.cypher_query(ORGANIZATION_INDUSTRIES_QUERY)
+    locations, _ = db.cypher_query(ORGANIZATION_LOCATIONS_QUERY)
+    index = IndustryGeoOrgIndex(dict(industries), {uri: [tuple(x) for x in geos] for uri, geos in locations})
+    pipe = client.pipeline()
+    pipe.set(generation_key(INDUSTRY_GEO_INDEX_KEY), zlib.compress(pickle.dumps(index)))
+    pipe.set(generation_key(INDUSTRY_GEO_INDEX_VERSION_KEY), datetime.utcnow().isoformat())
+    pipe.execute()
+    forget_industry_geo_org_index()
+    logger.info(f"Built industry geo index for {len(index)} organizations, {len(index.industries)} industries, "
+                f"{len(index.countries)} countries and {len(index.admin1s)} admin1s")
+    return len(index)
+
+
+_loaded = {"generation": None, "version": None, "index": None, "checked_at": 0}
+_lock = threading.Lock()
+
+
+def industry_geo_org_index(client=None):
+    '''
+        The current IndustryGeoOrgIndex, or None if one hasn't been built. Redis is asked for the version
+        at most every INDUSTRY_GEO_INDEX_CHECK_SECONDS
+    '''
+    with _lock:
+        now = time.monotonic()
+        generation = active_generation()
+        if generation == _loaded["generation"] and now - _loaded["checked_at"] < INDUSTRY_GEO_INDEX_CHECK_SECONDS:
+            return _loaded["index"]
+        _loaded["checked_at"] = now
+        if client is None:
+            client = redis_client()
+        version = client.get(generation_key(INDUSTRY_GEO_INDEX_VERSION_KEY, generation))
+        if generation != _loaded["generation"] or version != _loaded["version"]:
+            blob = client.get(generation_key(INDUSTRY_GEO_INDEX_KEY, generation)) if version is not None else None
+            _loaded["index"] = pickle.loads(zlib.decompress(blob)) if blob is not None else None
+            _loaded["generation"] = generation
+            _loaded["version"] = version
+        return _loaded["index"]
+
+
+def forget_industry_geo_org_index():
+    with _lock:
+        _loaded["checked_at"] = 0
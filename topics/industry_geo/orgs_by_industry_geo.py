@@ -5,16 +5,22 @@ from topics.industry_geo.region_hierarchies import (GLOBAL_REGION_TO_COUNTRY,
     COUNTRY_TO_GLOBAL_REGION, US_REGIONS_TO_STATES_HIERARCHY,
     GLOBAL_REGION_TO_COUNTRIES_FLAT,
     US_NATIONAL_REGIONS_TO_STATES)
-from neomodel import db
 from django.core.cache import cache
 from collections import defaultdict, OrderedDict
 from .hierarchy_utils import filtered_hierarchy, hierarchy_widths
 from typing import List
 from topics.util import cacheable_hash
+from topics.query_templates import run_query, template_name, NO_LIMIT
+from topics.industry_geo.org_index import industry_geo_org_index
 
 import logging
 logger = logging.getLogger(__name__)
 
+WARM_UP_BATCH_SIZE = 1000
+
+def industry_geo_cache_key(industry_cluster_topic_id, country_code, admin1_code, limit=None):
+    return f"orgs_industry_cluster_geo_{industry_cluster_topic_id}_{country_code}_{admin1_code}_{limit}"
+
 def orgs_by_industry_cluster_and_geo(industry_cluster_uri, industry_cluster_topic_id, 
                                      country_code, admin1_code=None, 
                                      force_update_cache=False,
@@ -25,7 +31,12 @@ def orgs_by_industry_cluster_and_geo(industry_cluster_uri, industry_cluster_topi
         country_code = None
     if admin1_code == '':
         admin1_code = None
-    cache_key = f"orgs_industry_cluster_geo_{industry_cluster_topic_id}_{country_code}_{admin1_code}_{limit}"
+    if force_update_cache is False:
+        index = industry_geo_org_index()
+        res = index.org_uris(industry_cluster_topic_id, country_code, admin1_code) if index is not None else None
+        if res is not None:
+            return res[:limit] if limit else res
+    cache_key = industry_geo_cache_key(industry_cluster_topic_id, country_code, admin1_code, limit)
     
     if force_update_cache is False:
         res = cache.get(cache_key)
@@ -39,71 +50,128 @@ def orgs_by_industry_cluster_and_geo(industry_cluster_uri, industry_cluster_topi
     cache.set(cache_key, res)
     return res
 
-def warm_up_industries():
-    logger.info("Warming up global industries")
-    query = f"""MATCH (o:Resource&Organization)-[:industryClusterPrimary]->(i: Resource&IndustryCluster)
+def orgs_by_industry_cluster_and_geos(industry_cluster_uri, industry_cluster_topic_id, geos,
+                                      set_none_to_empty_arr=False, counts_only=False):
+    '''
+        orgs_by_industry_cluster_and_geo for each (country_code, admin1_code) in geos. Returns dict of
+        (country_code, admin1_code) -> org uris, or -> number of orgs if counts_only.
+        Uses the industry geo index if there is one, otherwise everything already cached is fetched in one get_many
+    '''
+    index = industry_geo_org_index()
+    if index is not None and industry_cluster_topic_id is not None:
+        if counts_only:
+            return {(cc, adm1): index.count(industry_cluster_topic_id, cc, adm1) for cc, adm1 in geos}
+        return {(cc, adm1): index.org_uris(industry_cluster_topic_id, cc, adm1) for cc, adm1 in geos}
+    keys = {industry_geo_cache_key(industry_cluster_topic_id, cc, adm1): (cc, adm1) for cc, adm1 in geos}
+    found = cache.get_many(list(keys.keys()))
+    res = {}
+    for key, (cc, adm1) in keys.items():
+        if key in found:
+            res[(cc, adm1)] = found[key]
+        else:
+            res[(cc, adm1)] = orgs_by_industry_cluster_and_geo(industry_cluster_uri, industry_cluster_topic_id, cc, adm1,
+                                                                set_none_to_empty_arr=set_none_to_empty_arr)
+    if counts_only:
+        res = {k: len(v) for k, v in res.items()}
+    return res
+
+def set_many_in_batches(values, batch_size=WARM_UP_BATCH_SIZE):
+    items = list(values.items())
+    for idx in range(0, len(items), batch_size):
+        cache.set_many(dict(items[idx:idx + batch_size]))
+    return len(items)
+
+def industries_warm_up_values():
+    query = """MATCH (o:Resource&Organization)-[:industryClusterPrimary]->(i: Resource&IndustryCluster)
                             WHERE o.internalMergedSameAsHighToUri IS NULL
                             RETURN i.topicId, collect(distinct(o.uri))"""
-    industries, _ = db.cypher_query(query)
-    logger.info(f"Caching {len(industries)} results")
-    for industry_cluster_topic_id, org_uris in industries:
-        cache_key = f"orgs_industry_cluster_geo_{industry_cluster_topic_id}_None_None_None"
-        logger.debug(f"caching {cache_key}")
-        cache.set(cache_key, org_uris)
+    industries, _ = run_query("warm_up_industries", query)
+    return {industry_geo_cache_key(topic_id, None, None): org_uris for topic_id, org_uris in industries}
 
-def warm_up_regions(countries_with_state_province=COUNTRIES_WITH_STATE_PROVINCE):
-    logger.info("Warming up geo-wide orgs")
-    country_query = f"""MATCH (l: Resource&GeoNamesLocation)<-[:basedInHighGeoNamesLocation]-(o:Resource&Organization)
+def regions_warm_up_values(countries_with_state_province=COUNTRIES_WITH_STATE_PROVINCE):
+    country_query = """MATCH (l: Resource&GeoNamesLocation)<-[:basedInHighGeoNamesLocation]-(o:Resource&Organization)
                             WHERE o.internalMergedSameAsHighToUri IS NULL
                             RETURN l.countryCode, collect(distinct(o.uri))"""
-    country_level, _ = db.cypher_query(country_query)
-    
-    logger.info(f"Caching {len(country_level)} results")
-    for country_code, org_uris in country_level:
-        cache_key = f"orgs_industry_cluster_geo_None_{country_code}_None_None"
-        logger.debug(f"caching {cache_key}")
-        cache.set(cache_key, org_uris)
-    logger.info("Warming up at geo-wide orgs at admin1 level")
-
-    admin1_query = f"""MATCH (l: Resource&GeoNamesLocation)<-[:basedInHighGeoNamesLocation]-(o:Resource&Organization)
+    country_level, _ = run_query("warm_up_regions_country", country_query)
+    values = {industry_geo_cache_key(None, country_code, None): org_uris for country_code, org_uris in country_level}
+
+    admin1_query = """MATCH (l: Resource&GeoNamesLocation)<-[:basedInHighGeoNamesLocation]-(o:Resource&Organization)
                         WHERE o.internalMergedSameAsHighToUri IS NULL
-                        AND l.countryCode in {countries_with_state_province}
+                        AND l.countryCode in $country_codes
                         AND l.admin1Code <> '00'
                         RETURN l.countryCode, l.admin1Code, collect(distinct(o.uri))"""
-    admin1_level, _ = db.cypher_query(admin1_query)
-    logger.debug(f"Caching {len(admin1_level)} results")
+    admin1_level, _ = run_query("warm_up_regions_admin1", admin1_query, {"country_codes": list(countries_with_state_province)})
     for country_code, admin1_code, org_uris in admin1_level:
-        cache_key = f"orgs_industry_cluster_geo_None_{country_code}_{admin1_code}_None"
-        cache.set(cache_key, org_uris)
+        values[industry_geo_cache_key(None, country_code, admin1_code)] = org_uris
+    return values
 
-def warm_up_all_industry_geos(countries_with_state_province=COUNTRIES_WITH_STATE_PROVINCE):
-    logger.info("Warming up at country level")
-    country_query = f"""MATCH (l: Resource&GeoNamesLocation)<-[:basedInHighGeoNamesLocation]-(o:Resource&Organization)-[:industryClusterPrimary]->(i: Resource&IndustryCluster)
+def industry_geos_warm_up_values(countries_with_state_province=COUNTRIES_WITH_STATE_PROVINCE):
+    country_query = """MATCH (l: Resource&GeoNamesLocation)<-[:basedInHighGeoNamesLocation]-(o:Resource&Organization)-[:industryClusterPrimary]->(i: Resource&IndustryCluster)
                         WHERE o.internalMergedSameAsHighToUri IS NULL
                         RETURN i.topicId, l.countryCode, collect(distinct(o.uri))"""
-    country_level, _ = db.cypher_query(country_query)
-    logger.info(f"Caching {len(country_level)} results")
-    for industry_cluster_topic_id, country_code, org_uris in country_level:
-        cache_key = f"orgs_industry_cluster_geo_{industry_cluster_topic_id}_{country_code}_None_None"
-        logger.debug(f"caching {cache_key}")
-        cache.set(cache_key, org_uris)
-    
-    logger.info("Warming up at admin1 level")
-    admin1_query = f"""MATCH (l: Resource&GeoNamesLocation)<-[:basedInHighGeoNamesLocation]-(o:Resource&Organization)-[:industryClusterPrimary]->(i: Resource&IndustryCluster)
+    country_level, _ = run_query("warm_up_industry_geos_country", country_query)
+    values = {industry_geo_cache_key(topic_id, country_code, None): org_uris for topic_id, country_code, org_uris in country_level}
+
+    admin1_query = """MATCH (l: Resource&GeoNamesLocation)<-[:basedInHighGeoNamesLocation]-(o:Resource&Organization)-[:industryClusterPrimary]->(i: Resource&IndustryCluster)
                         WHERE o.internalMergedSameAsHighToUri IS NULL
-                        AND l.countryCode in {countries_with_state_province}
+                        AND l.countryCode in $country_codes
                         AND l.admin1Code <> '00'
                         RETURN i.topicId, l.countryCode, l.admin1Code, collect(distinct(o.uri))"""
-    admin1_level, _ = db.cypher_query(admin1_query)
-    logger.debug(f"Caching {len(admin1_level)} results")
-    for industry_cluster_topic_id, country_code, admin1_code, org_uris in admin1_level:
-        cache_key = f"orgs_industry_cluster_geo_{industry_cluster_topic_id}_{country_code}_{admin1_code}_None"
-        cache.set(cache_key, org_uris)
-    
-    warm_up_industries()
-    warm_up_regions()
-    # Now make sure any un-set industry/region combos are set to empty list
-    set_not_found_industry_geo_to_empty_list()
+    admin1_level, _ = run_query("warm_up_industry_geos_admin1", admin1_query, {"country_codes": list(countries_with_state_province)})
+    for topic_id, country_code, admin1_code, org_uris in admin1_level:
+        values[industry_geo_cache_key(topic_id, country_code, admin1_code)] = org_uris
+    return values
+
+def industry_geo_key_space(values, industry_topic_ids, countries_with_state_province=COUNTRIES_WITH_STATE_PROVINCE):
+    '''
+        Every cache key the industry-geo finder reads for these industries: each industry on its own and in each country,
+        each country and admin1 on its own, and each industry in each admin1 of the countries where it has orgs.
+        values (cache key -> org uris) is used to tell which countries an industry has orgs in
+    '''
+    admin1s = {cc: admin1s_for_country(cc) or [] for cc in countries_with_state_province}
+    keys = []
+    for cc in COUNTRY_TO_GLOBAL_REGION.keys():
+        keys.append(industry_geo_cache_key(None, cc, None))
+        for adm1 in admin1s.get(cc, []):
+            keys.append(industry_geo_cache_key(None, cc, adm1))
+    for topic_id in industry_topic_ids:
+        keys.append(industry_geo_cache_key(topic_id, None, None))
+        for cc in COUNTRY_TO_GLOBAL_REGION.keys():
+            key = industry_geo_cache_key(topic_id, cc, None)
+            keys.append(key)
+            if len(values.get(key, [])) > 0:
+                for adm1 in admin1s.get(cc, []):
+                    keys.append(industry_geo_cache_key(topic_id, cc, adm1))
+    return keys
+
+def warm_up_industries():
+    logger.info("Warming up global industries")
+    cnt = set_many_in_batches(industries_warm_up_values())
+    logger.info(f"Cached {cnt} results")
+
+def warm_up_regions(countries_with_state_province=COUNTRIES_WITH_STATE_PROVINCE):
+    logger.info("Warming up geo-wide orgs")
+    cnt = set_many_in_batches(regions_warm_up_values(countries_with_state_province))
+    logger.info(f"Cached {cnt} results")
+
+def warm_up_all_industry_geos(countries_with_state_province=COUNTRIES_WITH_STATE_PROVINCE):
+    '''
+        Works out every industry/geo entry in memory, including the empty lists for combinations with no orgs,
+        then writes them with set_many
+    '''
+    logger.info("Warming up industry geos")
+    values = industry_geos_warm_up_values(countries_with_state_province)
+    values.update(industries_warm_up_values())
+    values.update(regions_warm_up_values(countries_with_state_province))
+    industry_topic_ids = [x.topicId for x in IndustryCluster.leaf_nodes_only()]
+    empty_cnt = 0
+    for key in industry_geo_key_space(values, industry_topic_ids, countries_with_state_province):
+        if key not in values:
+            values[key] = []
+            empty_cnt += 1
+    cnt = set_many_in_batches(values)
+    logger.info(f"Cached {cnt} industry geo results of which {empty_cnt} empty")
+    return cnt
 
 def orgs_by_industry_text_and_geo(industry_text, country_code, admin1_code=None):
     cache_key = f"orgs_industry_text_{cacheable_hash(industry_text)}_{country_code}"
@@ -118,36 +186,37 @@ def orgs_by_industry_text_and_geo(industry_text, country_code, admin1_code=None)
     return res
 
 def do_org_geo_industry_cluster_query(industry_uri: str, country_code: str, admin1_code: str, limit: int = None):
-    industry_str = f" AND i.uri = '{industry_uri}' " if industry_uri else ""
-    country_str = f" AND l.countryCode = '{country_code}' " if country_code else ""
-    admin1_str = f" AND l.admin1Code = '{admin1_code}' " if admin1_code else ""
-    limit_str = f" LIMIT {limit} " if limit else ""
+    industry_str = " AND i.uri = $industry_uri " if industry_uri else ""
+    country_str = " AND l.countryCode = $country_code " if country_code else ""
+    admin1_str = " AND l.admin1Code = $admin1_code " if admin1_code else ""
     query = f"""MATCH (l: Resource&GeoNamesLocation)<-[:basedInHighGeoNamesLocation]-(o:Resource&Organization)-[:industryClusterPrimary]->(i: Resource&IndustryCluster)
                 WHERE o.internalMergedSameAsHighToUri IS NULL
                 {industry_str}
                 {country_str}
                 {admin1_str}
                 RETURN DISTINCT o.uri
-                {limit_str}
+                LIMIT $limit
                 """
     logger.debug(query)
-    res, _ = db.cypher_query(query, resolve_objects=True)
+    name = template_name("org_geo_industry_cluster", industry=bool(industry_uri), country=bool(country_code), admin1=bool(admin1_code))
+    res, _ = run_query(name, query, {"industry_uri": industry_uri, "country_code": country_code, "admin1_code": admin1_code,
+                                     "limit": limit if limit else NO_LIMIT}, resolve_objects=True)
     return [x[0] for x in res]
 
 def set_not_found_industry_geo_to_empty_list():
-    industry_clusters = IndustryCluster.leaf_nodes_only()
-    org_geo_industry_by_clusters(industry_clusters,counts_only=True,set_none_to_empty_arr=True) # all combos of industry/geo
-    
-    for ind in industry_clusters:
-        orgs_by_industry_cluster_and_geo(ind.uri,ind.topicId,None,set_none_to_empty_arr=True)
-    
-    for cc in COUNTRY_TO_GLOBAL_REGION.keys():
-        orgs_by_industry_cluster_and_geo(None,None,cc,set_none_to_empty_arr=True)
-        if cc in COUNTRIES_WITH_STATE_PROVINCE:
-            admin1_list = admin1s_for_country(cc)
-            for adm1 in admin1_list:
-                    res = orgs_by_industry_cluster_and_geo(None, None,cc,adm1,
-                                                    set_none_to_empty_arr=True)
+    '''
+        Sets any industry/geo entries that aren't cached to an empty list, in one get_many and set_many
+    '''
+    industry_topic_ids = [x.topicId for x in IndustryCluster.leaf_nodes_only()]
+    country_keys = [industry_geo_cache_key(topic_id, cc, None)
+                        for topic_id in industry_topic_ids for cc in COUNTRY_TO_GLOBAL_REGION.keys()]
+    found = {}
+    for idx in range(0, len(country_keys), WARM_UP_BATCH_SIZE):
+        found.update(cache.get_many(country_keys[idx:idx + WARM_UP_BATCH_SIZE]))
+    keys = industry_geo_key_space(found, industry_topic_ids)
+    for idx in range(0, len(keys), WARM_UP_BATCH_SIZE):
+        found.update(cache.get_many(keys[idx:idx + WARM_UP_BATCH_SIZE]))
+    return set_many_in_batches({key: [] for key in keys if key not in found})
 
 def org_geo_industry_cluster_query_by_words(search_text: str,counts_only):
     industry_clusters = IndustryCluster.by_representative_doc_words(search_text)
@@ -163,24 +232,22 @@ def org_geo_industry_by_clusters(industry_clusters, counts_only, set_none_to_emp
         logger.info(f"org_geo_industry_by_clusters: working on {ind.uri}")
         ind_uri = ind.uri
         country_results[ind_uri] = {}
+        by_country = orgs_by_industry_cluster_and_geos(ind.uri, ind.topicId,
+                                    [(cc, None) for cc in COUNTRY_TO_GLOBAL_REGION.keys()], set_none_to_empty_arr, counts_only)
         for cc in COUNTRY_TO_GLOBAL_REGION.keys():
-            res = orgs_by_industry_cluster_and_geo(ind.uri,ind.topicId,cc,set_none_to_empty_arr=set_none_to_empty_arr)
-            if len(res) > 0:
+            res = by_country[(cc, None)]
+            if (res if counts_only else len(res)) > 0:
                 relevant_countries.append(cc)
-                if counts_only:
-                    res = len(res)
                 country_results[ind_uri][cc] = res
                 if cc in COUNTRIES_WITH_STATE_PROVINCE:
                     admin1_list = admin1s_for_country(cc)
                     assert admin1_list is not None, f"No admin1 found for {cc}"
                     adm1_results[ind_uri][cc] = {}
+                    by_admin1 = orgs_by_industry_cluster_and_geos(ind.uri, ind.topicId,
+                                    [(cc, adm1) for adm1 in admin1_list], set_none_to_empty_arr, counts_only)
                     for adm1 in admin1_list:
-                        res = orgs_by_industry_cluster_and_geo(ind.uri,
-                                                        ind.topicId,cc,adm1,
-                                                        set_none_to_empty_arr=set_none_to_empty_arr)
-                        if len(res) > 0:
-                            if counts_only:
-                                res = len(res)
+                        res = by_admin1[(cc, adm1)]
+                        if (res if counts_only else len(res)) > 0:
                             adm1_results[ind_uri][cc][adm1] = res
                             relevant_admin1s[cc].append(adm1)
     return industry_clusters, relevant_countries, relevant_admin1s, country_results, adm1_results
@@ -0,0 +1,81 @@
+'''
+    Per-process LRU in front of django.core.cache for lookups that only change when data is imported
+    (geo data, source names, industry keywords etc), so that repeated calls don't go to Redis and unpickle.
+
+    Entries are held against the cache generation they were read in (see topics.cache_generations), so publishing
+    a new generation invalidates every process's copies. LOCAL_CACHE_TTL_SECONDS bounds how stale an entry can be
+    otherwise, e.g. after nuke_cache. Misses aren't held locally.
+
+    Values are shared between callers, so callers mustn't modify what they get back.
+'''
+
+from collections import OrderedDict
+import threading
+import time
+from django.core.cache import cache
+from topics.cache_generations import active_generation
+from syracuse.settings import LOCAL_CACHE_MAX_ENTRIES, LOCAL_CACHE_TTL_SECONDS
+
+
+class LocalCache(object):
+
+    def __init__(self, max_entries=LOCAL_CACHE_MAX_ENTRIES, ttl=LOCAL_CACHE_TTL_SECONDS, backend=cache):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.entries = OrderedDict() # (generation, key) -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_local(self, generation, key):
+        with self.lock:
+            entry = self.entries.get((generation, key))
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[(generation, key)]
+                return None
+            self.entries.move_to_end((generation, key))
+            return value
+
+    def set_local(self, generation, key, value):
+        with self.lock:
+            self.entries[(generation, key)] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end((generation, key))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        generation = active_generation()
+        value = self.get_local(generation, key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = self.backend.get(key)
+        if value is None:
+            return default
+        self.set_local(generation, key, value)
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+        self.set_local(active_generation(), key, value)
+
+    def delete(self, key):
+        self.backend.delete(key)
+        with self.lock:
+            for local_key in [x for x in self.entries if x[1] == key]:
+                del self.entries[local_key]
+
+    def clear_local(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+local_cache = LocalCache()
@@ -0,0 +1,74 @@
+'''
+    uri -> final merged uri for every node merged by sameAsHigh post-processing, stored as a single
+    Redis hash so that resolving many uris is one HMGET rather than a Bolt query per hop.
+
+    The hash is kept per cache generation (see topics.cache_generations). Only merged uris are in it: a uri that isn't there is either unmerged or newer than the map,
+    so callers should still check internalMergedSameAsHighToUri on the node they end up with.
+'''
+
+from neomodel import db
+from syracuse.settings import CACHES
+from topics.cache_generations import generation_key
+import redis
+import logging
+logger = logging.getLogger(__name__)
+
+MERGE_TARGETS_KEY = "merge_targets"
+
+MERGED_URIS_QUERY = """MATCH (n: Resource) WHERE n.internalMergedSameAsHighToUri IS NOT NULL
+                       RETURN n.uri, n.internalMergedSameAsHighToUri"""
+
+
+def redis_client():
+    return redis.Redis.from_url(CACHES["default"]["LOCATION"])
+
+
+def compress_merge_chains(merged_to):
+    '''
+        merged_to is dict of uri -> internalMergedSameAsHighToUri. Returns dict of uri -> last uri in its chain
+    '''
+    res = {}
+    for uri in merged_to:
+        chain = []
+        current = uri
+        while current in merged_to and current not in res and current not in chain:
+            chain.append(current)
+            current = merged_to[current]
+        if current in chain:
+            logger.warning(f"Merge chain from {uri} loops back to {current}")
+        final_uri = res.get(current, current)
+        for x in chain:
+            res[x] = final_uri
+    return res
+
+
+def build_merge_target_map(client=None, chunk_size=10000):
+    if client is None:
+        client = redis_client()
+    vals, _ = db.cypher_query(MERGED_URIS_QUERY)
+    targets = compress_merge_chains({x[0]: x[1] for x in vals})
+    key = generation_key(MERGE_TARGETS_KEY)
+    tmp_key = f"{key}_building"
+    client.delete(tmp_key)
+    items = list(targets.items())
+    for idx in range(0, len(items), chunk_size):
+        client.hset(tmp_key, mapping=dict(items[idx:idx + chunk_size]))
+    if len(items) > 0:
+        client.rename(tmp_key, key) # readers switch over in one step
+    else:
+        client.delete(key)
+    logger.info(f"Built merge target map for {len(items)} merged uris")
+    return len(items)
+
+
+def ultimate_target_uris(uris, client=None):
+    '''
+        Returns dict of uri -> final uri for those uris that are in the map
+    '''
+    uris = list(uris)
+    if len(uris) == 0:
+        return {}
+    if client is None:
+        client = redis_client()
+    vals = client.hmget(generation_key(MERGE_TARGETS_KEY), uris)
+    return {uri: val.decode("utf-8") for uri, val in zip(uris, vals) if val is not None}
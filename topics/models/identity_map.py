@@ -0,0 +1,46 @@
+'''
+    Request-scoped identity map: within a request each uri is hydrated into at most one node object,
+    so relationships prefetched onto that object (see Resource.prefetch) are reused wherever the node turns up.
+    Outside a request (management commands, tests) nothing is remembered.
+'''
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_identity_map = ContextVar("identity_map", default=None)
+
+
+@contextmanager
+def request_scope():
+    token = _identity_map.set({})
+    try:
+        yield
+    finally:
+        _identity_map.reset(token)
+
+
+def remember(node):
+    '''
+        Returns the node already held for node.uri if there is one, otherwise holds on to node and returns it
+    '''
+    nodes = _identity_map.get()
+    if nodes is None or node is None:
+        return node
+    return nodes.setdefault(node.uri, node)
+
+
+def remembered(uri):
+    nodes = _identity_map.get()
+    if nodes is None:
+        return None
+    return nodes.get(uri)
+
+
+class IdentityMapMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with request_scope():
+            return self.get_response(request)
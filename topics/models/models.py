@@ -1,18 +1,26 @@
 from neomodel import (StructuredNode, StringProperty,
     RelationshipTo, Relationship, RelationshipFrom, db, ArrayProperty,
     IntegerProperty, StructuredRel)
-from urllib.parse import urlparse
 from syracuse.neomodel_utils import NativeDateTimeProperty
 import cleanco
 from django.core.cache import cache
 from syracuse.settings import NEOMODEL_NEO4J_BOLT_URL
 from collections import Counter, defaultdict
+import zlib
 from neomodel.cardinality import OneOrMore, One
 from typing import List
 from topics.constants import BEGINNING_OF_TIME
 from topics.neo4j_utils import date_to_cypher_friendly
 from topics.util import cache_friendly,geo_to_country_admin1
 from integration.vector_search_utils import do_vector_search
+from topics.merge_targets import ultimate_target_uris
+from topics.query_templates import run_query, template_name, NO_LIMIT
+from topics.article_index import article_metadata, articles_metadata, store_article_metadata, source_mask
+from topics.models.identity_map import remember, remembered
+from topics.name_index import search_names
+from topics.random_active_nodes import sample_random_active_nodes
+from topics.models.node_records import NodeRecord, split_uri
+from topics.local_cache import local_cache
 
 import logging
 logger = logging.getLogger(__name__)
@@ -36,6 +44,102 @@ def shortest(arr):
         return arr # Don't sort if it's just a string
     return sorted(arr,key=len)[0]
 
+def most_common_name(name_cands):
+    if len(name_cands) == 0:
+        return None
+    return Counter(name_cands).most_common(1)[0][0]
+
+def by_popularity(vals):
+    return [x[0] for x in Counter(vals).most_common()]
+
+def longest_representative_doc(docs):
+    if docs is None:
+        return None
+    val = sorted(docs,key=len)[-1]
+    mappings = {"ott software": "OTT Software"}
+    return mappings.get(val.lower(),val)
+
+def industries_as_string(representative_docs):
+    if len(representative_docs) == 0:
+        return None
+    sorted_inds = sorted(representative_docs)
+    top_inds = sorted_inds[:2]
+    top_inds_as_str = ", ".join(sorted(top_inds))
+    if len(sorted_inds) < 3:
+        return top_inds_as_str
+    other_ind_num = len(sorted_inds) - 2
+    return f"{top_inds_as_str} and {other_ind_num} more"
+
+class PrefetchedRelationship(object):
+    '''
+        Stands in for a node's relationship manager once Resource.prefetch has loaded it: reads are served
+        from memory, anything else (connect, filter etc) goes to the real manager
+    '''
+
+    def __init__(self, manager, nodes, rels):
+        self.manager = manager
+        self.nodes = nodes
+        self.rels = rels # uri -> relationship
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __bool__(self):
+        return len(self.nodes) > 0
+
+    def __getitem__(self, idx):
+        return self.nodes[idx]
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def all(self):
+        return list(self.nodes)
+
+    def single(self):
+        return self.nodes[0] if len(self.nodes) > 0 else None
+
+    def relationship(self, node):
+        if node.uri in self.rels:
+            return self.rels[node.uri]
+        return self.manager.relationship(node)
+
+    def order_by(self, *props):
+        res = list(self.nodes)
+        for prop in reversed(props):
+            reverse = prop.startswith("-")
+            key = prop.lstrip("-")
+            res = sorted(res, key=lambda x: getattr(x, key), reverse=reverse)
+        return res
+
+    def __getattr__(self, name):
+        if name.startswith("__") or name == "manager":
+            raise AttributeError(name) # e.g. pickle looking for __setstate__ before manager is set
+        return getattr(self.manager, name)
+
+
+SELF_OR_ULTIMATE_TARGET_QUERY = """UNWIND $uris AS uri
+                                    MATCH (n: Resource {uri: uri})
+                                    RETURN uri, n"""
+
+NODES_BY_URI_QUERY = SELF_OR_ULTIMATE_TARGET_QUERY # same lookup, but callers don't follow merges
+
+# Only organizations with precomputed stats and no extra labels, anything else is built from the node
+ORGANIZATION_RECORDS_QUERY = """UNWIND $uris AS uri
+                                MATCH (n: Resource&Organization {uri: uri})
+                                WHERE SIZE(LABELS(n)) = 2
+                                AND n.internalMergedSameAsHighToUri IS NULL
+                                AND n.internalBestName IS NOT NULL
+                                AND n.internalIndustryUris IS NOT NULL
+                                AND n.internalSumOfWeights IS NOT NULL
+                                OPTIONAL MATCH (i: Resource&IndustryCluster) WHERE i.uri IN n.internalIndustryUris
+                                WITH n, COLLECT(i.representativeDoc) AS industry_docs
+                                RETURN n.uri, n.name, n.internalBestName, n.description, n.basedInHighRaw,
+                                    n.basedInHighClean, n.internalSumOfWeights, industry_docs"""
+
 class WeightedRel(StructuredRel):
     weight = IntegerProperty(default=1)
 
@@ -52,15 +156,42 @@ class Resource(StructuredNode):
     sameAsNameOnly = Relationship('Resource','sameAsNameOnly', model=WeightedRel)
     sameAsHigh = Relationship('Resource','sameAsHigh', model=WeightedRel)
     internalMergedSameAsHighToUri = StringProperty()
+    internalSumOfWeights = IntegerProperty() # set by RDFPostProcessor.precompute_organization_stats
+    internalSameAsNameOnlyComponentId = StringProperty() # set by RDFPostProcessor.precompute_same_as_name_only_components
+    internalSameAsNameOnlyRepresentativeUri = StringProperty() # ditto
+    internalSameAsNameOnlyArticleCount = IntegerProperty() # ditto, for the whole group
+
+    @property
+    def same_as_name_only_key(self):
+        '''
+            The same for every node in a sameAsNameOnly group, otherwise unique to this node
+        '''
+        return self.internalSameAsNameOnlyComponentId or self.uri
+
+    def same_as_name_only_members(self):
+        '''
+            The other unmerged nodes in this node's sameAsNameOnly group
+        '''
+        if self.internalSameAsNameOnlyComponentId is None:
+            return []
+        query = """MATCH (n: Resource {internalSameAsNameOnlyComponentId: $component_id})
+                   WHERE n.uri <> $uri AND n.internalMergedSameAsHighToUri IS NULL
+                   RETURN n"""
+        vals, _ = run_query("same_as_name_only_members", query,
+                            {"component_id": self.internalSameAsNameOnlyComponentId, "uri": self.uri},
+                            resolve_objects=True)
+        return [remember(x[0]) for x in vals]
 
     @property
     def sum_of_weights(self):
+        if self.internalSumOfWeights is not None:
+            return self.internalSumOfWeights
         cache_key = cache_friendly(f"sum_weights_{self.uri}")
         weight = cache.get(cache_key)
         if weight:
             return weight
-        query = f"""MATCH (n: Resource {{uri:'{self.uri}'}})-[x]-() RETURN sum(x.weight)"""
-        res, _ = db.cypher_query(query)
+        query = """MATCH (n: Resource {uri: $uri})-[x]-() RETURN sum(x.weight)"""
+        res, _ = run_query("sum_of_weights", query, {"uri": self.uri})
         weight = res[0][0]
         cache.set(cache_key, weight)
         return weight
@@ -78,28 +209,42 @@ class Resource(StructuredNode):
         return None # override in subclass
 
     @property
-    def related_articles(self):
-        cache_key = cache_friendly(f"{self.uri}_related_articles")
-        arts = cache.get(cache_key)
-        if arts is not None:
-            return arts
-        if isinstance(self, Article) is True or isinstance(self, IndustryCluster) is True:
-            arts = None
-        else:
+    def article_metadata(self):
+        '''
+            (source_mask, min_date_ordinal, max_date_ordinal) for the articles this node came from, see topics.article_index
+        '''
+        res = self.__dict__.get("_article_metadata")
+        if res is None:
+            res = article_metadata(self.uri)
+        if res is None:
             arts = self.documentSource.all()
-        cache.set(cache_key,arts)
-        return arts
-    
+            res = store_article_metadata(self.uri, [x.sourceOrganization for x in arts],
+                                         [x.datePublished for x in arts])
+        self.__dict__["_article_metadata"] = res
+        return res
+
+    @staticmethod
+    def prefetch_article_metadata(nodes):
+        '''
+            Reads article_metadata for all of nodes with one HMGET, rather than one HGET each when they're filtered
+        '''
+        nodes = [x for x in nodes if x is not None and "_article_metadata" not in x.__dict__
+                 and not isinstance(x, (Article, IndustryCluster))]
+        for node, res in zip(nodes, articles_metadata([x.uri for x in nodes])):
+            if res is not None:
+                node.__dict__["_article_metadata"] = res
+        return nodes
+
     def has_permitted_document_source(self,source_names):
         if isinstance(self, IndustryCluster):
             # Industry Clusters are always legitimate to show because they didn't come from specific articles
             return True 
         if hasattr(self, "sourceOrganization") and self.sourceOrganization in source_names:
             return True
-        for x in self.related_articles or []:
-            if x.sourceOrganization in source_names:
-                return True
-        return False
+        if isinstance(self, Article):
+            return False
+        mask, _, _ = self.article_metadata
+        return mask & source_mask(source_names) != 0
     
     def is_recent_enough(self, min_date):
         if isinstance(self, IndustryCluster):
@@ -109,10 +254,8 @@ class Resource(StructuredNode):
                 return True
             else:       
                 return False
-        for x in self.related_articles or []:
-            if x.datePublished.date() >= min_date:
-                return True
-        return False
+        _, _, max_date_ordinal = self.article_metadata
+        return max_date_ordinal >= min_date.toordinal()
 
     @staticmethod
     def get_by_uri(uri):
@@ -130,21 +273,31 @@ class Resource(StructuredNode):
 
     @classmethod
     def randomized_active_nodes(cls,limit=10,min_date=BEGINNING_OF_TIME):
-        cache_key = "randomized_nodes"
+        '''
+            Sampled from the pools built by topics.random_active_nodes, so a different selection each time.
+            Falls back to querying (and caching) if there isn't a pool for this class and min_date
+        '''
+        uri_counts = sample_random_active_nodes(cls.__name__, limit, min_date)
+        if uri_counts is not None:
+            records = Organization.records([x[0] for x in uri_counts])
+            return [(record, cnt) for record, (_, cnt) in zip(records, uri_counts) if record is not None]
+        cache_key = cache_friendly(f"randomized_nodes_{cls.__name__}_{limit}_{min_date.isoformat()}")
         res = cache.get(cache_key)
         if res is not None:
             return res
         query = f"""MATCH (n: Resource&{cls.__name__})-[:documentSource]->(a: Resource&Article)
                     WHERE n.internalMergedSameAsHighToUri IS NULL
                     AND SIZE(LABELS(n)) = 2
-                    AND a.datePublished >= datetime('{date_to_cypher_friendly(min_date)}')
+                    AND a.datePublished >= datetime($min_date)
                     WITH n, count(a) as article_count
-                    RETURN n,article_count,rand() as r
+                    RETURN n.uri,article_count,rand() as r
                     ORDER BY r
-                    LIMIT {limit}"""
+                    LIMIT $limit"""
         logger.debug(query)
-        res,_ = db.cypher_query(query, resolve_objects=True)
-        vals = [(x[0],x[1]) for x in res]
+        res,_ = run_query(f"randomized_active_nodes_{cls.__name__}", query,
+                          {"min_date": date_to_cypher_friendly(min_date), "limit": limit})
+        records = Organization.records([x[0] for x in res])
+        vals = [(record, x[1]) for record, x in zip(records, res) if record is not None]
         cache.set(cache_key, vals)
         return vals
 
@@ -178,21 +331,185 @@ class Resource(StructuredNode):
     @staticmethod
     def self_or_ultimate_target_node(uri_or_object):
         if isinstance(uri_or_object, str):
-            r = Resource.nodes.get_or_none(uri=uri_or_object)
+            target_uri = ultimate_target_uris([uri_or_object]).get(uri_or_object)
+            r = Resource.nodes.get_or_none(uri=target_uri) if target_uri is not None else None
+            if r is None: # not merged, or the map is behind the graph (e.g. the target was deleted since it was built)
+                r = Resource.nodes.get_or_none(uri=uri_or_object)
         else:
             r = uri_or_object
         if r is None:
             return None
         elif r.internalMergedSameAsHighToUri is None:
             return r
-        else:
-            return Resource.self_or_ultimate_target_node(r.internalMergedSameAsHighToUri)
+        # Map can be behind the graph, so only trust it if it leads somewhere unmerged
+        target_uri = ultimate_target_uris([r.uri]).get(r.uri)
+        if target_uri is not None:
+            target = Resource.nodes.get_or_none(uri=target_uri)
+            if target is not None and target.internalMergedSameAsHighToUri is None:
+                return target
+        target = Resource.self_or_ultimate_target_node(r.internalMergedSameAsHighToUri)
+        return target if target is not None else r
+
+    @staticmethod
+    def nodes_by_uri(uris: List):
+        '''
+            dict of uri -> node for those of uris that exist, in one query. Merged nodes are returned as they are
+        '''
+        res = {}
+        to_load = []
+        for uri in dict.fromkeys(uris):
+            node = remembered(uri)
+            if node is None:
+                to_load.append(uri)
+            else:
+                res[uri] = node
+        if len(to_load) > 0:
+            vals, _ = run_query("nodes_by_uri", NODES_BY_URI_QUERY, {"uris": to_load}, resolve_objects=True)
+            for uri, node in vals:
+                res[uri] = remember(node)
+        return res
+
+    def __getstate__(self):
+        '''
+            Prefetched relationships (see prefetch) belong to the request, so the plain managers are pickled instead
+        '''
+        return {k: v.manager if isinstance(v, PrefetchedRelationship) else v for k, v in self.__dict__.items()
+                if k != "_article_metadata"} # belongs to the cache generation it was read from
+
+    @staticmethod
+    def self_or_ultimate_target_uris(uris: List):
+        '''
+            Final merged uri for each of uris (in the same order) from the merge target map, no Neo4j queries
+        '''
+        targets = ultimate_target_uris(uris)
+        return [targets.get(x, x) for x in uris]
+
+    @staticmethod
+    def prefetch(nodes, rel_keys: List):
+        '''
+            Loads the rel_keys relationships (e.g. ["documentSource", "sameAsHigh"]) for all of nodes in one query,
+            so that later reads of node.documentSource etc don't go back to Neo4j. Nodes that don't have
+            a relationship called rel_key are skipped.
+        '''
+        nodes = list({id(x): x for x in nodes if x is not None}.values())
+        groups = {} # (rel_key, pattern) -> list of nodes
+        for node in nodes:
+            for rel_key, rel in node.__all_relationships__:
+                if rel_key not in rel_keys or isinstance(node.__dict__[rel_key], PrefetchedRelationship):
+                    continue
+                definition = node.__dict__[rel_key].definition
+                rel_type = definition["relation_type"]
+                other_label = definition["node_class"].__label__
+                if isinstance(rel, RelationshipTo):
+                    pattern = f"(n)-[r:`{rel_type}`]->(o:`{other_label}`)"
+                elif isinstance(rel, RelationshipFrom):
+                    pattern = f"(n)<-[r:`{rel_type}`]-(o:`{other_label}`)"
+                else:
+                    pattern = f"(n)-[r:`{rel_type}`]-(o:`{other_label}`)"
+                groups.setdefault((rel_key, pattern), []).append(node)
+        if len(groups) == 0:
+            return nodes
+        subqueries = []
+        params = {}
+        groups = dict(sorted(groups.items(), key=lambda x: x[0])) # same relationships -> same query text
+        for idx, ((rel_key, pattern), group_nodes) in enumerate(groups.items()):
+            params[f"uris_{idx}"] = [x.uri for x in group_nodes]
+            subqueries.append(f"""UNWIND $uris_{idx} AS uri
+                                  MATCH (n: Resource {{uri: uri}})
+                                  MATCH {pattern}
+                                  RETURN {idx} AS grp, uri, o, r""")
+        query = " UNION ALL ".join(subqueries)
+        vals, _ = run_query(f"prefetch_{zlib.crc32(query.encode()):08x}", query, params, resolve_objects=True)
+        found = defaultdict(list)
+        for grp, uri, other, rel in vals:
+            found[(grp, uri)].append((remember(other), rel))
+        for idx, ((rel_key, _), group_nodes) in enumerate(groups.items()):
+            for node in group_nodes:
+                manager = node.__dict__[rel_key]
+                rel_model = manager.definition.get("model")
+                others = []
+                rels = {}
+                for other, rel in found[(idx, node.uri)]:
+                    if other not in others:
+                        others.append(other)
+                    if rel_model is not None and not isinstance(rel, rel_model):
+                        rel = rel_model.inflate(rel)
+                    rels[other.uri] = rel
+                node.__dict__[rel_key] = PrefetchedRelationship(manager, others, rels)
+        return nodes
 
     @staticmethod
     def self_or_ultimate_target_node_set(uris_or_objects: List):
-        items = [Resource.self_or_ultimate_target_node(x) for x  in uris_or_objects]
+        items = Resource.self_or_ultimate_target_nodes(uris_or_objects)
         return list(set(items))
 
+    @staticmethod
+    def self_or_ultimate_target_nodes(uris_or_objects: List):
+        '''
+            Bulk self_or_ultimate_target_node: returns nodes in the same order as uris_or_objects (None if not found).
+            Unmerged nodes are returned as they are, everything else is resolved through the merge target map
+            and loaded in one query, with another query per extra hop only if the map is behind the graph.
+            If a target has gone (e.g. deleted since the map was built) the requested node is used instead,
+            or the last node found on its merge chain.
+        '''
+        uris_or_objects = list(uris_or_objects)
+        res = [None] * len(uris_or_objects)
+        requested = {} # index in res -> uri asked for
+        fallback = {} # index in res -> last node found on the way, if the rest of the chain is missing
+        pending = {} # uri to look up -> indexes in res
+        for idx, x in enumerate(uris_or_objects):
+            if x is None:
+                continue
+            if isinstance(x, str):
+                x = remembered(x) or x
+            if isinstance(x, str):
+                uri = x
+            elif x.internalMergedSameAsHighToUri is None:
+                res[idx] = x
+                continue
+            else:
+                uri = x.uri
+                fallback[idx] = x
+            requested[idx] = uri
+            pending.setdefault(uri, []).append(idx)
+        targets = ultimate_target_uris(pending.keys())
+        current = {} # index in res -> uri to look up next on its chain
+        visited = {} # index in res -> uris already on its chain, so that loops are caught per chain
+        for uri, idxs in pending.items():
+            for idx in idxs:
+                current[idx] = targets.get(uri, uri)
+                visited[idx] = {current[idx]}
+        loaded = {} # uri -> node, or None if not found, shared by all chains so each uri is only queried once
+        while len(current) > 0:
+            to_query = set(current.values()) - loaded.keys()
+            if len(to_query) > 0:
+                vals, _ = run_query("self_or_ultimate_target_nodes", SELF_OR_ULTIMATE_TARGET_QUERY,
+                                    {"uris": list(to_query)}, resolve_objects=True)
+                loaded.update({uri: None for uri in to_query})
+                loaded.update({uri: node for uri, node in vals})
+            next_current = {}
+            for idx, uri in current.items():
+                node = loaded[uri]
+                if node is None:
+                    next_uri = requested[idx] # the map is stale, start again from what was asked for
+                elif node.internalMergedSameAsHighToUri is None:
+                    res[idx] = remember(node)
+                    continue
+                else:
+                    fallback[idx] = node
+                    next_uri = node.internalMergedSameAsHighToUri
+                if next_uri in visited[idx]:
+                    if node is not None:
+                        logger.warning(f"Merge chain from {requested[idx]} loops back to {next_uri}")
+                    continue
+                visited[idx].add(next_uri)
+                next_current[idx] = next_uri
+            current = next_current
+        for idx, node in fallback.items():
+            if res[idx] is None:
+                res[idx] = remember(node)
+        return res
+
     @property
     def sourceDocumentURL(self):
         return uri_from_related(self.documentURL)
@@ -217,69 +534,67 @@ class Resource(StructuredNode):
         if res is not None:
             logger.debug(f"From cache {cache_key}")
             return res
-        objs1 = cls.find_by_name_optional_same_as_onlies(name,combine_same_as_name_only,min_date)
-        if combine_same_as_name_only is True:
-            objs2 = cls.get_first_same_as_name_onlies(name,min_date)
-        else:
-            objs2 = []
-        objs = set(objs1 + objs2)
+        uri_counts = search_names(cls.__name__, name, combine_same_as_name_only, min_date)
+        if uri_counts is None:
+            objs1 = cls.find_by_name_optional_same_as_onlies(name,combine_same_as_name_only,min_date)
+            if combine_same_as_name_only is True:
+                objs2 = cls.get_first_same_as_name_onlies(name,min_date)
+            else:
+                objs2 = []
+            uri_counts = [(node.uri, cnt) for node, cnt in objs1 + objs2]
+        records = Organization.records([x[0] for x in uri_counts])
+        objs = set([(record, cnt) for record, (_, cnt) in zip(records, uri_counts) if record is not None])
         cache.set(cache_key, objs)
         return objs
 
     @classmethod
     def find_by_name_optional_same_as_onlies(cls, name, combine_same_as_name_only,min_date=BEGINNING_OF_TIME):
-        query = f'''CALL db.index.fulltext.queryNodes("resource_names", "{name}",{{ analyzer: "classic"}}) YIELD node as n
+        query = '''CALL db.index.fulltext.queryNodes("resource_names", $name,{ analyzer: "classic"}) YIELD node as n
                     WITH n
-                    WHERE "{cls.__name__}" IN LABELS(n)
+                    WHERE $label IN LABELS(n)
                     AND n.internalMergedSameAsHighToUri IS NULL 
                    '''
         if combine_same_as_name_only is True: # then exclude entries with same_as_name_only here, they will be added later
-            query = f"{query} AND NOT (n)-[:sameAsNameOnly]-() "
+            query = f"{query} AND n.internalSameAsNameOnlyComponentId IS NULL "
         query = f"""{query}  OPTIONAL MATCH (n)-[]-(a:Article)
-                    WHERE a.datePublished >= datetime('{date_to_cypher_friendly(min_date)}') """
+                    WHERE a.datePublished >= datetime($min_date) """
         query = query + " WITH n, count(a) as cnt_artices RETURN n, cnt_artices"
         logger.debug(query)
-        results, _ = db.cypher_query(query,resolve_objects=True)
+        results, _ = run_query(template_name("find_by_name", without_same_as_name_only=combine_same_as_name_only), query,
+                               {"name": name, "label": cls.__name__, "min_date": date_to_cypher_friendly(min_date)},
+                               resolve_objects=True)
         objs = [(x[0],x[1]) for x in results]
         return objs
 
     @classmethod
     def get_first_same_as_name_onlies(cls, name, min_date=BEGINNING_OF_TIME):
         '''
-            For any group of nodes connected by sameAsNameOnly return the one with smallest internalDocId
+            For any group of nodes connected by sameAsNameOnly return the one with smallest internalDocId,
+            with the article count for the whole group. Groups are precomputed by
+            RDFPostProcessor.precompute_same_as_name_only_components
         '''
-        class_name = cls.__name__
-        query = f"""CALL db.index.fulltext.queryNodes("resource_names", "{name}",{{ analyzer: "classic" }}) YIELD node as n
+        all_time = min_date == BEGINNING_OF_TIME
+        query = """CALL db.index.fulltext.queryNodes("resource_names", $name,{ analyzer: "classic" }) YIELD node as n
                     WITH n
-                    MATCH (n)-[:sameAsNameOnly]-(o: {class_name})
-                    WHERE "{class_name}" in LABELS(n)
+                    WHERE $label in LABELS(n)
                     AND n.internalMergedSameAsHighToUri IS NULL
-                    AND o.internalMergedSameAsHighToUri IS NULL
-                    AND n.internalDocId <= o.internalDocId
-                    OPTIONAL MATCH (a:Article)--(n)
-                    WHERE a.datePublished >= datetime('{date_to_cypher_friendly(min_date)}')
-                    OPTIONAL MATCH (a2:Article)--(o)
-                    WHERE a2.datePublished >= datetime('{date_to_cypher_friendly(min_date)}')
-                    WITH n, o, count(a) as cnt_articles, count(a2) as cnt_articles2
-                    RETURN n, o, cnt_articles, cnt_articles2 ORDER BY n.internalDocId"""
+                    AND n.internalSameAsNameOnlyComponentId IS NOT NULL
+                    WITH DISTINCT n.internalSameAsNameOnlyComponentId AS component_id,
+                        n.internalSameAsNameOnlyRepresentativeUri AS representative_uri
+                    MATCH (r: Resource {uri: representative_uri})
+                    """
+        if all_time is True:
+            query = query + " RETURN r, r.internalSameAsNameOnlyArticleCount"
+        else:
+            query = query + """ MATCH (m: Resource {internalSameAsNameOnlyComponentId: component_id})
+                    OPTIONAL MATCH (m)-[]-(a:Article)
+                    WHERE a.datePublished >= datetime($min_date)
+                    RETURN r, count(a)"""
         logger.debug(query)
-        results,_ = db.cypher_query(query, resolve_objects=True)
-        '''
-            n: desired value 
-            o: other sameAsNameOnly
-            cnt_articles 
-        '''
-        entities_to_keep = defaultdict(int)
-        seen_orgs = set()
-        for source_node, other_node, cnt_articles, cnt_articles2 in results:
-            logger.debug(f"{source_node.uri} ({cnt_articles}) <-> {other_node.uri} ({cnt_articles2})")
-            if source_node not in seen_orgs:
-                entities_to_keep[source_node] += cnt_articles 
-                seen_orgs.add(source_node)
-            if other_node not in seen_orgs:
-                entities_to_keep[source_node] += cnt_articles2
-                seen_orgs.add(other_node)
-        return list(entities_to_keep.items())
+        results,_ = run_query(template_name(f"first_same_as_name_onlies_{cls.__name__}", min_date=not all_time), query,
+                              {"name": name, "label": cls.__name__, "min_date": date_to_cypher_friendly(min_date)},
+                              resolve_objects=True)
+        return [(x[0], x[1] or 0) for x in results]
 
 
     @property
@@ -315,15 +630,7 @@ class Resource(StructuredNode):
         return {k:v for k,v in vals.items() if v is not None}
 
     def split_uri(self):
-        parsed_uri = urlparse(self.uri)
-        splitted_uri = parsed_uri.path.split("/") # first element is empty string because path starts with /
-        assert len(splitted_uri) == 4, f"Expected {self.uri} path to have exactly 3 parts but it has {len(splitted_uri)}"
-        return {
-            "domain": parsed_uri.netloc,
-            "path": splitted_uri[1],
-            "doc_id": splitted_uri[2],
-            "name": splitted_uri[3],
-        }
+        return split_uri(self.uri)
 
     def all_directional_relationships(self, **kwargs):
         '''
@@ -411,13 +718,13 @@ class Article(Resource):
     @staticmethod
     def available_source_names_dict():
         cache_key = "available_source_names"
-        sources = cache.get(cache_key)
+        sources = local_cache.get(cache_key)
         if sources is not None:
             return sources
-        res = db.cypher_query("MATCH (n: Resource:Article) RETURN DISTINCT(n.sourceOrganization)")
+        res = run_query("article_source_organizations", "MATCH (n: Resource:Article) RETURN DISTINCT(n.sourceOrganization)")
         sources = {x[0].lower():x[0] for x in res[0]}
         assert None not in sources, f"We have an Article with None sourceOrganization"
-        cache.set(cache_key,sources)
+        local_cache.set(cache_key,sources)
         return sources
     
     @staticmethod
@@ -516,9 +823,7 @@ class IndustryCluster(Resource):
         res = cache.get(cache_key)
         if res is not None:
             return res
-        res = []
-        for x in self.orgsPrimary:
-            res.append(Organization.self_or_ultimate_target_node(x))
+        res = Organization.self_or_ultimate_target_nodes(self.orgsPrimary)
         cache.set(cache_key, res)
         return res
 
@@ -553,13 +858,7 @@ class IndustryCluster(Resource):
 
     @property
     def longest_representative_doc(self):
-        docs = self.representativeDoc
-        if docs is None:
-            return None
-        val = sorted(docs,key=len)[-1]
-        mappings = {"ott software": "OTT Software"}
-        val = mappings.get(val.lower(),val)
-        return val
+        return longest_representative_doc(self.representativeDoc)
 
     @staticmethod
     def for_external_api():
@@ -589,7 +888,7 @@ class IndustryCluster(Resource):
     @staticmethod
     def leaf_keywords(ignore_cache=False):
         cache_key = "industry_leaf_keywords"
-        res = cache.get(cache_key)
+        res = local_cache.get(cache_key)
         if res is not None and ignore_cache is False:
             return res
         keywords = {}
@@ -600,19 +899,19 @@ class IndustryCluster(Resource):
                 if word not in keywords.keys():
                     keywords[word] = set()
                 keywords[word].add(idx)
-        cache.set(cache_key, keywords)
+        local_cache.set(cache_key, keywords)
         return keywords
 
     @staticmethod
     def top_node():
         query = "MATCH (n: IndustryCluster) WHERE NOT (n)<-[:childLeft|childRight]-(:IndustryCluster) AND n.topicId <> -1 return n"
-        results, _ = db.cypher_query(query,resolve_objects=True)
+        results, _ = run_query("industry_top_node", query, resolve_objects=True)
         return results[0][0]
 
     @staticmethod
     def leaf_nodes_only():
         query = "MATCH (n: IndustryCluster) WHERE NOT (n)-[:childLeft|childRight]->(:IndustryCluster) AND (n)-[:industryClusterPrimary]-() RETURN n"
-        results, _ = db.cypher_query(query,resolve_objects=True)
+        results, _ = run_query("industry_leaf_nodes", query, resolve_objects=True)
         flattened = [x for sublist in results for x in sublist]
         return flattened
 
@@ -640,7 +939,9 @@ class IndustryCluster(Resource):
         root = IndustryCluster.nodes.get_or_none(topicId=topic_id)
         if root is None:
             return []
-        descendant_uris,_ = db.cypher_query(f"MATCH (n: IndustryCluster {{uri:'{root.uri}'}})-[x:childLeft|childRight*..{max_depth}]->(o: IndustryCluster) return o.uri;")
+        # variable-length bounds can't be parameters, so max_depth stays in the text
+        query = f"MATCH (n: IndustryCluster {{uri: $uri}})-[x:childLeft|childRight*..{int(max_depth)}]->(o: IndustryCluster) return o.uri;"
+        descendant_uris,_ = run_query(f"industry_descendants_{int(max_depth)}", query, {"uri": root.uri})
         flattened = [x for sublist in descendant_uris for x in sublist]
         return [root.uri] + flattened
 
@@ -652,14 +953,14 @@ class IndustryCluster(Resource):
 
     @staticmethod
     def by_representative_doc_words(name, limit=10, min_score=0.85):
-        query = f''' CALL db.index.vector.queryNodes('industry_cluster_representative_docs_vec', 500, $query_embedding)
+        query = ''' CALL db.index.vector.queryNodes('industry_cluster_representative_docs_vec', 500, $query_embedding)
         YIELD node, score
         WITH node, score
-        WHERE score >= {min_score}
+        WHERE score >= $min_score
         RETURN node
         ORDER BY score DESCENDING
         '''
-        res = do_vector_search(name, query)
+        res = do_vector_search(name, query, params={"min_score": min_score}, name="industries_by_representative_doc_words")
         flattened = [x[0] for x in res]
         return flattened[:limit]
 
@@ -764,11 +1065,12 @@ class GeoNamesLocation(Resource):
         if res is not None:
             return res
         country_code, admin1_code = geo_to_country_admin1(geo_code)
-        query = f"""MATCH (n: GeoNamesLocation) WHERE n.countryCode = '{country_code}' """
+        query = """MATCH (n: GeoNamesLocation) WHERE n.countryCode = $country_code """
         if admin1_code is not None:
-            query = f"{query} AND n.admin1Code = '{admin1_code}'"
+            query = f"{query} AND n.admin1Code = $admin1_code"
         query = f"{query} RETURN n.uri"
-        vals, _ = db.cypher_query(query,resolve_objects=True)
+        vals, _ = run_query(template_name("geonames_uris_by_geo_code", admin1=admin1_code is not None), query,
+                            {"country_code": country_code, "admin1_code": admin1_code}, resolve_objects=True)
         uris = [x[0] for x in vals]
         cache.set(cache_key, uris)
         return uris
@@ -805,6 +1107,8 @@ class Organization(Resource):
     operations = RelationshipTo('OperationsActivity','hasOperationsActivity', model=WeightedRel)
     recognition = RelationshipTo('RecognitionActivity','hasRecognitionActivity', model=WeightedRel)
     regulatory = RelationshipTo('RegulatoryActivity','hasRegulatoryActivity', model=WeightedRel)
+    internalBestName = StringProperty() # set by RDFPostProcessor.precompute_organization_stats
+    internalIndustryUris = ArrayProperty(StringProperty()) # industry_list by popularity, ditto
 
     @property
     def industry_clusters(self):
@@ -842,16 +1146,15 @@ class Organization(Resource):
         res = cache.get(cache_key)
         if res is not None:
             return res
-        inds = self.industryClusterPrimary.all()
-        for x in self.sameAsHigh:
-            if hasattr(x, "industryClusterPrimary"):
-                inds.extend(x.industryClusterPrimary.all())
-        c = Counter(inds)
-        if c == []:
-            val = None
+        if self.internalIndustryUris is not None:
+            inds_by_uri = {x.uri: x for x in IndustryCluster.nodes.filter(uri__in=self.internalIndustryUris)}
+            val = [inds_by_uri[x] for x in self.internalIndustryUris if x in inds_by_uri]
         else:
-            by_popularity = c.most_common()
-            val = [x[0] for x in by_popularity]
+            inds = self.industryClusterPrimary.all()
+            for x in self.sameAsHigh:
+                if hasattr(x, "industryClusterPrimary"):
+                    inds.extend(x.industryClusterPrimary.all())
+            val = by_popularity(inds)
         cache.set(cache_key,val)
         return val
 
@@ -865,18 +1168,14 @@ class Organization(Resource):
     @property
     def industry_as_string(self):
         inds = self.industry_list
-        if inds is None or len(inds) == 0:
+        if inds is None:
             return None
-        sorted_inds = sorted([x.longest_representative_doc for x in inds])
-        top_inds = sorted_inds[:2]
-        top_inds_as_str = ", ".join(sorted(top_inds))
-        if len(sorted_inds) < 3:
-            return top_inds_as_str
-        other_ind_num = len(sorted_inds) - 2
-        return f"{top_inds_as_str} and {other_ind_num} more"
+        return industries_as_string([x.longest_representative_doc for x in inds])
 
     @property
     def best_name(self):
+        if self.internalBestName is not None:
+            return self.internalBestName
         cache_key = cache_friendly(f"org_name_{self.uri}")
         name = cache.get(cache_key)
         if name is not None:
@@ -885,8 +1184,7 @@ class Organization(Resource):
         for x in self.sameAsHigh:
             if x.name is not None:
                 name_cands.extend(x.name)
-        name_counter = Counter(name_cands)
-        top_name = name_counter.most_common(1)[0][0]
+        top_name = most_common_name(name_cands)
         cache.set(cache_key, top_name)
         return top_name
 
@@ -921,10 +1219,37 @@ class Organization(Resource):
                     }
         return {**vals,**org_vals}
 
+    @staticmethod
+    def records(uris_or_objects: List):
+        '''
+            NodeRecords for the nodes Resource.self_or_ultimate_target_nodes would return, in the same order
+            (None if not found). Organizations with precomputed stats come from one projection query,
+            so no other array properties or embeddings are loaded, anything else is built from its node.
+        '''
+        uris = [x if isinstance(x, str) else x.uri for x in uris_or_objects]
+        targets = ultimate_target_uris(uris)
+        target_uris = [targets.get(x, x) for x in uris]
+        vals, _ = run_query("organization_records", ORGANIZATION_RECORDS_QUERY, {"uris": sorted(set(target_uris))})
+        records = {}
+        for uri, name, best_name, description, based_in_high_raw, based_in_high_clean, sum_of_weights, industry_docs in vals:
+            values = {"entity_type": "Organization", "label": best_name, "name": name, "uri": uri,
+                      "best_name": best_name, "description": description,
+                      "industry": industries_as_string([longest_representative_doc(x) for x in industry_docs]),
+                      "based_in_high_raw": based_in_high_raw, "based_in_high_clean": based_in_high_clean}
+            records[uri] = NodeRecord(uri, values, sum_of_weights)
+        res = [records.get(x) for x in target_uris]
+        missing = [idx for idx, x in enumerate(res) if x is None]
+        # resolve from what was asked for rather than the mapped target, which may have gone since the map was built
+        for idx, node in zip(missing, Resource.self_or_ultimate_target_nodes([uris[idx] for idx in missing])):
+            if node is not None:
+                res[idx] = NodeRecord.from_node(node, node.sum_of_weights)
+        return res
+
     def get_role_activities(self,source_names=Article.core_sources()):
         role_activities = []
         for role in self.hasRole:
             acts = role.withRole.all()
+            Resource.prefetch_article_metadata(acts)
             role_activities.extend([(role,act) for act in acts if act.has_permitted_document_source(source_names)])
         return role_activities
 
@@ -950,22 +1275,24 @@ class Organization(Resource):
         where2 = None
         if industry_uris is not None:
             match1 = "(n: Organization)-[:industryClusterPrimary]-(i: IndustryCluster) "
-            where1 = f" i.uri IN {industry_uris} "
+            where1 = " i.uri IN $industry_uris "
         if geo_uris is not None:
             match2 = "(n: Organization)-[:basedInHighGeoNamesLocation]-(g: GeoNamesLocation) "
-            where2 = f" g.uri IN {geo_uris} "
+            where2 = " g.uri IN $geo_uris "
         if industry_uris is None and geo_uris is not None:
             query = f"MATCH {match2} WHERE {where2} AND n.internalMergedSameAsHighToUri IS NULL "
         elif industry_uris is not None and geo_uris is None:
             query = f"MATCH {match1} WHERE {where1} AND n.internalMergedSameAsHighToUri IS NULL "
         else:
             query = f"MATCH {match1}, {match2} WHERE {where1} AND {where2} AND n.internalMergedSameAsHighToUri IS NULL "
-        article_clause = f" OPTIONAL MATCH (a:Article)-[]-(n) WHERE a.datePublished >= datetime('{date_to_cypher_friendly(min_date)}') "
-        query = f"{query} {article_clause} WITH n, count(a) as cnt_articles RETURN n, cnt_articles "
-        if limit is not None:
-            query = f"{query} LIMIT {limit}"
+        article_clause = " OPTIONAL MATCH (a:Article)-[]-(n) WHERE a.datePublished >= datetime($min_date) "
+        query = f"{query} {article_clause} WITH n, count(a) as cnt_articles RETURN n, cnt_articles LIMIT $limit"
         logger.debug(query)
-        vals, _ = db.cypher_query(query, resolve_objects=True)
+        vals, _ = run_query(template_name("organization_by_industry_and_or_geo", industry=industry_uris is not None, geo=geo_uris is not None),
+                            query, {"industry_uris": industry_uris, "geo_uris": geo_uris,
+                                    "min_date": date_to_cypher_friendly(min_date),
+                                    "limit": limit if limit is not None else NO_LIMIT},
+                            resolve_objects=True)
         if uris_only is True:
             res = [x[0].uri for x in vals]
             if allowed_to_set_cache is True:
@@ -986,30 +1313,25 @@ class Organization(Resource):
         RETURN node.uri
         ORDER BY score DESCENDING
         '''
-        vals = do_vector_search(name, query)
-        res = set()
-        for val in vals:
-            res.add( Organization.self_or_ultimate_target_node(val[0]).uri)
-        return list(res)
+        vals = do_vector_search(name, query, name="organizations_by_industry_text")
+        return list(set(Resource.self_or_ultimate_target_uris([x[0] for x in vals])))
 
     @staticmethod
     def by_industry_text_and_geo(name,country_code,admin1_code=None):
-        query = f'''CALL db.index.vector.queryNodes('organization_industries_vec', 500, $query_embedding) 
+        query = '''CALL db.index.vector.queryNodes('organization_industries_vec', 500, $query_embedding) 
                     YIELD node, score
                     WITH node, score
                     WHERE score > 0.85
                     WITH node, score
                     MATCH (node)-[:basedInHighGeoNamesLocation]-(r: Resource&GeoNamesLocation)
-                    WHERE r.countryCode = '{country_code}'
+                    WHERE r.countryCode = $country_code
                     '''
         if admin1_code is not None:
-            query = f"{query} AND r.admin1Code = '{admin1_code}'"
+            query = f"{query} AND r.admin1Code = $admin1_code"
         query = f"{query} RETURN node.uri ORDER BY score DESCENDING"
-        vals = do_vector_search(name, query)
-        res = set()
-        for val in vals:
-            res.add( Organization.self_or_ultimate_target_node(val[0]).uri )
-        return list(res)
+        vals = do_vector_search(name, query, params={"country_code": country_code, "admin1_code": admin1_code},
+                                name=template_name("organizations_by_industry_text_and_geo", admin1=admin1_code is not None))
+        return list(set(Resource.self_or_ultimate_target_uris([x[0] for x in vals])))
 
 
 class CorporateFinanceActivity(ActivityMixin, Resource):
@@ -1101,8 +1423,8 @@ class RoleActivity(ActivityMixin, Resource):
             return f"{text.title()}: {self.longest_roleFoundName}"
 
     def related_orgs(self):
-        query = f"MATCH (n: RoleActivity {{uri:'{self.uri}'}})--(o: Role)--(p: Organization) RETURN p"
-        objs, _ = db.cypher_query(query,resolve_objects=True)
+        query = "MATCH (n: RoleActivity {uri: $uri})--(o: Role)--(p: Organization) RETURN p"
+        objs, _ = run_query("role_activity_related_orgs", query, {"uri": self.uri}, resolve_objects=True)
         flattened = [x for sublist in objs for x in sublist]
         return flattened
 
@@ -5,28 +5,39 @@
 from neomodel import db
 from neomodel.exceptions import NodeClassAlreadyDefined
 import logging
-from django.core.cache import cache
+from topics.local_cache import local_cache
 from .models import *
 logger = logging.getLogger(__name__)
 
-def get_multi_labels(ignore_cache=False):
+def get_multi_labels(ignore_cache=False, uris=None):
+    '''
+        If uris are provided only those nodes are checked and any new label combinations
+        are added to the cached list (so that new imports don't need a full scan)
+    '''
     cache_key = "multi_labels_resources"
-    if ignore_cache is False:
-        res = cache.get(cache_key)
-        if res is not None:
-            return res
-    query = "match (n: Resource) where size(labels(n)) > 2 return distinct labels(n)"
-    labels_arr, _ = db.cypher_query(query)
-    res = [x[0] for x in labels_arr]
-    cache.set(cache_key, res)
+    res = None
+    if ignore_cache is False or uris is not None:
+        res = local_cache.get(cache_key)
+    if res is not None and uris is None:
+        return res
+    if res is not None and uris is not None:
+        query = "unwind $uris as uri match (n: Resource {uri: uri}) where size(labels(n)) > 2 return distinct labels(n)"
+        labels_arr, _ = db.cypher_query(query, {"uris": list(uris)})
+        existing = set([tuple(sorted(x)) for x in res])
+        res = res + [x[0] for x in labels_arr if tuple(sorted(x[0])) not in existing]
+    else:
+        query = "match (n: Resource) where size(labels(n)) > 2 return distinct labels(n)"
+        labels_arr, _ = db.cypher_query(query)
+        res = [x[0] for x in labels_arr]
+    local_cache.set(cache_key, res)
     return res
 
-def add_dynamic_classes_for_multiple_labels(ignore_cache=False):
+def add_dynamic_classes_for_multiple_labels(ignore_cache=False, uris=None):
     classes = []
-    labels_list = get_multi_labels(ignore_cache=ignore_cache)
+    labels_list = get_multi_labels(ignore_cache=ignore_cache, uris=uris)
     for labels in labels_list:
         assert "Resource" in labels, f"Expected {labels} to include 'Resource'"
-        labels.remove("Resource")
+        labels = [x for x in labels if x != "Resource"] # labels_list is shared through local_cache, don't change it
         class_name = "".join(labels)
         parent_classes = tuple([globals()[x] for x in labels])
         logger.debug(f"Defining {class_name}")
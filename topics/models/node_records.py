@@ -0,0 +1,68 @@
+'''
+    Read-only records standing in for hydrated nodes on read paths (search results, random orgs, org tables).
+
+    A NodeRecord holds the uri, what the node's serialize() would return and optionally its sum_of_weights,
+    so it has no relationship managers, none of the array properties that aren't shown and never any embeddings.
+    That keeps them small in worker memory and when pickled into the cache. Organization.records loads them
+    with a projection query rather than RETURN n.
+'''
+
+from urllib.parse import urlparse
+
+
+def split_uri(uri):
+    parsed_uri = urlparse(uri)
+    splitted_uri = parsed_uri.path.split("/") # first element is empty string because path starts with /
+    assert len(splitted_uri) == 4, f"Expected {uri} path to have exactly 3 parts but it has {len(splitted_uri)}"
+    return {
+        "domain": parsed_uri.netloc,
+        "path": splitted_uri[1],
+        "doc_id": splitted_uri[2],
+        "name": splitted_uri[3],
+    }
+
+
+class NodeRecord(object):
+
+    __slots__ = ("uri", "values", "sum_of_weights")
+
+    def __init__(self, uri, values, sum_of_weights=None):
+        object.__setattr__(self, "uri", uri)
+        object.__setattr__(self, "values", values)
+        object.__setattr__(self, "sum_of_weights", sum_of_weights)
+
+    @classmethod
+    def from_node(cls, node, sum_of_weights=None):
+        return cls(node.uri, node.serialize(), sum_of_weights)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is read-only")
+
+    def __reduce__(self):
+        return (self.__class__, (self.uri, self.values, self.sum_of_weights))
+
+    def __hash__(self):
+        return hash(self.uri)
+
+    def __eq__(self, other):
+        return self.uri == getattr(other, "uri", None)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.entity_type} {self.uri}>"
+
+    @property
+    def entity_type(self):
+        return self.values.get("entity_type")
+
+    @property
+    def best_name(self):
+        return self.values.get("best_name", self.values.get("label"))
+
+    def serialize(self):
+        return dict(self.values)
+
+    def serialize_no_none(self):
+        return {k:v for k,v in self.values.items() if v is not None}
+
+    def split_uri(self):
+        return split_uri(self.uri)
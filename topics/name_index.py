@@ -0,0 +1,222 @@
+'''
+    In-process name index for Organization.find_by_name, so that the search box doesn't need the fulltext index.
+
+    Built after import from every unmerged Organization: normalised (cleanco-stripped) name tokens and their trigrams
+    point at the organization, which carries the sorted date ordinals of its articles so that counts for any
+    min_date are a bisect, and its precomputed sameAsNameOnly group. The index is pickled into Redis under the
+    cache generation being built; each process loads it once and reloads when the generation or version key changes.
+    A search that finds nothing here returns None and the caller falls back to the fulltext index.
+'''
+
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime
+import pickle
+import re
+import threading
+import time
+import zlib
+import cleanco
+from neomodel import db
+from topics.article_index import date_ordinal
+from topics.merge_targets import redis_client
+from topics.cache_generations import generation_key, active_generation
+from syracuse.settings import NAME_INDEX_CHECK_SECONDS
+import logging
+logger = logging.getLogger(__name__)
+
+NAME_INDEX_KEY = "name_index"
+NAME_INDEX_VERSION_KEY = "name_index_version"
+NAME_INDEX_LABEL = "Organization"
+TRIGRAM_THRESHOLD = 0.5
+
+UNMERGED_ORGANIZATIONS_QUERY = """MATCH (n: Resource&Organization)
+                                  WHERE n.uri > $after AND n.internalMergedSameAsHighToUri IS NULL
+                                  RETURN n.uri, n.name, n.internalSameAsNameOnlyComponentId, n.internalSameAsNameOnlyRepresentativeUri
+                                  ORDER BY n.uri LIMIT $limit"""
+
+ORGANIZATION_NAME_INDEX_INPUTS_QUERY = """UNWIND $uris AS uri
+                                          MATCH (n: Resource {uri: uri})
+                                          OPTIONAL MATCH (n)-[]-(a: Article)
+                                          RETURN n.uri, COLLECT(a.datePublished)"""
+
+
+def name_tokens(name):
+    lowered = name.lower()
+    base = cleanco.basename(lowered) or lowered # don't strip a name that is only a legal suffix down to nothing
+    return re.findall(r"[^\W_]+", base)
+
+
+def trigrams(tokens):
+    res = set()
+    for token in tokens:
+        padded = f"  {token} "
+        res.update(padded[idx:idx + 3] for idx in range(len(padded) - 2))
+    return res
+
+
+class NameIndex(object):
+    '''
+        rows are (uri, names, article_dates, same_as_name_only_component_id, same_as_name_only_representative_uri),
+        the last two being None for organizations that aren't in a sameAsNameOnly group
+    '''
+
+    def __init__(self, rows):
+        rows = list(rows)
+        self.uris = [x[0] for x in rows]
+        self.article_ordinals = [sorted(date_ordinal(d) for d in x[2] if d is not None) for x in rows]
+        self.component_ids = [x[3] for x in rows]
+        self.representative_uris = {x[3]: x[4] for x in rows if x[3] is not None}
+        self.component_members = defaultdict(list)
+        for idx, component_id in enumerate(self.component_ids):
+            if component_id is not None:
+                self.component_members[component_id].append(idx)
+        self.component_members = dict(self.component_members)
+        self.name_tokens = [] # per org, list of token lists, one per name
+        postings = defaultdict(set)
+        trigram_postings = defaultdict(set)
+        for idx, row in enumerate(rows):
+            org_tokens = [name_tokens(name) for name in (row[1] or []) if name]
+            self.name_tokens.append(org_tokens)
+            for tokens in org_tokens:
+                for token in tokens:
+                    postings[token].add(idx)
+                for trigram in trigrams(tokens):
+                    trigram_postings[trigram].add(idx)
+        self.tokens = sorted(postings.keys())
+        self.postings = {k: sorted(v) for k, v in postings.items()}
+        self.trigram_postings = {k: sorted(v) for k, v in trigram_postings.items()}
+
+    def __len__(self):
+        return len(self.uris)
+
+    def prefix_matches(self, prefix):
+        res = set()
+        for token in self.tokens[bisect_left(self.tokens, prefix):]:
+            if not token.startswith(prefix):
+                break
+            res.update(self.postings[token])
+        return res
+
+    def token_matches(self, tokens):
+        '''
+            Every token must match a name token exactly, apart from the last which can be a prefix (still typing)
+        '''
+        res = None
+        for token in tokens[:-1]:
+            matches = set(self.postings.get(token, []))
+            res = matches if res is None else res & matches
+            if len(res) == 0:
+                return res
+        last_matches = self.prefix_matches(tokens[-1])
+        return last_matches if res is None else res & last_matches
+
+    def trigram_matches(self, tokens, threshold=TRIGRAM_THRESHOLD):
+        query_trigrams = trigrams(tokens)
+        candidates = set()
+        for trigram in query_trigrams:
+            candidates.update(self.trigram_postings.get(trigram, []))
+        res = set()
+        for idx in candidates:
+            for org_tokens in self.name_tokens[idx]:
+                name_trigrams = trigrams(org_tokens)
+                if len(query_trigrams & name_trigrams) / len(query_trigrams | name_trigrams) >= threshold:
+                    res.add(idx)
+                    break
+        return res
+
+    def article_count(self, idx, min_date_ordinal):
+        ordinals = self.article_ordinals[idx]
+        return len(ordinals) - bisect_left(ordinals, min_date_ordinal)
+
+    def search(self, name, combine_same_as_name_only, min_date):
+        '''
+            List of (uri, article count) on the same basis as find_by_name, or None if nothing matches
+        '''
+        tokens = name_tokens(name)
+        if len(tokens) == 0:
+            return None
+        matches = self.token_matches(tokens)
+        if len(matches) == 0:
+            matches = self.trigram_matches(tokens)
+        if len(matches) == 0:
+            return None
+        min_date_ordinal = date_ordinal(min_date)
+        if combine_same_as_name_only is False:
+            return [(self.uris[idx], self.article_count(idx, min_date_ordinal)) for idx in matches]
+        res = [(self.uris[idx], self.article_count(idx, min_date_ordinal))
+                    for idx in matches if self.component_ids[idx] is None]
+        for component_id in set(self.component_ids[idx] for idx in matches) - {None}:
+            cnt = sum(self.article_count(idx, min_date_ordinal) for idx in self.component_members[component_id])
+            res.append((self.representative_uris[component_id], cnt))
+        return res
+
+
+def build_name_index(client=None, batch_size=10000):
+    if client is None:
+        client = redis_client()
+    rows = []
+    after = ""
+    while True:
+        vals, _ = db.cypher_query(UNMERGED_ORGANIZATIONS_QUERY, {"after": after, "limit": batch_size})
+        if len(vals) == 0:
+            break
+        after = vals[-1][0]
+        details, _ = db.cypher_query(ORGANIZATION_NAME_INDEX_INPUTS_QUERY, {"uris": [x[0] for x in vals]})
+        dates = dict(details)
+        for uri, names, component_id, representative_uri in vals:
+            rows.append((uri, names, dates[uri], component_id, representative_uri))
+    index = NameIndex(rows)
+    pipe = client.pipeline()
+    pipe.set(generation_key(NAME_INDEX_KEY), zlib.compress(pickle.dumps(index)))
+    pipe.set(generation_key(NAME_INDEX_VERSION_KEY), datetime.utcnow().isoformat())
+    pipe.execute()
+    forget_name_index()
+    logger.info(f"Built name index for {len(index)} organizations")
+    return len(index)
+
+
+_loaded = {"generation": None, "version": None, "index": None, "checked_at": 0}
+_lock = threading.Lock()
+
+
+def name_index(client=None):
+    '''
+        The current NameIndex, or None if one hasn't been built. Redis is asked for the version
+        at most every NAME_INDEX_CHECK_SECONDS
+    '''
+    with _lock:
+        now = time.monotonic()
+        generation = active_generation()
+        if generation == _loaded["generation"] and now - _loaded["checked_at"] < NAME_INDEX_CHECK_SECONDS:
+            return _loaded["index"]
+        _loaded["checked_at"] = now
+        if client is None:
+            client = redis_client()
+        version = client.get(generation_key(NAME_INDEX_VERSION_KEY, generation))
+        if generation != _loaded["generation"] or version != _loaded["version"]:
+            blob = client.get(generation_key(NAME_INDEX_KEY, generation)) if version is not None else None
+            _loaded["index"] = pickle.loads(zlib.decompress(blob)) if blob is not None else None
+            _loaded["generation"] = generation
+            _loaded["version"] = version
+        return _loaded["index"]
+
+
+def forget_name_index():
+    '''
+        Make this process check Redis on the next search rather than waiting for NAME_INDEX_CHECK_SECONDS
+    '''
+    with _lock:
+        _loaded["checked_at"] = 0
+
+
+def search_names(label, name, combine_same_as_name_only, min_date):
+    '''
+        List of (uri, article count), or None if the index can't answer and the fulltext index should be used
+    '''
+    if label != NAME_INDEX_LABEL:
+        return None
+    index = name_index()
+    if index is None:
+        return None
+    return index.search(name, combine_same_as_name_only, min_date)
@@ -0,0 +1,119 @@
+'''
+    Named, parameterised Cypher. Values always go in params so that each template has one query text
+    and Neo4j can reuse its plan; run_query also keeps a latency histogram per template name, which each
+    process logs every QUERY_LATENCY_LOG_SECONDS.
+
+    Optional clauses are handled by giving each combination of clauses its own name (see template_name),
+    rather than interpolating values into the text.
+'''
+
+from neomodel import db
+from bisect import bisect_left
+import threading
+import time
+from syracuse.settings import SLOW_QUERY_MS, QUERY_LATENCY_LOG_SECONDS
+import logging
+logger = logging.getLogger(__name__)
+
+# Cypher LIMIT can be a parameter, so "no limit" is just a very big one
+NO_LIMIT = 2 ** 62
+
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is everything slower than the last bucket
+        self.count = 0
+        self.total_ms = 0
+        self.max_ms = 0
+
+    def add(self, ms):
+        self.counts[bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, pct):
+        '''
+            Upper bound of the bucket that the pct-th percentile falls in
+        '''
+        if self.count == 0:
+            return None
+        threshold = self.count * pct / 100
+        running = 0
+        for idx, cnt in enumerate(self.counts):
+            running += cnt
+            if running >= threshold:
+                return self.buckets[idx] if idx < len(self.buckets) else self.max_ms
+        return self.max_ms
+
+    def as_dict(self):
+        return {"count": self.count,
+                "mean_ms": round(self.total_ms / self.count, 1) if self.count > 0 else None,
+                "p50_ms": self.percentile(50),
+                "p95_ms": self.percentile(95),
+                "max_ms": round(self.max_ms, 1),
+                "buckets": {f"<={le}" : cnt for le, cnt in zip(self.buckets + ["inf"], self.counts)}}
+
+
+_histograms = {}
+_query_texts = {}
+_lock = threading.Lock()
+_last_logged = time.monotonic()
+
+
+def template_name(base_name, **clauses):
+    '''
+        e.g. template_name("orgs", industry=True, country=False) -> "orgs[industry]"
+    '''
+    used = [k for k, v in clauses.items() if v]
+    if len(used) == 0:
+        return base_name
+    return f"{base_name}[{','.join(used)}]"
+
+
+def run_query(name, query, params=None, resolve_objects=False):
+    if params is None:
+        params = {}
+    with _lock:
+        previous_query = _query_texts.setdefault(name, query)
+    if previous_query != query:
+        logger.warning(f"Query text for template {name} has changed, are values being interpolated into it?")
+    t1 = time.perf_counter()
+    try:
+        return db.cypher_query(query, params, resolve_objects=resolve_objects)
+    finally:
+        ms = (time.perf_counter() - t1) * 1000
+        with _lock:
+            _histograms.setdefault(name, LatencyHistogram()).add(ms)
+        if ms > SLOW_QUERY_MS:
+            logger.warning(f"Slow query {name}: {ms:.0f}ms")
+        log_query_latencies_if_due()
+
+
+def query_latencies():
+    with _lock:
+        return {name: hist.as_dict() for name, hist in sorted(_histograms.items())}
+
+
+def log_query_latencies_if_due():
+    global _last_logged
+    if not QUERY_LATENCY_LOG_SECONDS:
+        return
+    now = time.monotonic()
+    with _lock:
+        if now - _last_logged < QUERY_LATENCY_LOG_SECONDS:
+            return
+        _last_logged = now
+    for name, latencies in query_latencies().items():
+        logger.info(f"Query latency {name}: count={latencies['count']} mean={latencies['mean_ms']}ms "
+                    f"p50<={latencies['p50_ms']}ms p95<={latencies['p95_ms']}ms max={latencies['max_ms']}ms")
+
+
+def reset_query_latencies():
+    with _lock:
+        _histograms.clear()
+        _query_texts.clear()
@@ -0,0 +1,154 @@
+'''
+    Pools of randomly chosen active nodes for the Index page, so that picking some doesn't need ORDER BY rand()
+    over every documentSource.
+
+    After import one scan fills a fixed-size reservoir per date window (RANDOM_ACTIVE_NODES_WINDOW_DAYS back from
+    the import date, plus all time). Each pool is a Redis set of "uri ordinal,ordinal,..." with the date ordinals
+    of the node's articles in that window, and each request samples it with SRANDMEMBER. A request uses the
+    narrowest window that starts on or before its min_date and counts articles since min_date from the ordinals.
+'''
+
+from bisect import bisect_left
+from datetime import date, timedelta
+import random
+from neomodel import db
+from topics.article_index import date_ordinal
+from topics.constants import BEGINNING_OF_TIME
+from topics.merge_targets import redis_client
+from topics.cache_generations import generation_key
+from syracuse.settings import RANDOM_ACTIVE_NODES_POOL_SIZE, RANDOM_ACTIVE_NODES_WINDOW_DAYS
+import logging
+logger = logging.getLogger(__name__)
+
+RANDOM_ACTIVE_NODES_LABELS = ["Organization"]
+ALL_TIME_WINDOW = "all"
+
+# SIZE(LABELS(n)) = 2 keeps to nodes that are only Resource and the label, as randomized_active_nodes always has
+UNMERGED_NODES_QUERY = """MATCH (n: Resource&{label})
+                          WHERE SIZE(LABELS(n)) = 2
+                          AND n.internalMergedSameAsHighToUri IS NULL
+                          AND n.uri > $after
+                          RETURN n.uri ORDER BY n.uri LIMIT $limit"""  # label is filled in with str.format
+
+ARTICLE_DATES_QUERY = """UNWIND $uris AS uri
+                         MATCH (n: Resource {uri: uri})-[:documentSource]->(a: Resource&Article)
+                         RETURN n.uri, COLLECT(a.datePublished)"""
+
+
+def pool_key(label, window):
+    return generation_key(f"random_active_nodes:{label}:{window}")
+
+
+def windows_key(label):
+    return generation_key(f"random_active_nodes_windows:{label}")
+
+
+def encode_pool_entry(uri, ordinals):
+    return f"{uri} {','.join(str(x) for x in ordinals)}"
+
+
+def decode_pool_entry(val):
+    uri, ordinals = val.rsplit(" ", 1)
+    return uri, [int(x) for x in ordinals.split(",")]
+
+
+def window_starts(as_of_date):
+    '''
+        dict of window name -> first date ordinal in that window
+    '''
+    res = {str(days): date_ordinal(as_of_date - timedelta(days=days)) for days in RANDOM_ACTIVE_NODES_WINDOW_DAYS}
+    res[ALL_TIME_WINDOW] = date_ordinal(BEGINNING_OF_TIME)
+    return res
+
+
+def choose_window(starts, min_date_ordinal):
+    '''
+        Name of the window with the latest start that is still on or before min_date_ordinal, or None
+    '''
+    candidates = [(start, window) for window, start in starts.items() if start <= min_date_ordinal]
+    if len(candidates) == 0:
+        return None
+    return max(candidates)[1]
+
+
+class Reservoir(object):
+    '''
+        Uniform sample of up to size items from a stream of unknown length (Algorithm R)
+    '''
+
+    def __init__(self, size, rng=None):
+        self.size = size
+        self.rng = rng or random.Random()
+        self.items = []
+        self.seen = 0
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+            return
+        idx = self.rng.randrange(self.seen)
+        if idx < self.size:
+            self.items[idx] = item
+
+
+def build_random_active_node_pools(client=None, as_of_date=None, batch_size=10000):
+    if client is None:
+        client = redis_client()
+    if as_of_date is None:
+        as_of_date = date.today()
+    starts = window_starts(as_of_date)
+    for label in RANDOM_ACTIVE_NODES_LABELS:
+        reservoirs = {window: Reservoir(RANDOM_ACTIVE_NODES_POOL_SIZE) for window in starts}
+        after = ""
+        while True:
+            vals, _ = db.cypher_query(UNMERGED_NODES_QUERY.format(label=label), {"after": after, "limit": batch_size})
+            if len(vals) == 0:
+                break
+            after = vals[-1][0]
+            rows, _ = db.cypher_query(ARTICLE_DATES_QUERY, {"uris": [x[0] for x in vals]})
+            for uri, dates in rows:
+                ordinals = sorted(date_ordinal(x) for x in dates if x is not None)
+                for window, start in starts.items():
+                    in_window = ordinals[bisect_left(ordinals, start):]
+                    if len(in_window) > 0:
+                        reservoirs[window].add(encode_pool_entry(uri, in_window))
+        for window, reservoir in reservoirs.items():
+            tmp_key = f"{pool_key(label, window)}_building"
+            client.delete(tmp_key)
+            if len(reservoir.items) > 0:
+                client.sadd(tmp_key, *reservoir.items)
+                client.rename(tmp_key, pool_key(label, window))
+            else:
+                client.delete(pool_key(label, window))
+            logger.info(f"Random active {label} pool for window {window}: {len(reservoir.items)} of {reservoir.seen}")
+        client.delete(windows_key(label))
+        client.hset(windows_key(label), mapping=starts)
+    return starts
+
+
+def sample_random_active_nodes(label, limit, min_date, client=None):
+    '''
+        Up to limit (uri, article count since min_date) chosen at random, or None if there is no pool to sample
+    '''
+    if client is None:
+        client = redis_client()
+    starts = {k.decode("utf-8"): int(v) for k, v in client.hgetall(windows_key(label)).items()}
+    min_date_ordinal = date_ordinal(min_date)
+    window = choose_window(starts, min_date_ordinal)
+    if window is None:
+        return None
+    key = pool_key(label, window)
+    if client.exists(key) == 0:
+        return None
+    # Oversample because some entries will only have articles between the window start and min_date
+    vals = client.srandmember(key, limit * 4)
+    res = []
+    for val in vals:
+        uri, ordinals = decode_pool_entry(val.decode("utf-8"))
+        cnt = len(ordinals) - bisect_left(ordinals, min_date_ordinal)
+        if cnt > 0:
+            res.append((uri, cnt))
+        if len(res) == limit:
+            break
+    return res
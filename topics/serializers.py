@@ -9,9 +9,9 @@ from .family_tree_helpers import org_family_tree
 from .constants import BEGINNING_OF_TIME, ALL_TIME_MAGIC_NUMBER
 from typing import Union, List
 from datetime import date, timedelta
-from django.core.cache import cache
 from .industry_geo import orgs_by_industry_and_or_geo, country_admin1_full_name, orgs_by_industry_text_and_geo_code
 from .util import elements_from_uri, cacheable_hash
+from .single_flight import get_or_compute
 
 import logging
 logger = logging.getLogger(__name__)
@@ -90,10 +90,11 @@ class FamilyTreeSerializer(serializers.BaseSerializer):
         earliest_doc_date = date_from_str_with_default(self.context.get("earliest_str"))
         source_names_as_hash = cacheable_hash(",".join(sorted(source_names)))
         cache_key=cache_friendly(f"familytree_{organization_uri}_{source_names_as_hash}_{combine_same_as_name_only}_{clean_rels}_{earliest_doc_date}")
-        res = cache.get(cache_key)
-        if res is not None:
-            logger.debug(f"Cache hit {cache_key}: {res}")
-            return res
+        return get_or_compute(cache_key, lambda: self.family_tree_representation(instance, combine_same_as_name_only,
+                                                                                 clean_rels, source_names, earliest_doc_date))
+
+    def family_tree_representation(self, instance, combine_same_as_name_only, clean_rels, source_names, earliest_doc_date):
+        organization_uri = instance.uri
         parents, parents_children, org_children = org_family_tree(organization_uri, 
                                                                   combine_same_as_name_only=combine_same_as_name_only,
                                                                   relationships=clean_rels,
@@ -138,8 +139,6 @@ class FamilyTreeSerializer(serializers.BaseSerializer):
             "document_sources": create_source_pretty_print_data(self.context.get("source_str")),
             "earliest_doc_date": create_earliest_date_pretty_print_data(self.context.get("earliest_str")),
         }
-        
-        cache.set(cache_key, res)
         return res
 
 
@@ -265,10 +264,10 @@ class OrganizationGraphSerializer(serializers.BaseSerializer):
         combine_same_as_name_only = self.context.get("combine_same_as_name_only")
         max_nodes = 50
         cache_key=cache_friendly(f"graph_{instance.uri}_{source_names_as_hash}_{combine_same_as_name_only}_{earliest_doc_date}")
-        res = cache.get(cache_key)
-        if res is not None:
-            logger.debug(f"Cache hit {cache_key}: {res}")
-            return res
+        return get_or_compute(cache_key, lambda: self.graph_representation(instance, source_names, earliest_doc_date,
+                                                                           combine_same_as_name_only, max_nodes))
+
+    def graph_representation(self, instance, source_names, earliest_doc_date, combine_same_as_name_only, max_nodes):
         graph_data = graph_centered_on(instance,source_names=source_names,
                                        min_date=earliest_doc_date,
                                        combine_same_as_name_only=combine_same_as_name_only,
@@ -296,7 +295,6 @@ class OrganizationGraphSerializer(serializers.BaseSerializer):
                 nodes_by_type[node_type] = []
             nodes_by_type[node_type].append(node_row['id'])
         data["nodes_by_type"] = nodes_by_type
-        cache.set(cache_key, data)
         return data
 
 
@@ -345,10 +343,10 @@ class OrganizationTimelineSerializer(serializers.BaseSerializer):
         earliest_doc_date = date_from_str_with_default(self.context.get("earliest_str"))
         source_names_as_hash = cacheable_hash(",".join(sorted(source_names)))
         cache_key=cache_friendly(f"timeline_{instance.uri}_{source_names_as_hash}_{combine_same_as_name_only}_{earliest_doc_date}")
-        res = cache.get(cache_key)
-        if res is not None:
-            logger.debug(f"Cache hit {cache_key}: {res}")
-            return res
+        return get_or_compute(cache_key, lambda: self.timeline_representation(instance, combine_same_as_name_only,
+                                                                              source_names, earliest_doc_date))
+
+    def timeline_representation(self, instance, combine_same_as_name_only, source_names, earliest_doc_date):
         groups, items, item_display_details, org_display_details = get_timeline_data(instance, combine_same_as_name_only, 
                                                                                      source_names, earliest_doc_date)
         resp = {"groups": groups, "items":items,
@@ -359,7 +357,6 @@ class OrganizationTimelineSerializer(serializers.BaseSerializer):
             "document_sources": create_source_pretty_print_data(self.context.get("source_str")),
             "earliest_doc_date": create_earliest_date_pretty_print_data(self.context.get("earliest_str")),
             }
-        cache.set(cache_key,resp)
         return resp
 
 class CountryRegionSerializer(serializers.Serializer):
@@ -454,9 +451,11 @@ class OrgsByIndustryGeoSerializer(serializers.BaseSerializer):
         
 def orgs_by_weight(org_uris):
     org_data = []
-    for uri in org_uris:
-        logger.info(uri)
-        o = Organization.get_by_uri(uri)
+    seen = set()
+    for o in Organization.records(org_uris):
+        if o is None or o.uri in seen: # two uris can be merged into the same organization
+            continue
+        seen.add(o.uri)
         weight = o.sum_of_weights
         name = o.best_name
         org_vals = {"uri":o.uri,"name":name,"sum_of_weights":weight}
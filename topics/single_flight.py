@@ -0,0 +1,83 @@
+'''
+    Cache get-or-compute for expensive pages (graph, timeline, family tree, activity lists), so that workers
+    that miss the same key at once don't all run the same traversal.
+
+    On a miss one worker takes a Redis lock named after the cache key and computes; the others wait up to
+    SINGLE_FLIGHT_WAIT_SECONDS for its result before giving up and computing themselves, so the wait plus one
+    computation has to fit inside the gunicorn worker timeout. With stale_after,
+    a value older than that is still returned while whichever worker gets the lock recomputes it.
+'''
+
+from collections import namedtuple
+import time
+from django.core.cache import cache
+from redis.exceptions import LockError
+from topics.merge_targets import redis_client
+from syracuse.settings import (SINGLE_FLIGHT_LOCK_SECONDS, SINGLE_FLIGHT_WAIT_SECONDS,
+                               CACHE_STALE_AFTER_SECONDS)
+import logging
+logger = logging.getLogger(__name__)
+
+SINGLE_FLIGHT_POLL_SECONDS = 0.1
+
+CachedValue = namedtuple("CachedValue", ["value", "computed_at"])
+
+
+def lock_name(cache_key):
+    return f"single_flight:{cache.make_key(cache_key)}" # make_key so that each cache generation has its own lock
+
+
+def unwrap(entry):
+    '''
+        (value, computed_at) for whatever is in the cache, computed_at None for values not set by this module
+    '''
+    if isinstance(entry, CachedValue):
+        return entry.value, entry.computed_at
+    return entry, None
+
+
+def compute_and_set(cache_key, compute):
+    value = compute()
+    cache.set(cache_key, CachedValue(value, time.time()))
+    return value
+
+
+def release(lock, cache_key):
+    try:
+        lock.release()
+    except LockError:
+        logger.warning(f"Lock for {cache_key} expired before it was released, consider raising SINGLE_FLIGHT_LOCK_SECONDS")
+
+
+def get_or_compute(cache_key, compute, stale_after=CACHE_STALE_AFTER_SECONDS, client=None):
+    '''
+        Cached value for cache_key, or compute() which is then cached. stale_after (seconds, 0 for never)
+        is how old a value can be before it's recomputed, while it's still returned to everyone else
+    '''
+    entry = cache.get(cache_key)
+    if entry is not None:
+        value, computed_at = unwrap(entry)
+        if not stale_after or computed_at is None or time.time() - computed_at < stale_after:
+            return value
+    if client is None:
+        client = redis_client()
+    lock = client.lock(lock_name(cache_key), timeout=SINGLE_FLIGHT_LOCK_SECONDS)
+    if lock.acquire(blocking=False):
+        try:
+            return compute_and_set(cache_key, compute)
+        finally:
+            release(lock, cache_key)
+    if entry is not None:
+        logger.debug(f"Returning stale {cache_key} while it is recomputed")
+        return value
+    deadline = time.monotonic() + SINGLE_FLIGHT_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        time.sleep(SINGLE_FLIGHT_POLL_SECONDS)
+        lock_held = client.exists(lock_name(cache_key)) > 0 # before the get, so a value set just before release isn't missed
+        entry = cache.get(cache_key)
+        if entry is not None:
+            return unwrap(entry)[0]
+        if not lock_held:
+            break # the other worker failed without setting anything
+    logger.info(f"Computing {cache_key} without the lock")
+    return compute_and_set(cache_key, compute)
@@ -26,11 +26,30 @@ from .serializers import (
 )
 from topics.industry_geo.orgs_by_industry_geo import (
     build_region_hierarchy, prepare_headers,
-    combined_industry_geo_results,
+    combined_industry_geo_results, industry_geo_cache_key, industry_geo_key_space,
 )
 from topics.industry_geo.hierarchy_utils import filtered_hierarchy, hierarchy_widths
 from topics.cache_helpers import refresh_geo_data, nuke_cache
 from topics.industry_geo import orgs_by_industry_and_or_geo
+from topics.merge_targets import compress_merge_chains, ultimate_target_uris, MERGE_TARGETS_KEY
+from topics.query_templates import (LatencyHistogram, template_name, query_latencies, log_query_latencies_if_due,
+                                    reset_query_latencies)
+import topics.query_templates as query_templates
+from topics.article_index import article_metadata, decode_article_metadata, encode_article_metadata, source_mask
+import topics.article_index as article_index
+from topics.models.identity_map import request_scope
+from topics.name_index import NameIndex
+from topics.random_active_nodes import Reservoir, choose_window, encode_pool_entry, decode_pool_entry
+import random
+from topics.models.models import PrefetchedRelationship
+from topics.models.node_records import NodeRecord
+from topics.cache_generations import new_cache_generation, current_generation, generation_key
+from topics.local_cache import LocalCache
+from topics.single_flight import get_or_compute, lock_name, CachedValue
+from topics.merge_targets import redis_client
+from topics.industry_geo.org_index import IndustryGeoOrgIndex
+from django.core.cache import cache
+import pickle
 from topics.views import remove_not_needed_admin1s_from_individual_cells
 from dump.embeddings.embedding_utils import apply_latest_org_embeddings
 
@@ -42,6 +61,11 @@ if os.environ.get(env_var) != "Y":
     print(f"Set env var {env_var}=Y to confirm you want to drop Neo4j database")
     exit(0)
 
+class NoRedisClient(object):
+    def __getattr__(self, name):
+        raise AssertionError(f"Unexpected Redis call {name}")
+
+
 class TestUtilsWithDumpData(TestCase):
 
     def setUpTestData():
@@ -77,6 +101,147 @@ class TestUtilsWithDumpData(TestCase):
         geo = GeoSerializer(data={"country_or_region":"United Kingdom of Great Britain and Northern Ireland"})
         assert geo.get_country_or_region_id() == 'GB'
 
+    def test_merge_target_map_matches_graph(self):
+        vals, _ = db.cypher_query("MATCH (n: Resource) WHERE n.internalMergedSameAsHighToUri IS NOT NULL RETURN n.uri LIMIT 20")
+        uris = [x[0] for x in vals]
+        assert len(uris) > 0
+        targets = ultimate_target_uris(uris)
+        for uri in uris:
+            node = Resource.nodes.get(uri=uri)
+            while node.internalMergedSameAsHighToUri is not None:
+                node = Resource.nodes.get(uri=node.internalMergedSameAsHighToUri)
+            assert targets[uri] == node.uri
+        assert Resource.self_or_ultimate_target_uris(uris + ["https://1145.am/db/0/not_merged"]) == [targets[x] for x in uris] + ["https://1145.am/db/0/not_merged"]
+
+    def test_bulk_self_or_ultimate_target_nodes_keeps_input_order(self):
+        vals, _ = db.cypher_query("MATCH (n: Resource&Organization) WHERE n.internalMergedSameAsHighToUri IS NOT NULL RETURN n.uri LIMIT 5")
+        merged_uris = [x[0] for x in vals]
+        vals, _ = db.cypher_query("MATCH (n: Resource&Organization) WHERE n.internalMergedSameAsHighToUri IS NULL RETURN n.uri LIMIT 5")
+        unmerged_uris = [x[0] for x in vals]
+        assert len(merged_uris) > 0 and len(unmerged_uris) > 0
+        merged_node = Resource.nodes.get(uri=merged_uris[0])
+        items = [merged_node] + unmerged_uris + ["https://1145.am/db/0/not_there"] + merged_uris
+        res = Resource.self_or_ultimate_target_nodes(items)
+        assert len(res) == len(items)
+        assert res[len(unmerged_uris) + 1] is None
+        expected = [Resource.self_or_ultimate_target_node(x) for x in items]
+        assert [x.uri if x else None for x in res] == [x.uri if x else None for x in expected]
+        assert all([x.internalMergedSameAsHighToUri is None for x in res if x is not None])
+
+    def test_bulk_self_or_ultimate_target_nodes_with_stale_map_and_convergent_chains(self):
+        vals, _ = db.cypher_query("""MATCH (a: Resource&Organization) WHERE a.internalMergedSameAsHighToUri IS NOT NULL
+                                     MATCH (b: Resource&Organization {uri: a.internalMergedSameAsHighToUri})
+                                     WHERE b.internalMergedSameAsHighToUri IS NULL
+                                     RETURN a.uri, b.uri LIMIT 1""")
+        assert len(vals) > 0
+        uri_a, uri_b = vals[0]
+        key = generation_key(MERGE_TARGETS_KEY)
+        before = ultimate_target_uris([uri_a])[uri_a]
+        redis_client().hset(key, uri_a, "https://1145.am/db/0/deleted_since_map_was_built")
+        try:
+            res = Resource.self_or_ultimate_target_nodes([uri_a, uri_b, Resource.nodes.get(uri=uri_a)])
+        finally:
+            redis_client().hset(key, uri_a, before)
+        assert [x.uri for x in res] == [uri_b, uri_b, uri_b] # A -> B isn't a loop just because B was asked for too
+
+    def test_precomputed_organization_stats_match_lazy_values(self):
+        orgs = Organization.nodes.filter(internalMergedSameAsHighToUri__isnull=True, internalBestName__isnull=False)[:10]
+        assert len(orgs) > 0
+        for org in orgs:
+            res, _ = db.cypher_query(f"MATCH (n: Resource {{uri:'{org.uri}'}})-[x]-() RETURN sum(x.weight)")
+            assert org.sum_of_weights == res[0][0]
+            name_cands = list(org.name or [])
+            for x in org.sameAsHigh:
+                name_cands.extend(x.name or [])
+            assert org.best_name in name_cands
+            inds = set(org.industryClusterPrimary.all())
+            for x in org.sameAsHigh:
+                inds.update(x.industryClusterPrimary.all())
+            assert set(org.industry_list) == inds
+
+    def test_organization_records_match_serialized_nodes(self):
+        orgs = Organization.nodes.filter(internalMergedSameAsHighToUri__isnull=True, internalBestName__isnull=False)[:10]
+        assert len(orgs) > 0
+        records = Organization.records(orgs)
+        for org, record in zip(orgs, records):
+            assert record.uri == org.uri
+            assert record.serialize() == org.serialize()
+            assert record.sum_of_weights == org.sum_of_weights
+        assert Organization.records(["https://1145.am/db/0/not_there"]) == [None]
+
+    def test_same_as_name_only_members_include_neighbours(self):
+        query = """MATCH (n: Resource&Organization)-[:sameAsNameOnly]-(o: Resource&Organization)
+                   WHERE n.internalMergedSameAsHighToUri IS NULL AND o.internalMergedSameAsHighToUri IS NULL
+                   RETURN n.uri, COLLECT(DISTINCT o.uri) LIMIT 10"""
+        vals, _ = db.cypher_query(query)
+        assert len(vals) > 0
+        for uri, neighbour_uris in vals:
+            org = Organization.self_or_ultimate_target_node(uri)
+            member_uris = set([x.uri for x in org.same_as_name_only_members()])
+            assert set(neighbour_uris) <= member_uris
+            assert uri not in member_uris
+            representative = Organization.self_or_ultimate_target_node(org.internalSameAsNameOnlyRepresentativeUri)
+            assert representative.same_as_name_only_key == org.same_as_name_only_key
+
+    def test_prefetch_matches_relationship_managers(self):
+        source_uri = "https://1145.am/db/3558745/Jb_Hunt"
+        with request_scope():
+            o = Organization.self_or_ultimate_target_node(source_uri)
+            expected_buyer = set(o.buyer.all())
+            expected_docs = set(o.documentSource.all())
+            Resource.prefetch([o], ["buyer", "documentSource", "notARelationship"])
+            assert isinstance(o.buyer, PrefetchedRelationship)
+            assert set(o.buyer) == expected_buyer
+            assert set(o.documentSource.all()) == expected_docs
+            doc = o.documentSource[0]
+            assert o.documentSource.relationship(doc).weight >= 1
+            assert o.documentSource.order_by("datePublished")[0] == o.earliestDocumentSource
+            assert Resource.self_or_ultimate_target_nodes([o.buyer[0].uri])[0] is o.buyer[0] # same object within request
+            unpickled = pickle.loads(pickle.dumps(o))
+            assert not isinstance(unpickled.buyer, PrefetchedRelationship) # prefetched data stays out of the cache
+            assert set(unpickled.buyer.all()) == expected_buyer
+
+    def test_nodes_by_uri_does_not_follow_merges(self):
+        merged = Resource.nodes.filter(internalMergedSameAsHighToUri__isnull=False)[0]
+        nodes = Resource.nodes_by_uri([merged.uri, "https://1145.am/db/not_a_node"])
+        assert list(nodes.keys()) == [merged.uri]
+        assert nodes[merged.uri].internalMergedSameAsHighToUri == merged.internalMergedSameAsHighToUri
+
+    def test_article_index_matches_document_sources(self):
+        orgs = Organization.nodes.filter(internalMergedSameAsHighToUri__isnull=True)[:10]
+        for org in orgs:
+            arts = org.documentSource.all()
+            assert article_metadata(org.uri) is not None
+            for source_names in [Article.core_sources(), ["Not a real source"], [arts[0].sourceOrganization]]:
+                expected = any([x.sourceOrganization in source_names for x in arts])
+                assert org.has_permitted_document_source(source_names) == expected
+            latest = max([x.datePublished.date() for x in arts])
+            assert org.is_recent_enough(latest) is True
+            assert org.is_recent_enough(date.fromordinal(latest.toordinal() + 1)) is False
+
+    def test_source_mask_and_prefetched_metadata_stay_out_of_redis(self):
+        orgs = Organization.nodes.filter(internalMergedSameAsHighToUri__isnull=True)[:10]
+        source_names = Article.core_sources() + ["Not a real source"]
+        mask = source_mask(source_names)
+        assert source_mask(source_names, client=NoRedisClient()) == mask # codes and misses are remembered
+        article_index._known["generation"] = -1 # as if another process had flushed and rebuilt the cache
+        with self.assertRaises(AssertionError):
+            source_mask(source_names, client=NoRedisClient()) # codes may have been given out again so are refetched
+        assert source_mask(source_names) == mask
+        Resource.prefetch_article_metadata(orgs)
+        assert all(["_article_metadata" in x.__dict__ for x in orgs])
+        permitted = [x.has_permitted_document_source(source_names) for x in orgs]
+        assert permitted == [article_metadata(x.uri)[0] & mask != 0 for x in orgs]
+
+    def test_encodes_article_metadata(self):
+        assert decode_article_metadata(encode_article_metadata(2**70 + 5, 738000, 739000)) == (2**70 + 5, 738000, 739000)
+
+    def test_parameterised_queries_record_latencies(self):
+        Organization.by_industry_and_or_geo(None, "US-CA", allowed_to_set_cache=False)
+        Organization.by_industry_and_or_geo(None, "GB", allowed_to_set_cache=False)
+        latencies = query_latencies()
+        assert latencies["organization_by_industry_and_or_geo[geo]"]["count"] >= 1
+
     def test_corp_fin_graph_nodes(self):
         source_uri = "https://1145.am/db/3558745/Jb_Hunt"
         o = Organization.self_or_ultimate_target_node(source_uri)
@@ -921,6 +1086,196 @@ class TestUtilsWithDumpData(TestCase):
         assert primary['organizations'][0]['uri'] == 'https://1145.am/db/3457045/Haines_Direct'
         assert len(secondary['organizations']) == 0
 
+class TestMergeTargets(TestCase):
+
+    def test_compresses_merge_chains(self):
+        merged_to = {"https://1145.am/db/1/a": "https://1145.am/db/2/b",
+                     "https://1145.am/db/2/b": "https://1145.am/db/3/c",
+                     "https://1145.am/db/4/d": "https://1145.am/db/3/c"}
+        res = compress_merge_chains(merged_to)
+        assert res == {"https://1145.am/db/1/a": "https://1145.am/db/3/c",
+                       "https://1145.am/db/2/b": "https://1145.am/db/3/c",
+                       "https://1145.am/db/4/d": "https://1145.am/db/3/c"}
+
+    def test_compresses_merge_chains_with_loop(self):
+        res = compress_merge_chains({"a": "b", "b": "a"})
+        assert set(res.keys()) == {"a","b"}
+
+
+class TestQueryLatency(TestCase):
+
+    def test_latency_histogram_percentiles(self):
+        hist = LatencyHistogram()
+        for ms in [0.5, 3, 3, 40, 20000]:
+            hist.add(ms)
+        vals = hist.as_dict()
+        assert vals["count"] == 5
+        assert vals["p50_ms"] == 5
+        assert vals["max_ms"] == 20000
+        assert vals["buckets"]["<=inf"] == 1
+        assert template_name("orgs", industry=True, country=False, admin1=True) == "orgs[industry,admin1]"
+
+    def test_logs_query_latencies_when_due(self):
+        reset_query_latencies()
+        query_templates._histograms["orgs[industry]"] = LatencyHistogram()
+        query_templates._histograms["orgs[industry]"].add(3)
+        query_templates._last_logged = time.monotonic() - query_templates.QUERY_LATENCY_LOG_SECONDS - 1
+        with self.assertLogs("topics.query_templates", level="INFO") as logs:
+            log_query_latencies_if_due()
+        assert len(logs.output) == 1
+        assert "orgs[industry]: count=1" in logs.output[0]
+        with self.assertNoLogs("topics.query_templates", level="INFO"):
+            log_query_latencies_if_due() # not due again yet
+        reset_query_latencies()
+
+
+class TestNameIndex(TestCase):
+
+    def test_name_index_search(self):
+        new_date, old_date = date(2024,1,1), date(2020,1,1)
+        index = NameIndex([("foo_new", ["Foo Industries"], [new_date], None, None),
+                           ("foo_old", ["Foo Old"], [old_date], None, None),
+                           ("same_one", ["Same One"], [new_date], "same_one", "same_one"),
+                           ("same_two", ["Same Two"], [new_date], "same_one", "same_one"),
+                           ("same_three", ["Same Three"], [old_date], "same_one", "same_one")])
+        min_date = date(2023,1,1)
+        assert sorted(index.search("foo", True, min_date)) == [("foo_new",1),("foo_old",0)]
+        assert index.search("foo indus", True, min_date) == [("foo_new",1)] # prefix on last token
+        assert index.search("fooo industries", True, min_date) == [("foo_new",1)] # trigrams
+        assert index.search("same two", True, min_date) == [("same_one",2)] # whole group under its representative
+        assert sorted(index.search("same", False, min_date)) == [("same_one",1),("same_three",0),("same_two",1)]
+        assert index.search("zzz", True, min_date) is None
+
+
+class TestRandomActiveNodes(TestCase):
+
+    def test_reservoir_and_windows(self):
+        reservoir = Reservoir(10, rng=random.Random(42))
+        for x in range(1000):
+            reservoir.add(x)
+        assert len(reservoir.items) == 10
+        assert len(set(reservoir.items)) == 10
+        assert reservoir.seen == 1000
+        assert max(reservoir.items) > 100 # not just the first ones seen
+        starts = {"730": 1000, "all": 1}
+        assert choose_window(starts, 1200) == "730"
+        assert choose_window(starts, 900) == "all"
+        assert choose_window({"730": 1000}, 900) is None
+        assert decode_pool_entry(encode_pool_entry("https://1145.am/db/1/a", [5,7])) == ("https://1145.am/db/1/a", [5,7])
+
+
+class TestNodeRecord(TestCase):
+
+    def test_node_record_is_read_only_and_pickles(self):
+        values = {"entity_type": "Organization", "label": "Foo Inc", "name": ["Foo Inc"], "uri": "https://1145.am/db/1/Foo_Inc",
+                  "best_name": "Foo Inc", "description": None}
+        record = NodeRecord("https://1145.am/db/1/Foo_Inc", values, 12)
+        with self.assertRaises(AttributeError):
+            record.uri = "https://1145.am/db/2/Bar"
+        restored = pickle.loads(pickle.dumps(record))
+        assert restored == record
+        assert restored.sum_of_weights == 12
+        assert restored.best_name == "Foo Inc"
+        assert "description" not in restored.serialize_no_none()
+        assert restored.split_uri()["doc_id"] == "1"
+        assert len({record, restored}) == 1
+
+
+class TestCacheGenerations(TestCase):
+
+    def test_cache_generation_switches_when_published(self):
+        cache.set("generation_test_key", "old")
+        before = current_generation()
+        with new_cache_generation() as generation:
+            assert generation > before
+            assert cache.get("generation_test_key") is None
+            cache.set("generation_test_key", "new")
+        assert current_generation() == generation
+        assert cache.get("generation_test_key") == "new"
+
+    def test_cache_generation_not_published_on_error(self):
+        before = current_generation()
+        with self.assertRaises(ValueError):
+            with new_cache_generation():
+                raise ValueError("warm-up failed")
+        assert current_generation() == before
+
+    def test_redis_indexes_not_visible_until_generation_published(self):
+        before = ultimate_target_uris(["generation_test_a"])
+        with self.assertRaises(ValueError):
+            with new_cache_generation():
+                redis_client().hset(generation_key(MERGE_TARGETS_KEY), "generation_test_a", "generation_test_b")
+                assert ultimate_target_uris(["generation_test_a"]) == {"generation_test_a": "generation_test_b"}
+                raise ValueError("warm-up failed")
+        assert ultimate_target_uris(["generation_test_a"]) == before
+
+
+class TestLocalCache(TestCase):
+
+    def test_local_cache_follows_generation_and_evicts(self):
+        local = LocalCache(max_entries=2, ttl=60)
+        local.set("local_test_a", {"a": 1})
+        cache.set("local_test_a", {"a": 2}) # only seen once the local copy is gone
+        assert local.get("local_test_a") == {"a": 1}
+        with new_cache_generation():
+            assert local.get("local_test_a") is None
+            local.set("local_test_a", {"a": 3})
+        assert local.get("local_test_a") == {"a": 3}
+        local.set("local_test_b", 1)
+        local.set("local_test_c", 1)
+        assert len(local.entries) == 2
+
+
+class TestIndustryGeoWarmUp(TestCase):
+
+    def test_industry_geo_key_space(self):
+        values = {industry_geo_cache_key(12, "DE", None): ["https://1145.am/db/1/foo"]}
+        keys = industry_geo_key_space(values, [12, 13], countries_with_state_province=[])
+        assert len(keys) == len(set(keys))
+        assert industry_geo_cache_key(12, None, None) in keys
+        assert industry_geo_cache_key(13, "DE", None) in keys
+        assert industry_geo_cache_key(None, "DE", None) in keys
+        assert industry_geo_cache_key(12, "DE", None) == "orgs_industry_cluster_geo_12_DE_None_None"
+
+
+class TestIndustryGeoOrgIndex(TestCase):
+
+    def test_industry_geo_org_index(self):
+        index = IndustryGeoOrgIndex({"org_a": [1], "org_b": [1, 2], "org_c": [2]},
+                                    {"org_a": [("DE", "01")], "org_b": [("DE", "00"), ("US", "CA")], "org_d": [("US", "NY")]})
+        assert index.org_uris(1, "DE") == ["org_a", "org_b"]
+        assert index.org_uris(1, "DE", "01") == ["org_a"]
+        assert index.count(1, "DE", "00") == 0 # '00' is not an admin1
+        assert index.org_uris(None, "US") == ["org_b", "org_d"]
+        assert index.org_uris(2, None) == ["org_b", "org_c"]
+        assert index.count(2, "US", "CA") == 1
+        assert index.org_uris(None, None) is None
+        restored = pickle.loads(pickle.dumps(index))
+        assert restored.count(1, "DE") == 2
+
+
+class TestSingleFlight(TestCase):
+
+    def test_get_or_compute_single_flight_and_stale(self):
+        calls = []
+        def compute():
+            calls.append(1)
+            return "computed"
+        cache.delete("single_flight_test")
+        assert get_or_compute("single_flight_test", compute) == "computed"
+        assert get_or_compute("single_flight_test", compute) == "computed"
+        assert len(calls) == 1
+        cache.set("single_flight_test", CachedValue("stale", time.time() - 100))
+        lock = redis_client().lock(lock_name("single_flight_test"), timeout=10)
+        assert lock.acquire(blocking=False) # another worker is recomputing
+        try:
+            assert get_or_compute("single_flight_test", compute, stale_after=10) == "stale"
+        finally:
+            lock.release()
+        assert get_or_compute("single_flight_test", compute, stale_after=10) == "computed"
+        assert len(calls) == 2
+
+
 class TestRegionHierarchy(TestCase):
 
     def setUpTestData():
@@ -1,4 +1,7 @@
-from topics.models import Article
+from topics.models import Article, Resource
+
+TIMELINE_ORG_RELATIONSHIPS = ["vendor", "participant", "protagonist", "buyer", "investor",
+    "locationAdded", "locationRemoved", "hasRole", "target", "partnership", "awarded", "providedBy"]
 
 def get_timeline_data(org,combine_same_as_name_only, 
                       source_names = Article.core_sources(),
@@ -7,6 +10,9 @@ def get_timeline_data(org,combine_same_as_name_only,
     org_nodes = []
     activities = []
  
+    same_as_name_onlies = org.same_as_name_only_members() if combine_same_as_name_only is True else []
+    orgs = [org] + same_as_name_onlies
+    prefetch_timeline_relationships(orgs)
     display_data = org.serialize()
     org_display.append(display_data)
     org_nodes.append(org)
@@ -37,7 +43,7 @@ def get_timeline_data(org,combine_same_as_name_only,
     provided_by.extend(allowable_entities(org.providedBy, source_names))
 
     if combine_same_as_name_only is True:
-        for x in org.sameAsNameOnly:
+        for x in same_as_name_onlies:
             vendor.extend(allowable_entities(x.vendor,source_names))
             participant.extend(allowable_entities(x.participant,source_names))
             buyer.extend(allowable_entities(x.buyer,source_names))
@@ -119,7 +125,25 @@ def get_timeline_data(org,combine_same_as_name_only,
     return groups, items, item_display_details, org_display_details
 
 
+def prefetch_timeline_relationships(orgs):
+    '''
+        One query for the activities of all orgs and one for those activities' articles
+    '''
+    Resource.prefetch(orgs, TIMELINE_ORG_RELATIONSHIPS)
+    activities = []
+    for org in orgs:
+        for rel_key in TIMELINE_ORG_RELATIONSHIPS:
+            activities.extend(org.__dict__.get(rel_key, []))
+    Resource.prefetch(activities, ["documentSource", "withRole"])
+    role_activities = []
+    for x in activities:
+        role_activities.extend(x.__dict__.get("withRole", []))
+    Resource.prefetch(role_activities, ["documentSource"])
+    return activities + role_activities
+
+
 def allowable_entities(related_entities, source_names):
+    Resource.prefetch_article_metadata(related_entities)
     return [x for x in related_entities if x.has_permitted_document_source(source_names)]
 
 
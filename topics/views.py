@@ -329,9 +329,8 @@ class IndustryGeoOrgsView(APIView):
         geo_name = country_admin1_full_name(geo_code)
         organizations = []
         found_uris = set()
-        for org_uri in org_uris:
-            organization = Organization.self_or_ultimate_target_node(org_uri)
-            if organization.uri in found_uris:
+        for organization in Organization.self_or_ultimate_target_nodes(org_uris):
+            if organization is None or organization.uri in found_uris:
                 continue
             found_uris.add(organization.uri)
             serialized_org = organization.serialize()
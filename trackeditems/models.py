@@ -120,8 +120,8 @@ class TrackedOrganization(models.Model):
     @staticmethod
     def trackable_uris_by_user(user):
         tracked_orgs = TrackedOrganization.by_user(user)
-        org_uris = [x.organization_or_merged_uri for x in tracked_orgs]
-        return org_uris
+        orgs = Organization.self_or_ultimate_target_nodes([x.organization_uri for x in tracked_orgs])
+        return [x.uri if x is not None else None for x in orgs]
 
 
 class ActivityNotification(models.Model):
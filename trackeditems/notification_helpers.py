@@ -29,9 +29,10 @@ def recents_by_user_min_max_date(user, min_date, max_date):
     tracked_items = TrackedItem.trackable_by_user(user)
     org_uris = []
     matching_activity_orgs = []
+    tracked_org_uris = [ti.organization_uri for ti in tracked_items if ti.organization_uri is not None]
+    org_uris.extend([x.uri for x in Organization.self_or_ultimate_target_nodes(tracked_org_uris) if x is not None])
     for ti in tracked_items:
         if ti.organization_uri is not None:
-            org_uris.append(ti.organization_or_merged_uri)
             continue
         if ti.industry_search_str is not None:
             if ti.region is None: